@@ -1,2 +1,2 @@
-from ana.packages.common.lib.package_utils import get_volume_path
+from ana.packages.common.lib.package_utils import get_volume_path, get_asset_info
 import ana.packages.common.lib.context as ctx 
\ No newline at end of file
@@ -15,13 +15,50 @@ import sys
 import argparse
 import time
 import logging
-import yaml
-import os
 import ana.packages.common.lib.context as ctx
-from ana.packages.common.lib.interp import interp
+import ana.packages.common.lib.trace as trace
+from ana.packages.common.lib.interp import load_graph, run as run_graph
+from ana.packages.common.lib.daemon import serve
 
 logger = logging.getLogger(__name__)
 
+
+def get_interp_nums(args):
+    """
+    Return the list of interp_num values to run. A range is given as START:STOP
+    (STOP is exclusive) and a list file contains whitespace separated values.
+    Raises ValueError when the range or list doesn't give any values.
+    """
+    if args.interp_range is not None:
+        message = "--interp_range must be START:STOP with START < STOP"
+        try:
+            start, stop = (int(value) for value in args.interp_range.split(":"))
+        except ValueError:
+            raise ValueError(message) from None
+        if start >= stop:
+            raise ValueError(message)
+        return list(range(start, stop))
+    if args.interp_list is not None:
+        with open(args.interp_list, "r") as f:
+            values = f.read().split()
+        try:
+            interp_nums = [int(value) for value in values]
+        except ValueError:
+            raise ValueError("--interp_list file '{}' must contain whitespace separated integers".format(
+                args.interp_list)) from None
+        if not interp_nums:
+            raise ValueError("--interp_list file '{}' doesn't contain any interp_num values".format(args.interp_list))
+        return interp_nums
+    return [args.interp_num]
+
+
+def get_max_rss():
+    """ Return the peak memory use of this process in MB """
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
 if __name__ == "__main__":
     '''
     This is the main execution procedure for Ana. It takes a graph file as input
@@ -39,53 +76,113 @@ if __name__ == "__main__":
 
     # parse command line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--graph', required=True)
+    parser.add_argument('--graph', default=None)
     parser.add_argument('--channel', required=True)
     parser.add_argument('--loglevel', default="ERROR")
     parser.add_argument('--logfile', default=None)
     parser.add_argument('--seed', default=None, type=int)
     parser.add_argument('--interp_num', default=0, type=int)
+    parser.add_argument('--interp_range', default=None)
+    parser.add_argument('--interp_list', default=None)
     parser.add_argument('--preview', action="store_true", default=False)
     parser.add_argument('--output', default="./output")
     parser.add_argument('--data', default='./data')
+    parser.add_argument('--trace', default=None)
+    parser.add_argument('--max_rss', default=None, type=int)
+    parser.add_argument('--daemon', default=None)
+    parser.add_argument('--node_threads', default=0, type=int)
+    parser.add_argument('--cache_dir', default=None)
+    parser.add_argument('--cache_size', default=10240, type=int)
+    parser.add_argument('--prefetch', action="store_true", default=False)
     args = parser.parse_args(argv)
+    if args.graph is None and args.daemon is None:
+        parser.error("--graph is required unless running with --daemon")
 
-    # Create Ana
     try:
-        ctx.initialize(
-            channel_name=args.channel,
-            seed=args.seed,
-            interp_num=args.interp_num,
-            preview=args.preview,
-            output=args.output,
-            data=args.data,
-            loglevel=args.loglevel,
-            logfile=args.logfile)
+        interp_nums = get_interp_nums(args)
+    except ValueError as e:
+        parser.error(str(e))
     except Exception as e:
-        message = f"An exception of type {type(e).__name__} occurred while initializing channel"
+        message = f"An exception of type {type(e).__name__} occurred while parsing the interp_num values"
         logging.error(message, exc_info=e)
         sys.exit(1)
+    # a batch reports the status of every run, even when the range or list holds a single value
+    batch = args.interp_range is not None or args.interp_list is not None
 
-    # load graph - supports yaml or json format
+    # record a timeline of the run
+    if args.trace is not None:
+        trace.enable(args.trace)
+
+    # Create Ana
     try:
-        if '/' not in args.graph:
-            if '.yml' not in args.graph and os.path.isfile(f'./channels/{args.channel}/graphs/{args.graph}.yml'):
-                args.graph = f'channels/{args.channel}/graphs/{args.graph}.yml'
-            elif os.path.isfile(f'./channels/{args.channel}/graphs/{args.graph}'):
-                args.graph = f'channels/{args.channel}/graphs/{args.graph}'
-        with open(args.graph, "r") as f:
-            input_graph = yaml.safe_load(f)
+        with trace.span("initialize"):
+            ctx.initialize(
+                channel_name=args.channel,
+                seed=args.seed,
+                interp_num=interp_nums[0],
+                preview=args.preview,
+                output=args.output,
+                data=args.data,
+                loglevel=args.loglevel,
+                logfile=args.logfile,
+                node_threads=args.node_threads,
+                cache_dir=args.cache_dir,
+                cache_size=args.cache_size,
+                prefetch=args.prefetch)
     except Exception as e:
-        message = f"An exception of type {type(e).__name__} occurred while loading graph"
+        message = f"An exception of type {type(e).__name__} occurred while initializing channel"
         logging.error(message, exc_info=e)
         sys.exit(1)
 
+    # serve graph jobs from a socket instead of running a single graph
+    if args.daemon is not None:
+        try:
+            serve(args.daemon)
+        except Exception as e:
+            message = f"An exception of type {type(e).__name__} occurred in the daemon"
+            logging.error(message, exc_info=e)
+            sys.exit(1)
+        sys.exit(0)
+
+    # load graph - supports yaml or json format
     try:
-        interp(input_graph)
+        input_graph = load_graph(args.graph, args.channel)
     except Exception as e:
-        message = f"An exception of type {type(e).__name__} occurred while interpreting graph"
+        message = f"An exception of type {type(e).__name__} occurred while loading graph"
         logging.error(message, exc_info=e)
         sys.exit(1)
 
+    # interpret the graph once per interp_num - in batch mode a failed run doesn't stop the batch
+    failed = []
+    for run, interp_num in enumerate(interp_nums):
+        runstarttime = time.time()
+        status = "ok"
+        try:
+            run_graph(input_graph, interp_num, reset_channel=run > 0)
+        except Exception as e:
+            message = f"An exception of type {type(e).__name__} occurred while interpreting graph"
+            if not batch:
+                logging.error(message, exc_info=e)
+                sys.exit(1)
+            logging.error(f"{message} for interp_num {interp_num}", exc_info=e)
+            failed.append(interp_num)
+            status = "failed"
+        if batch:
+            print('Run {}: {} Elapsed Time: {:.3f}sec'.format(
+                interp_num, status, time.time()-runstarttime), flush=True)
+            # stop the batch early when memory use has grown too large, the runner restarts the rest
+            if args.max_rss is not None and run < len(interp_nums) - 1 and get_max_rss() > args.max_rss:
+                logger.warning("Stopping after interp_num %d, memory use %dMB exceeds %dMB",
+                               interp_num, get_max_rss(), args.max_rss)
+                print('Stopped batch after run {}'.format(interp_num), flush=True)
+                break
 
+    if failed:
+        logging.error("%d of %d runs failed, interp_num: %s", len(failed), len(interp_nums),
+                      ", ".join(str(num) for num in failed))
+
+    if ctx.volume_cache is not None:
+        print(ctx.volume_cache.summary())
     print('Elapsed Time: {:.3f}sec'.format(time.time()-starttime))
+    if failed:
+        sys.exit(1)
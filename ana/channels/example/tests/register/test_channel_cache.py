@@ -0,0 +1,92 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the cache of resolved channel configurations.
+"""
+import os
+import pytest
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.channel import Channel, channel_cache_file, load_channel_cache, save_channel_cache
+
+CHANNEL = ("classes", {"schema": [1, 2]}, {"package": {"objects": {"Cube": {"filename": "a.blend"}}}}, {})
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("ANA_CACHE_DIR", str(cache_dir))
+    return channel_cache_file(str(tmp_path), "test")
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "channel.yml"
+    path.write_text("nodes: {}\n")
+    return str(path)
+
+
+def test_round_trip(cache_file, source):
+    save_channel_cache(cache_file, [source], CHANNEL)
+    assert load_channel_cache(cache_file) == list(CHANNEL)
+    assert oct(os.stat(os.path.dirname(cache_file)).st_mode & 0o777) == oct(0o700)
+
+
+def test_changed_file_invalidates(cache_file, source):
+    save_channel_cache(cache_file, [source], CHANNEL)
+    # touching a file without changing it keeps the cache
+    os.utime(source, ns=(0, 0))
+    assert load_channel_cache(cache_file) == list(CHANNEL)
+    with open(source, "w") as f:
+        f.write("nodes: {a: 1}\n")
+    assert load_channel_cache(cache_file) is None
+
+
+def test_removed_file_invalidates(cache_file, source):
+    save_channel_cache(cache_file, [source], CHANNEL)
+    os.remove(source)
+    assert load_channel_cache(cache_file) is None
+
+
+@pytest.mark.parametrize("contents", ["", "{", "[1, 2]", '{"version": 2}'])
+def test_corrupt_cache_is_ignored(cache_file, source, contents):
+    save_channel_cache(cache_file, [source], CHANNEL)
+    with open(cache_file, "w") as f:
+        f.write(contents)
+    assert load_channel_cache(cache_file) is None
+
+
+def test_shared_cache_is_ignored(cache_file, source):
+    save_channel_cache(cache_file, [source], CHANNEL)
+    os.chmod(os.path.dirname(cache_file), 0o777)
+    assert load_channel_cache(cache_file) is None
+    os.chmod(os.path.dirname(cache_file), 0o700)
+    os.chmod(cache_file, 0o666)
+    assert load_channel_cache(cache_file) is None
+
+
+def test_values_json_cant_hold_are_not_cached(cache_file, source):
+    save_channel_cache(cache_file, [source], ("classes", {1: "integer key"}, {}, {}))
+    assert not os.path.exists(cache_file)
+
+
+def test_channel_uses_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("ANA_CACHE_DIR", str(tmp_path))
+    channel = os.path.dirname(os.path.realpath(__file__)).split('/')[-3]
+    parsed = Channel(ctx.ROOT_DIR, ctx.BASE_DIR, channel)
+    assert os.path.isfile(channel_cache_file(ctx.BASE_DIR, channel))
+    monkeypatch.setattr(Channel, "parse", lambda *args: pytest.fail("the cached configuration was not used"))
+    cached = Channel(ctx.ROOT_DIR, ctx.BASE_DIR, channel)
+    assert (cached.classes, cached.schemas, cached.packages, cached.package_config_files) == \
+        (parsed.classes, parsed.schemas, parsed.packages, parsed.package_config_files)
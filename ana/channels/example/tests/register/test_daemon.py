@@ -0,0 +1,80 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the daemon socket protocol - bad requests and clients must not stop the daemon.
+"""
+import os
+import socket
+import threading
+import time
+import types
+import pytest
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib import daemon
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ctx, "channel", types.SimpleNamespace(name="test", classes={}))
+    monkeypatch.setattr(ctx, "seed", 1)
+    monkeypatch.setattr(ctx, "preview", False)
+    monkeypatch.setattr(ctx, "output", str(tmp_path))
+    path = str(tmp_path / "daemon.sock")
+    thread = threading.Thread(target=daemon.serve, args=(path,), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.01)
+    yield path
+    # tests may have stopped the daemon already
+    thread.join(0.5)
+    if thread.is_alive():
+        daemon.request(path, {"command": "shutdown"})
+        thread.join(5)
+    assert not thread.is_alive()
+    assert not os.path.exists(path)
+
+
+def send(socket_path, data):
+    # send raw bytes and return the reply line, empty when the daemon closed the connection
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(data)
+        try:
+            with client.makefile("r") as stream:
+                return stream.readline()
+        except ConnectionResetError:
+            return ""
+
+
+def test_invalid_jobs(socket_path):
+    for job in ([1], "graph", None):
+        reply = daemon.request(socket_path, job)
+        assert reply["status"] == "failed"
+        assert reply["error"].startswith("Invalid job: expected a JSON object")
+    assert daemon.request(socket_path, "{")["status"] == "failed"
+    assert "Invalid job" in send(socket_path, b"{\n")
+
+
+def test_bad_clients_only_end_their_connection(socket_path):
+    # bytes that aren't text, and a client that leaves without reading its reply
+    assert send(socket_path, b"\xff\xfe\n") == ""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(b'{"interp_num": 1}\n')
+    reply = daemon.request(socket_path, {"interp_num": 2})
+    assert reply["status"] == "failed" and reply["interp_num"] == 2
+    assert daemon.request(socket_path, {"command": "shutdown"}) == {"status": "ok"}
@@ -0,0 +1,209 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for weighted generator selection - alias tables, when they are rebuilt and compiled programs.
+"""
+import json
+import os
+import numpy as np
+import pytest
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.ana_object import AnaObject
+from ana.packages.common.lib.generator import (
+    Generator, ObjectGenerator, CreateBranchGenerator, ObjectModifier, GeneratorProgram,
+    build_alias_table, compile_generator)
+
+dirpath = os.path.dirname(os.path.realpath(__file__))
+channel = dirpath.split('/')[-3]
+if not ctx.initialized:
+    ctx.initialize(channel_name=channel)
+
+
+@pytest.fixture(autouse=True)
+def run():
+    Generator.reset()
+    ctx.reset(0)
+    yield
+    Generator.reset()
+
+
+def table_probabilities(table):
+    # the probability of each index implied by an alias table
+    prob, alias = table
+    probs = prob.copy()
+    np.add.at(probs, alias, 1.0 - prob)
+    return probs / len(prob)
+
+
+def leaves(*weights):
+    generators = []
+    for num, weight in enumerate(weights):
+        generator = ObjectGenerator(AnaObject, "object{}".format(num))
+        generator.weight = weight
+        generators.append(generator)
+    return generators
+
+
+@pytest.mark.parametrize("weights", [[1], [1, 1], [1, 2, 3, 4], [0, 5, 0.5], [1e-6, 1, 1000]])
+def test_alias_table(weights):
+    expected = np.array(weights, dtype=np.float64) / sum(weights)
+    assert np.allclose(table_probabilities(build_alias_table(weights)), expected)
+
+
+def test_alias_table_without_weights():
+    with pytest.raises(ValueError):
+        build_alias_table([])
+    with pytest.raises(ValueError):
+        build_alias_table([0, 0])
+
+
+def test_selection_follows_weights():
+    branch = CreateBranchGenerator(children=leaves(1, 3))
+    counts = np.bincount(branch.select_indices(40000), minlength=2)
+    assert abs(counts[1] / counts.sum() - 0.75) < 0.02
+
+
+def test_select_children():
+    children = leaves(1, 3)
+    branch = CreateBranchGenerator(children=children)
+    selected = branch.select_children(40000)
+    assert len(selected) == 40000
+    assert all(child is children[0] or child is children[1] for child in selected)
+    assert abs(sum(child is children[1] for child in selected) / len(selected) - 0.75) < 0.02
+    assert branch.select_children(0) == []
+
+
+def test_weight_change_rebuilds_table():
+    children = leaves(1, 1)
+    branch = CreateBranchGenerator(children=children)
+    other = CreateBranchGenerator(children=[children[1]])
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.5, 0.5])
+    table = branch.alias_table()
+    assert branch.alias_table() is table
+    other.alias_table()
+    children[0].weight = 3
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.75, 0.25])
+    # the weight of a generator only affects its parents
+    assert other._alias_table is not None
+
+
+def test_children_changes_rebuild_table():
+    branch = CreateBranchGenerator(children=leaves(1, 1))
+    branch.alias_table()
+    # replacing a child in place keeps the length
+    branch.children[1] = leaves(3)[0]
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.25, 0.75])
+    branch.children.append(leaves(4)[0])
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.125, 0.375, 0.5])
+    del branch.children[0]
+    assert np.allclose(table_probabilities(branch.alias_table()), [3 / 7, 4 / 7])
+    branch.children = leaves(1, 1)
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.5, 0.5])
+    # the weight of a child added in place still reaches the table
+    branch.children[0].weight = 3
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.75, 0.25])
+
+
+def test_clone_has_its_own_table():
+    children = leaves(1, 1)
+    branch = CreateBranchGenerator(children=children)
+    branch.alias_table()
+    clone = branch.clone()
+    clone.children = [children[0]]
+    assert np.allclose(table_probabilities(clone.alias_table()), [1.0])
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.5, 0.5])
+    children[1].weight = 3
+    assert np.allclose(table_probabilities(branch.alias_table()), [0.25, 0.75])
+
+
+def route_probabilities(node, prob=1.0, outer=(), result=None):
+    # reference result of a compiled program - follow every route, keyed by (leaf, modifiers innermost first)
+    if result is None:
+        result = {}
+    if not isinstance(node, (CreateBranchGenerator, ObjectModifier)):
+        key = (node, tuple(reversed(outer)))
+        result[key] = result.get(key, 0.0) + prob
+        return result
+    if isinstance(node, ObjectModifier):
+        outer = outer + (node,)
+    total = sum(child.weight for child in node.children)
+    for child in node.children:
+        if child.weight > 0:
+            route_probabilities(child, prob * child.weight / total, outer, result)
+    return result
+
+
+def program_probabilities(program):
+    return {
+        (program.leaves[leaf], tuple(program.modifiers[modifier] for modifier in program.chains[chain])): prob
+        for leaf, chain, prob in zip(program.path_leaves, program.path_chains, program.probs)}
+
+
+@pytest.fixture
+def tree():
+    first, second, unused = leaves(1, 3, 0)
+    inner = ObjectModifier("make_materials_unique", [first, second])
+    outer = ObjectModifier("make_materials_unique", [inner, first, unused])
+    outer.weight = 2
+    return CreateBranchGenerator(children=[outer, second, inner])
+
+
+def test_compile_generator(tree):
+    program = compile_generator(tree)
+    expected = route_probabilities(tree)
+    probs = program_probabilities(program)
+    assert probs.keys() == expected.keys()
+    for key, prob in expected.items():
+        assert probs[key] == pytest.approx(prob)
+    assert program.probs.sum() == pytest.approx(1.0)
+    # the leaf without weight is left out
+    assert len(program.leaves) == 2 and len(program.modifiers) == 2
+
+
+def test_compile_shared_children():
+    # 2 ** 40 routes to two leaves, compiling must visit each generator once
+    root = CreateBranchGenerator(children=leaves(1, 3))
+    for _ in range(40):
+        root = CreateBranchGenerator(children=[root, root])
+    root = ObjectModifier("make_materials_unique", [root])
+    program = compile_generator(root)
+    assert np.allclose(program.probs, [0.25, 0.75])
+    assert program.chains == [(0,)]
+
+
+def test_dump_and_load(tree):
+    program = compile_generator(tree)
+    loaded = GeneratorProgram.load(json.loads(json.dumps(program.dump())))
+    assert np.array_equal(loaded.path_leaves, program.path_leaves)
+    assert np.array_equal(loaded.path_chains, program.path_chains)
+    assert np.allclose(loaded.probs, program.probs)
+    assert loaded.chains == program.chains
+    assert [(leaf.object_class, leaf.object_type, leaf.kwargs) for leaf in loaded.leaves] == [
+        (leaf.object_class, leaf.object_type, leaf.kwargs) for leaf in program.leaves]
+    assert [modifier.method for modifier in loaded.modifiers] == [modifier.method for modifier in program.modifiers]
+
+    # the loaded program samples paths in proportion to their probabilities
+    counts = np.bincount(loaded.sample(40000), minlength=len(loaded.probs))
+    assert np.allclose(counts / counts.sum(), program.probs, atol=0.015)
+
+
+def test_instanced_objects_cant_be_modified():
+    modifier = ObjectModifier("make_materials_unique", [])
+    obj = AnaObject("object")
+    obj.load_mode = "instance"
+    with pytest.raises(ValueError, match="load: instance"):
+        modifier.apply(obj)
+    obj.load_mode = "append"
+    assert modifier.apply(obj) is obj
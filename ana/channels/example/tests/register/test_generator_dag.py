@@ -0,0 +1,113 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the generator DAG helpers - leaves, path counts and pruning a tree to a leaf.
+"""
+import copy
+import itertools
+import pytest
+import ana.packages.common.lib.generator_dag as generator_dag
+
+
+class Node:
+    """ Stand-in for a generator, only what the DAG helpers use """
+    ids = itertools.count()
+
+    def __init__(self, name, children=()):
+        self.id = next(Node.ids)
+        self.name = name
+        self.children = list(children)
+
+    def clone(self):
+        the_clone = copy.copy(self)
+        the_clone.id = next(Node.ids)
+        the_clone.children = []
+        return the_clone
+
+
+class Leaf(Node):
+    pass
+
+
+def names(tree):
+    # nested (name, children) tuples of a tree
+    if isinstance(tree, Leaf):
+        return tree.name
+    return (tree.name, [names(child) for child in tree.children])
+
+
+@pytest.fixture
+def dag():
+    # a and b are shared by both branches
+    a, b, c = Leaf("a"), Leaf("b"), Leaf("c")
+    left = Node("left", [a, b])
+    right = Node("right", [b, c, a])
+    root = Node("root", [left, right])
+    return root, {node.name: node for node in (a, b, c, left, right, root)}
+
+
+def test_unique_leaves(dag):
+    root, _ = dag
+    assert [leaf.name for leaf in generator_dag.unique_leaves(root, Leaf)] == ["a", "b", "c"]
+
+
+def test_count_paths(dag):
+    root, nodes = dag
+    assert generator_dag.count_paths(root, Leaf) == 5
+    assert generator_dag.count_paths(root, Leaf, nodes["c"].id) == 1
+
+
+def test_count_paths_is_linear():
+    # 2 ** 40 paths through 80 nodes
+    tree = Leaf("leaf")
+    for depth in range(40):
+        tree = Node(str(depth), [tree, tree])
+    assert generator_dag.count_paths(tree, Leaf) == 2 ** 40
+
+
+def test_prune_to_leaf(dag):
+    root, nodes = dag
+    pruned = generator_dag.prune_to_leaf(root, nodes["a"].id, Leaf)
+    assert names(pruned) == ("root", [("left", ["a"]), ("right", ["a"])])
+    # the shared leaf is cloned once and stays shared
+    assert pruned.children[0].children[0] is pruned.children[1].children[0]
+    assert pruned.children[0].children[0] is not nodes["a"]
+
+    pruned = generator_dag.prune_to_leaf(root, nodes["c"].id, Leaf)
+    assert names(pruned) == ("root", [("right", ["c"])])
+
+
+def test_prune_to_leaf_returns_a_fresh_copy(dag):
+    root, nodes = dag
+    first = generator_dag.prune_to_leaf(root, nodes["b"].id, Leaf)
+    second = generator_dag.prune_to_leaf(root, nodes["b"].id, Leaf)
+    assert first is not second
+    assert first.children[0] is not second.children[0]
+    first.children.pop()
+    assert names(second) == ("root", [("left", ["b"]), ("right", ["b"])])
+
+
+def test_prune_to_leaf_follows_changes(dag):
+    root, nodes = dag
+    generator_dag.prune_to_leaf(root, nodes["c"].id, Leaf)
+    nodes["left"].children[1] = nodes["c"]
+    pruned = generator_dag.prune_to_leaf(root, nodes["c"].id, Leaf)
+    assert names(pruned) == ("root", [("left", ["c"]), ("right", ["c"])])
+
+
+def test_prune_to_unknown_leaf(dag):
+    root, nodes = dag
+    with pytest.raises(ValueError):
+        generator_dag.prune_to_leaf(nodes["left"], nodes["c"].id, Leaf)
@@ -0,0 +1,83 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Memory tests for the generator registry - repeated runs in one process must not accumulate generators.
+"""
+import gc
+import os
+import tracemalloc
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.ana_object import AnaObject
+from ana.packages.common.lib.generator import (
+    Generator, ObjectGenerator, CreateBranchGenerator, ObjectModifier,
+    create_single_path, create_multi_path, compile_generator)
+
+dirpath = os.path.dirname(os.path.realpath(__file__))
+channel = dirpath.split('/')[-3]
+if not ctx.initialized:
+    ctx.initialize(channel_name=channel)
+
+RUNS = 1000
+
+
+def simulate_run(run):
+    # build a generator tree with shared children and exercise the path helpers like a graph run would
+    Generator.reset()
+    ctx.reset(run)
+    leaves = [ObjectGenerator(AnaObject, "object{}".format(num)) for num in range(10)]
+    modifier = ObjectModifier("make_materials_unique", leaves[:3])
+    branches = [CreateBranchGenerator(children=leaves[num:num + 4]) for num in range(0, 8, 2)]
+    root = CreateBranchGenerator(children=branches + [modifier])
+    for _ in range(3):
+        create_single_path(root)
+        create_multi_path(root)
+    compile_generator(root).sample(20)
+
+
+def live_generators():
+    gc.collect()
+    return len(Generator.generators)
+
+
+def test_generators_are_freed():
+    simulate_run(0)
+    # nothing outlives the run
+    assert live_generators() == 0
+    assert Generator.next_id > 0
+    Generator.reset()
+    assert live_generators() == 0
+    assert Generator.next_id == 0
+
+
+def test_registry_stays_flat():
+    sizes = []
+    ids = []
+    tracemalloc.start()
+    try:
+        for run in range(RUNS):
+            simulate_run(run)
+            sizes.append(live_generators())
+            ids.append(Generator.next_id)
+            if run == 99:
+                baseline, _ = tracemalloc.get_traced_memory()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    Generator.reset()
+
+    assert max(sizes) <= max(sizes[:100])
+    # ids restart every run, how many a run uses depends on the sampled leaves
+    assert max(ids) < 2 * min(ids)
+    # allow for allocator noise, a leak of one tree per run would be several MB
+    assert current - baseline < 256 * 1024
@@ -0,0 +1,128 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduling tests for the graph execution plan - ordering, main thread nodes and errors.
+"""
+import threading
+import types
+import pytest
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.node import Node, NodeRegistry
+from ana.packages.common.lib.interp import ExecutionPlan
+from ana.packages.common.lib.exceptions import GraphError
+
+SCHEMAS = {
+    "Value": {"inputs": [{"name": "Value"}], "outputs": [{"name": "Value"}], "main_thread": False},
+    "Sum": {"inputs": [{"name": "Values"}], "outputs": [{"name": "Value"}], "main_thread": False},
+    "Blender": {"inputs": [{"name": "Values"}], "outputs": [{"name": "Value"}]},
+}
+
+
+class RecordNode(Node):
+    """ Adds its inputs and records where it ran """
+    log = []
+
+    def exec(self):
+        RecordNode.log.append((self.name, threading.current_thread() is threading.main_thread()))
+        if self.inputs.get("Fail"):
+            raise RuntimeError("{} failed".format(self.name))
+        values = self.inputs.get("Value", []) + self.inputs.get("Values", [])
+        return {"Value": sum(values)}
+
+
+@pytest.fixture(autouse=True)
+def channel(monkeypatch):
+    registry = NodeRegistry({}, SCHEMAS)
+    monkeypatch.setattr(ctx, "channel", types.SimpleNamespace(registry=registry))
+    RecordNode.log = []
+
+
+def make_nodes(graph):
+    # graph: {name: (alias, {port: values or [(src_node, src_port), ...]})}
+    nodes = {}
+    for name, (alias, ports) in graph.items():
+        node = RecordNode(name, alias)
+        for port, values in ports.items():
+            if values and isinstance(values[0], tuple):
+                node.inlinks[port] = list(values)
+            else:
+                node.inputs[port] = list(values)
+        nodes[name] = node
+    return nodes
+
+
+def diamond():
+    return make_nodes({
+        "d": ("Sum", {"Values": [("b", "Value"), ("c", "Value")]}),
+        "c": ("Value", {"Value": [("a", "Value")]}),
+        "b": ("Value", {"Value": [("a", "Value")]}),
+        "a": ("Value", {"Value": [1]}),
+        "e": ("Blender", {"Values": [("d", "Value"), ("a", "Value")]}),
+    })
+
+
+def test_order_breaks_ties_by_name():
+    plan = ExecutionPlan(make_nodes({
+        "z": ("Value", {"Value": [1]}),
+        "y": ("Value", {"Value": [("z", "Value")]}),
+        "a": ("Value", {"Value": [2]}),
+        "m": ("Sum", {"Values": [("y", "Value"), ("a", "Value")]}),
+    }))
+    assert plan.order == ["a", "z", "y", "m"]
+
+
+@pytest.mark.parametrize("threads", [0, 1, 4])
+def test_execute_matches_serial(threads):
+    nodes = diamond()
+    ExecutionPlan(nodes).execute(threads)
+    # inputs are ordered by the plan position of their source, not by finishing order
+    assert nodes["d"].inputs["Values"] == [1, 1]
+    assert nodes["e"].inputs["Values"] == [1, 2]
+    assert sorted(name for name, _ in RecordNode.log) == ["a", "b", "c", "d", "e"]
+
+
+def test_main_thread_nodes_stay_on_main_thread():
+    nodes = make_nodes({"v{}".format(num): ("Value", {"Value": [num]}) for num in range(8)})
+    nodes.update(make_nodes({
+        "blender": ("Blender", {"Values": [("v{}".format(num), "Value") for num in range(8)]})}))
+    ExecutionPlan(nodes).execute(4)
+    ran = dict(RecordNode.log)
+    assert ran["blender"] is True
+    assert nodes["blender"].inputs["Values"] == list(range(8))
+
+
+@pytest.mark.parametrize("threads", [0, 4])
+def test_node_errors_propagate(threads):
+    nodes = diamond()
+    nodes["c"].inputs["Fail"] = [True]
+    with pytest.raises(RuntimeError, match="c failed"):
+        ExecutionPlan(nodes).execute(threads)
+    # nothing downstream of the failed node ran
+    assert "d" not in dict(RecordNode.log)
+
+
+def test_cycle_is_reported():
+    nodes = make_nodes({
+        "a": ("Value", {"Value": [("b", "Value")]}),
+        "b": ("Value", {"Value": [("a", "Value")]}),
+    })
+    with pytest.raises(GraphError, match="cyclic"):
+        ExecutionPlan(nodes)
+
+
+def test_undefined_link_is_reported():
+    nodes = make_nodes({"a": ("Value", {"Value": [("missing", "Value")]})})
+    with pytest.raises(GraphError, match="undefined node"):
+        ExecutionPlan(nodes)
@@ -0,0 +1,53 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for parsing the interp_num values of a run from the command line.
+"""
+import types
+import pytest
+from ana.ana import get_interp_nums
+
+
+def args(interp_num=0, interp_range=None, interp_list=None):
+    return types.SimpleNamespace(interp_num=interp_num, interp_range=interp_range, interp_list=interp_list)
+
+
+def test_interp_num():
+    assert get_interp_nums(args(interp_num=7)) == [7]
+
+
+def test_interp_range():
+    assert get_interp_nums(args(interp_range="2:5")) == [2, 3, 4]
+    assert get_interp_nums(args(interp_range="5:6")) == [5]
+
+
+@pytest.mark.parametrize("interp_range", ["5:5", "6:5", "5", "1:2:3", "a:b", ""])
+def test_invalid_interp_range(interp_range):
+    with pytest.raises(ValueError, match="START < STOP"):
+        get_interp_nums(args(interp_range=interp_range))
+
+
+def test_interp_list(tmp_path):
+    listfile = tmp_path / "list.txt"
+    listfile.write_text("3 1\n3\n")
+    assert get_interp_nums(args(interp_list=str(listfile))) == [3, 1, 3]
+
+
+@pytest.mark.parametrize("text, match", [("", "doesn't contain"), (" \n", "doesn't contain"), ("1 x", "integers")])
+def test_invalid_interp_list(tmp_path, text, match):
+    listfile = tmp_path / "list.txt"
+    listfile.write_text(text)
+    with pytest.raises(ValueError, match=match):
+        get_interp_nums(args(interp_list=str(listfile)))
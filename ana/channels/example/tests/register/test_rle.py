@@ -0,0 +1,79 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Round-trip and format tests for the COCO run-length encoder used for annotations.
+"""
+import numpy
+import pytest
+import ana.packages.common.lib.rle as rle
+
+
+def naive_encode(mask):
+    # reference implementation - walk the pixels in column-major order
+    counts = []
+    current = False
+    count = 0
+    for pixel in mask.flatten(order='F'):
+        if bool(pixel) != current:
+            counts.append(count)
+            current = bool(pixel)
+            count = 0
+        count += 1
+    counts.append(count)
+    return {"size": list(mask.shape), "counts": counts}
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (1, 7), (7, 1), (5, 9), (64, 48)])
+@pytest.mark.parametrize("density", [0.0, 0.1, 0.5, 0.9, 1.0])
+def test_round_trip(shape, density):
+    mask = numpy.random.RandomState(0).random_sample(shape) < density
+    encoded = rle.encode(mask)
+    assert encoded == naive_encode(mask)
+    assert numpy.array_equal(rle.decode(encoded), mask)
+    assert rle.area(encoded) == mask.sum()
+
+
+def test_known_encoding():
+    mask = numpy.array([
+        [0, 1, 1],
+        [0, 1, 0]], dtype=bool)
+    # column-major pixels are 0 0 1 1 1 0
+    assert rle.encode(mask) == {"size": [2, 3], "counts": [2, 3, 1]}
+    # a mask that starts with a foreground pixel starts with an empty background run
+    assert rle.encode(~mask)["counts"] == [0, 2, 3, 1]
+
+
+def test_instance_mask_round_trip():
+    # an instance mask with many objects, as written by the index pass
+    img = numpy.random.RandomState(1).randint(0, 20, size=(1080, 1920)).astype(numpy.uint16)
+    for instance in range(20):
+        mask = img == instance
+        assert numpy.array_equal(rle.decode(rle.encode(mask)), mask)
+
+
+def test_invalid_counts():
+    with pytest.raises(ValueError):
+        rle.decode({"size": [2, 2], "counts": [1, 2]})
+
+
+def test_full_hd_round_trip():
+    # a full HD mask with a large object, encoded without walking the pixels in Python
+    mask = numpy.zeros((1080, 1920), dtype=bool)
+    mask[100:900, 300:1500] = True
+    encoded = rle.encode(mask)
+    # one background run before each object column, one object run per column and the final background run
+    assert len(encoded["counts"]) == 2 * 1200 + 1
+    assert rle.area(encoded) == 800 * 1200
+    assert numpy.array_equal(rle.decode(encoded), mask)
@@ -0,0 +1,80 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the batch runner with a stand-in for Blender that reports runs like ana.py.
+"""
+import os
+import sys
+import stat
+import argparse
+import threading
+import pytest
+from ana.runner import Runner
+
+# stand-in for blender: runs the interp_list the way ana.py does, MODE changes how it reports
+STUB = '''#!{python}
+import sys
+argv = sys.argv[sys.argv.index("--") + 1:]
+interp_nums = open(argv[argv.index("--interp_list") + 1]).read().split()
+mode = "{mode}"
+for run, interp_num in enumerate(interp_nums):
+    if mode == "silent":
+        continue
+    print("Run {{}}: ok Elapsed Time: 0.001sec".format(interp_num), flush=True)
+    if mode == "stop" and run == 0 and len(interp_nums) > 1:
+        print("Stopped batch after run {{}}".format(interp_num), flush=True)
+        break
+'''
+
+
+def make_args(tmp_path, mode, **kwargs):
+    blender = tmp_path / "blender"
+    blender.write_text(STUB.format(python=sys.executable, mode=mode))
+    blender.chmod(blender.stat().st_mode | stat.S_IXUSR)
+    args = dict(graph="graph", channel="example", count=3, start=0, workers=2, threads=2, jobs_per_worker=50,
+                max_rss=None, retries=2, seed=1, blender=str(blender), preview=False, output=str(tmp_path),
+                data=str(tmp_path), cache_dir=None, cache_size=10240, prefetch=False, loglevel="ERROR")
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def run(args):
+    # the runner must finish on its own, a hang fails the test instead of blocking the suite
+    runner = Runner(args)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(failed=runner.run()), daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "runner did not finish"
+    return runner, result["failed"]
+
+
+@pytest.mark.parametrize("count, workers, jobs_per_worker", [(3, 2, 50), (1, 1, 50), (4, 1, 2), (5, 3, 1)])
+def test_all_runs_complete(tmp_path, count, workers, jobs_per_worker):
+    runner, failed = run(make_args(tmp_path, "ok", count=count, workers=workers, jobs_per_worker=jobs_per_worker))
+    assert failed == []
+    assert sorted(runner.done) == list(range(count))
+
+
+def test_unreported_runs_fail_instead_of_requeueing(tmp_path):
+    runner, failed = run(make_args(tmp_path, "silent", count=3, workers=2, retries=1))
+    assert failed == [0, 1, 2]
+    assert all(runner.attempts[interp_num] == 2 for interp_num in range(3))
+
+
+def test_stopped_batches_are_requeued(tmp_path):
+    runner, failed = run(make_args(tmp_path, "stop", count=6, workers=1, retries=0))
+    assert failed == []
+    assert sorted(runner.done) == list(range(6))
@@ -0,0 +1,137 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the volume file cache - hashing, copies, hits, eviction and prefetching.
+"""
+import os
+import threading
+import pytest
+import ana.packages.common.lib.volume_cache as volume_cache
+from ana.packages.common.lib.volume_cache import VolumeCache
+
+
+@pytest.fixture
+def volume(tmp_path):
+    directory = tmp_path / "volume"
+    directory.mkdir()
+
+    def write(name, data):
+        path = directory / name
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "cache")
+
+
+def test_copy_and_hit(volume, cache_dir):
+    source = volume("a.blend", b"a" * 1000)
+    cache = VolumeCache(cache_dir, 1 << 20)
+    cached = cache.get(source)
+    assert cached != source and cached.endswith(".blend")
+    assert open(cached, "rb").read() == b"a" * 1000
+    assert cache.get(source) == cached
+    assert cache.stats == {"hits": 0, "misses": 1, "bytes_saved": 0, "bytes_copied": 1000}
+
+    # another process finds the file through the shared index
+    other = VolumeCache(cache_dir, 1 << 20)
+    assert other.get(source) == cached
+    assert other.stats == {"hits": 1, "misses": 0, "bytes_saved": 1000, "bytes_copied": 0}
+    assert "1 files found, 0 copied (100% hit rate)" in other.summary()
+
+
+def test_same_contents_are_stored_once(volume, cache_dir):
+    first = volume("a.blend", b"same")
+    second = volume("b.blend", b"same")
+    cache = VolumeCache(cache_dir, 1 << 20)
+    assert cache.get(first) == cache.get(second)
+    assert len(os.listdir(cache.files_dir)) == 1
+
+
+def test_changed_source_is_copied_again(volume, cache_dir):
+    source = volume("a.blend", b"old")
+    cached = VolumeCache(cache_dir, 1 << 20).get(source)
+    volume("a.blend", b"new contents")
+    cache = VolumeCache(cache_dir, 1 << 20)
+    changed = cache.get(source)
+    assert changed != cached
+    assert open(changed, "rb").read() == b"new contents"
+    assert cache.stats["misses"] == 1
+
+
+def test_files_that_cant_be_cached(volume, cache_dir, tmp_path):
+    cache = VolumeCache(cache_dir, 100)
+    large = volume("large.blend", b"x" * 101)
+    missing = str(tmp_path / "missing.blend")
+    assert cache.get(large) == large
+    assert cache.get(missing) == missing
+    assert cache.get(str(tmp_path)) == str(tmp_path)
+    assert cache.stats["misses"] == 0
+
+
+def test_least_recently_used_files_are_evicted(volume, cache_dir):
+    cache = VolumeCache(cache_dir, 250)
+    paths = [volume("{}.blend".format(num), bytes([num]) * 100) for num in range(3)]
+    first = cache.get(paths[0])
+    second = cache.get(paths[1])
+    # use the first file again so the second one is the oldest
+    VolumeCache(cache_dir, 250).get(paths[0])
+    third = cache.get(paths[2])
+    assert os.path.isfile(first) and os.path.isfile(third)
+    assert not os.path.exists(second)
+    with cache.locked_index() as index:
+        assert sum(entry["size"] for entry in index["files"].values()) <= 250
+        assert os.path.abspath(paths[1]) not in index["sources"]
+
+
+def test_prefetch(volume, cache_dir):
+    paths = [volume("{}.blend".format(num), bytes([num]) * 100) for num in range(3)]
+    cache = VolumeCache(cache_dir, 1 << 20)
+    cache.prefetch(paths)
+    cached = [cache.get(path) for path in paths]
+    assert all(os.path.dirname(path) == cache.files_dir for path in cached)
+    assert cache.futures == {}
+    cache.cancel_prefetch()
+    assert cache.stats["misses"] == 3
+
+
+def test_cancel_prefetch(volume, cache_dir, monkeypatch):
+    monkeypatch.setattr(volume_cache, "COPY_CHUNK", 10)
+    source = volume("a.blend", b"a" * 1000)
+    cache = VolumeCache(cache_dir, 1 << 20)
+    started = threading.Event()
+    resume = threading.Event()
+    copy = cache.copy
+
+    def slow_copy(*args):
+        started.set()
+        resume.wait(5)
+        return copy(*args)
+    monkeypatch.setattr(cache, "copy", slow_copy)
+    cache.prefetch([source, volume("b.blend", b"b")])
+    assert started.wait(5)
+    executor = cache.executor
+    cache.cancel_prefetch()
+    resume.set()
+    executor.shutdown(wait=True)
+    # the copy in progress stopped without leaving files behind, and the queued file was dropped
+    assert os.listdir(cache.files_dir) == []
+    assert cache.stats["misses"] == 0
+    # the file is still copied when it is needed
+    monkeypatch.setattr(cache, "copy", copy)
+    assert open(cache.get(source), "rb").read() == b"a" * 1000
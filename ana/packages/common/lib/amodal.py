@@ -0,0 +1,142 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Amodal masks - the pixels an object would cover if nothing else were in the scene.
+
+The evaluated mesh triangles of an object are projected into the image of the scene
+camera and rasterized on the CPU with numpy, so no extra render is needed. A pixel is
+covered when its center is inside a triangle; depth is ignored because only coverage
+matters. Triangles with a vertex behind the camera are skipped.
+"""
+import logging
+import bpy
+import numpy
+import ana.packages.common.lib.trace as trace
+
+logger = logging.getLogger(__name__)
+
+# maximum number of pixel tests evaluated at once by the rasterizer
+PIXEL_BUDGET = 1 << 22
+# triangles with a vertex closer to the camera plane than this are skipped
+MIN_W = 1e-6
+
+
+def rasterize_triangles(triangles, width, height):
+    """
+    Rasterize triangles into a boolean coverage mask of shape (height, width).
+    triangles is an array of shape (N, 3, 2) holding pixel coordinates, x to the right and y down.
+    """
+    mask = numpy.zeros((height, width), dtype=bool)
+    triangles = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 2)
+    if len(triangles) == 0:
+        return mask
+
+    xs, ys = triangles[:, :, 0], triangles[:, :, 1]
+    # range of pixels whose centers can be inside the triangle
+    x0 = numpy.maximum(numpy.ceil(xs.min(axis=1) - 0.5), 0).astype(numpy.int64)
+    x1 = numpy.minimum(numpy.floor(xs.max(axis=1) - 0.5), width - 1).astype(numpy.int64)
+    y0 = numpy.maximum(numpy.ceil(ys.min(axis=1) - 0.5), 0).astype(numpy.int64)
+    y1 = numpy.minimum(numpy.floor(ys.max(axis=1) - 0.5), height - 1).astype(numpy.int64)
+    doublearea = (xs[:, 1] - xs[:, 0]) * (ys[:, 2] - ys[:, 0]) - (xs[:, 2] - xs[:, 0]) * (ys[:, 1] - ys[:, 0])
+    keep = (x1 >= x0) & (y1 >= y0) & (doublearea != 0)
+    if not keep.any():
+        return mask
+    triangles, x0, x1, y0, y1 = triangles[keep], x0[keep], x1[keep], y0[keep], y1[keep]
+    orientation = numpy.sign(doublearea[keep])
+
+    # group triangles by the power of two that fits their pixel range so each group is a dense array
+    extent = numpy.maximum(x1 - x0, y1 - y0) + 1
+    buckets = numpy.ceil(numpy.log2(extent)).astype(numpy.int64)
+    for bucket in numpy.unique(buckets):
+        size = 1 << int(bucket)
+        members = numpy.flatnonzero(buckets == bucket)
+        chunk = max(1, PIXEL_BUDGET // (size * size))
+        offsets = numpy.arange(size)
+        for start in range(0, len(members), chunk):
+            idx = members[start:start + chunk]
+            cols = x0[idx, None] + offsets[None, :]  # (n, size)
+            rows = y0[idx, None] + offsets[None, :]
+            px = cols[:, None, :] + 0.5  # (n, 1, size)
+            py = rows[:, :, None] + 0.5  # (n, size, 1)
+            inside = (cols <= x1[idx, None])[:, None, :] & (rows <= y1[idx, None])[:, :, None]
+            tri = triangles[idx]
+            sign = orientation[idx, None, None]
+            for a, b in ((0, 1), (1, 2), (2, 0)):
+                ax, ay = tri[:, a, 0, None, None], tri[:, a, 1, None, None]
+                bx, by = tri[:, b, 0, None, None], tri[:, b, 1, None, None]
+                inside &= sign * ((bx - ax) * (py - ay) - (by - ay) * (px - ax)) >= 0
+            n, r, c = numpy.nonzero(inside)
+            mask[rows[n, r], cols[n, c]] = True
+    return mask
+
+
+def project_mesh_objects(mesh_objects, scene, depsgraph=None):
+    """
+    Project the evaluated triangles of mesh objects into the image of the scene camera.
+    Returns an array of shape (N, 3, 2) with pixel coordinates, x to the right and y down.
+    """
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    render = scene.render
+    width = int(render.resolution_x * render.resolution_percentage / 100)
+    height = int(render.resolution_y * render.resolution_percentage / 100)
+    camera = scene.camera
+    projection = camera.calc_matrix_camera(
+        depsgraph, x=width, y=height, scale_x=render.pixel_aspect_x, scale_y=render.pixel_aspect_y)
+    view = camera.matrix_world.inverted()
+
+    projected = []
+    for mesh_object in mesh_objects:
+        evaluated = mesh_object.evaluated_get(depsgraph)
+        mesh = evaluated.to_mesh()
+        try:
+            mesh.calc_loop_triangles()
+            coords = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float64)
+            mesh.vertices.foreach_get("co", coords)
+            indices = numpy.empty(len(mesh.loop_triangles) * 3, dtype=numpy.int64)
+            mesh.loop_triangles.foreach_get("vertices", indices)
+            matrix = numpy.array(projection @ view @ evaluated.matrix_world)
+        finally:
+            evaluated.to_mesh_clear()
+        if len(indices) == 0:
+            continue
+
+        coords = coords.reshape(-1, 3)
+        clip = coords @ matrix[:3, :3].T + matrix[:3, 3]
+        w = coords @ matrix[3, :3] + matrix[3, 3]
+        triangles = indices.reshape(-1, 3)
+        in_front = (w[triangles] > MIN_W).all(axis=1)
+        triangles = triangles[in_front]
+        w = numpy.where(w > MIN_W, w, 1.0)
+        pixels = numpy.empty((len(coords), 2))
+        pixels[:, 0] = (clip[:, 0] / w + 1.0) * 0.5 * width
+        pixels[:, 1] = (1.0 - (clip[:, 1] / w + 1.0) * 0.5) * height
+        projected.append(pixels[triangles])
+
+    if not projected:
+        return numpy.zeros((0, 3, 2))
+    return numpy.concatenate(projected)
+
+
+@trace.traced(category="annotation")
+def compute_amodal_mask(obj, scene=None):
+    """ Return the boolean amodal mask of an AnaObject in the image of the scene camera """
+    if scene is None:
+        scene = obj.active_scene
+    render = scene.render
+    width = int(render.resolution_x * render.resolution_percentage / 100)
+    height = int(render.resolution_y * render.resolution_percentage / 100)
+    mesh_objects = [mesh_object for mesh_object in obj.mesh_objects if not mesh_object.hide_render]
+    triangles = project_mesh_objects(mesh_objects, scene)
+    return rasterize_triangles(triangles, width, height)
@@ -15,11 +15,17 @@ import sys
 from abc import ABC
 import logging
 import bpy
-from ana.packages.common.lib.search_utils import find_root
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.search_utils import find_root, index_hierarchy
 import ana.packages.common.lib.bbox as annotations
+import ana.packages.common.lib.trace as trace
+from ana.packages.common.lib.load import instance_collection, collection_instance
 
 logger = logging.getLogger(__name__)
 
+# values of "load" in the object configuration of package.yml
+LOAD_MODES = ("append", "link", "instance")
+
 
 class AnaObject(ABC):
     """ Base class for Ana objects """
@@ -47,8 +53,47 @@ class AnaObject(ABC):
         self.ooi = False
         # location of mask file for scene rendered with only this object
         self.solo_mask_id = ''
+        # (row, column) of the top left corner of the solo mask when it was rendered for a border region
+        self.solo_mask_region = None
+        # number of pixels covered by the object if nothing else were in the scene, set when obstruction uses amodal masks
+        self.amodal_pixels = None
         # object specific configuration
         self.config = {}
+        # how the default loader created the collection, one of LOAD_MODES
+        self.load_mode = None
+        # True while the object shares its materials with other instances of the same collection
+        self.shared_materials = False
+        # objects below the root indexed by their path of base names, see index_hierarchy
+        self.object_index = None
+        self._hierarchy = None
+        self._mesh_objects = None
+
+    @property
+    def rng(self):
+        """ Random number generator of this object for the current run, see context.rng """
+        return ctx.rng("object", self.instance)
+
+    @property
+    def hierarchy(self):
+        """ The root and all objects below it, parents before their children """
+        if self._hierarchy is None:
+            self.index_hierarchy()
+        return self._hierarchy
+
+    @property
+    def mesh_objects(self):
+        """ The mesh objects in the hierarchy """
+        if self._mesh_objects is None:
+            self.index_hierarchy()
+        return self._mesh_objects
+
+    def index_hierarchy(self):
+        """
+        Index the object hierarchy so lookups don't walk it. The index is built on first use;
+        call this again after adding or removing objects below the root.
+        """
+        self._hierarchy, self.object_index = index_hierarchy(self.root)
+        self._mesh_objects = [obj for obj in self._hierarchy if obj.type == 'MESH']
 
     def __key(self):
         # the key for hashing and equality comparison
@@ -70,19 +115,46 @@ class AnaObject(ABC):
             - set self.collection = the collection datablock
             - set self.root = the root object datablock
             - set self.loaded = True
+
+        The "load" setting of the object configuration selects how the collection is created:
+            - append (default): copy the objects of the collection appended from the file
+            - link: copy the objects of the collection linked from the file, so the mesh and
+              material data stay read-only library data
+            - instance: a single empty instancing the appended collection is the root. All
+              instances share the collection's objects, so modifiers raise ValueError, masks of
+              two instances of the same collection get the same pass index and annotations
+              that need mesh objects (bounding boxes, amodal masks) are not available.
        """
         if self.loaded:
             # only load the object once
             return
 
         blender_file = kwargs.pop("blender_file")
-        # load the collection
-        with bpy.data.libraries.load(filepath="//" + blender_file, link=False) as (_, dt):
-            dt.collections = [self.object_type]
-        self.collection = dt.collections[0]
-        
-        # link collection to the current scene
-        bpy.context.scene.collection.children.link(self.collection)
+        mode = kwargs.get("config", {}).get("load", "append")
+        if mode not in LOAD_MODES:
+            raise ValueError("Object '{}' has load mode '{}', expected one of {}".format(
+                self.object_type, mode, ", ".join(LOAD_MODES)))
+        self.load_mode = mode
+        with trace.span("load " + self.object_type, "load", blender_file=blender_file, mode=mode):
+            if mode == "instance":
+                # a single empty that instances the cached collection, the root is the empty
+                self.collection = collection_instance(blender_file, self.object_type)
+            elif mode == "link":
+                # copy the objects of the collection linked from the file, mesh and material data stay in the library
+                self.collection = instance_collection(blender_file, self.object_type, link=True)
+                self.shared_materials = True
+            elif kwargs.get("config", {}).get("cache", True):
+                # copy the collection from the asset cache, sharing mesh and material data
+                self.collection = instance_collection(blender_file, self.object_type)
+                self.shared_materials = True
+            else:
+                # load the collection
+                with bpy.data.libraries.load(filepath="//" + blender_file, link=False) as (_, dt):
+                    dt.collections = [self.object_type]
+                self.collection = dt.collections[0]
+
+            # link collection to the current scene
+            bpy.context.scene.collection.children.link(self.collection)
 
         # find the root object
         self.root = find_root(self.collection)
@@ -93,6 +165,27 @@ class AnaObject(ABC):
             self.config = kwargs.pop("config")
 
 
+    def make_materials_unique(self):
+        """
+        Give this object its own copy of each of its materials. Objects loaded from the
+        asset cache share materials with the other instances of the same collection, so
+        this must be called before changing a material of a single instance.
+        """
+        if not self.shared_materials:
+            return
+        copies = {}
+        for obj in self.hierarchy:
+            for slot in obj.material_slots:
+                material = slot.material
+                if material is None:
+                    continue
+                if material not in copies:
+                    copies[material] = material.copy()
+                # link the material to the object so the shared mesh is left unchanged
+                slot.link = 'OBJECT'
+                slot.material = copies[material]
+        self.shared_materials = False
+
     def dump_metadata(self):
         """
         Convert object to a JSON serializable representation.
@@ -139,6 +232,11 @@ class AnaObject(ABC):
             'size':         size,
             'rotation':     rotation,
             'obstruction':  obstruction}
+        segmentation = annotations.get_annotator(self).segmentation
+        if segmentation == "rle":
+            annotation['segmentation'] = annotations.compute_rle(self)
+        elif segmentation == "both":
+            annotation['rle'] = annotations.compute_rle(self)
         return annotation
 
     def find_object(self, qname):
@@ -176,7 +274,13 @@ class AnaObject(ABC):
         "no two children with the same base name" rule
 
         """
-        
+        if self.object_index is None:
+            self.index_hierarchy()
+        obj = self.object_index.get(tuple(qname))
+        if obj is not None:
+            return obj
+
+        # fall back to prefix matching, e.g. for names that differ from the original by more than a suffix
         # start at the root
         obj = self.root
         # find objects below the root
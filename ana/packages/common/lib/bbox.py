@@ -14,34 +14,129 @@
 import bpy, os, bpy_extras, mathutils, numpy, cv2, json, logging, imageio
 import ana.packages.common.lib.context as ctx
 from  ana.packages.common.lib.camera_checks import collect_mesh_objects
+import ana.packages.common.lib.trace as trace
+import ana.packages.common.lib.rle as rle
 
 logger = logging.getLogger(__name__)
 loglevel = logging.getLogger().level
 MIN_FEATURE_SIZE = 2  # Minimum value of 2 - bboxs with boundingRect h=1, have bbox h=0
 
+def read_mask(maskfile):
+    """
+    Read an instance mask. The pixel values are the instance numbers of the objects.
+    Masks written as 32 bit EXR files are rounded to integers.
+    """
+    if maskfile.lower().endswith('.exr'):
+        # OpenCV only decodes EXR files when this is set
+        os.environ.setdefault('OPENCV_IO_ENABLE_OPENEXR', '1')
+        img = cv2.imread(maskfile, cv2.IMREAD_UNCHANGED)
+        if img.ndim == 3:
+            img = img[:, :, 0]
+        return numpy.rint(img).astype(numpy.int32)
+    return imageio.imread(maskfile)
+
+
+def compute_instance_stats(img):
+    """
+    Compute the pixel count and bounding box of every instance in a mask in a single pass.
+    Returns two dictionaries indexed by instance number: the pixel counts and the
+    bounding boxes as [xmin, ymin, xmax, ymax] (inclusive).
+    """
+    ys, xs = numpy.nonzero(img)
+    labels = img[ys, xs]
+    if len(labels) == 0:
+        return {}, {}
+    # group the pixels by instance; the stable sort keeps the row-major order within each group
+    order = numpy.argsort(labels, kind='stable')
+    labels, ys, xs = labels[order], ys[order], xs[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], labels[1:] != labels[:-1])))
+    ends = numpy.concatenate((starts[1:], [len(labels)]))
+    counts = ends - starts
+    xmins = numpy.minimum.reduceat(xs, starts)
+    xmaxs = numpy.maximum.reduceat(xs, starts)
+    ymins = ys[starts]
+    ymaxs = ys[ends - 1]
+    instances = [int(label) for label in labels[starts]]
+    pixel_counts = dict(zip(instances, counts.tolist()))
+    bboxes = {instance: [int(xmin), int(ymin), int(xmax), int(ymax)]
+              for instance, xmin, ymin, xmax, ymax in zip(instances, xmins, ymins, xmaxs, ymaxs)}
+    return pixel_counts, bboxes
+
+
+class MaskAnnotator:
+    """
+    Annotates all instances in a mask from a single read of the mask file.
+    Pixel counts and bounding boxes are computed for every instance at once,
+    contours are only extracted inside the bounding box of each instance.
+    """
+
+    def __init__(self, maskfile, polygon_tolerance=0.0, segmentation="polygon"):
+        if segmentation not in ("polygon", "rle", "both"):
+            raise ValueError("Invalid segmentation format '{}'".format(segmentation))
+        self.maskfile = maskfile
+        self.mtime = os.path.getmtime(maskfile)
+        # maximum distance in pixels between a simplified polygon and the contour, 0 disables simplification
+        self.polygon_tolerance = polygon_tolerance
+        # segmentation written to the annotations: "polygon", "rle" or "both"
+        self.segmentation = segmentation
+        self.img = read_mask(maskfile)
+        self.shape = self.img.shape
+        self.pixel_counts, self.bboxes = compute_instance_stats(self.img)
+
+    def polygons(self, instance):
+        """ Return the polygons and bounding box of an instance, see compute_polygons """
+        if instance not in self.bboxes:
+            return None, None
+        # crop to the bounding box plus a one pixel border so contours are traced as in the full image
+        xmin, ymin, xmax, ymax = self.bboxes[instance]
+        x0, y0 = max(xmin - 1, 0), max(ymin - 1, 0)
+        x1, y1 = min(xmax + 2, self.shape[1]), min(ymax + 2, self.shape[0])
+        roi = numpy.where(self.img[y0:y1, x0:x1] == instance, 255, 0).astype(numpy.uint8)
+        contours, _ = cv2.findContours(roi, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+        if len(contours) == 0:
+            return None, None
+
+        poly = []
+        for c in contours:
+            if self.polygon_tolerance > 0:
+                c = cv2.approxPolyDP(c, self.polygon_tolerance, True)
+            pts = c.reshape(-1).tolist()
+            if len(pts) > 4: poly.append(pts)
+        polyarr = numpy.concatenate([c.reshape(-1, 2) for c in contours]).astype(numpy.int32)
+        if len(polyarr) < 3: return None, None
+        x,y,w,h = cv2.boundingRect(polyarr)
+        if w < MIN_FEATURE_SIZE or h < MIN_FEATURE_SIZE: return None, None
+        bbox = [int(val) for val in [x,y,w-1,h-1]]
+        return poly, bbox
+
+
+# the annotator for the mask that is currently being annotated
+_annotator = None
+
+
+def open_annotator(maskfile, polygon_tolerance=0.0, segmentation="polygon"):
+    """ Read a mask and make it the current mask for the annotation functions """
+    globals()['_annotator'] = MaskAnnotator(maskfile, polygon_tolerance=polygon_tolerance, segmentation=segmentation)
+    return _annotator
+
+
+def close_annotator():
+    """ Release the current mask """
+    globals()['_annotator'] = None
+
+
+def get_annotator(obj):
+    """ Return the annotator for the object's mask, the mask is only read again if it changed """
+    maskfile = obj.mask.replace('#', str(obj.active_scene.frame_current))
+    if _annotator is None or _annotator.maskfile != maskfile or _annotator.mtime != os.path.getmtime(maskfile):
+        return open_annotator(maskfile)
+    return _annotator
+
+
+@trace.traced(category="annotation")
 def compute_polygons(obj):
     """ Generates the polygon from a mask segmentation and bounding box array. """
-    maskfile = obj.mask.replace('#', str(obj.active_scene.frame_current))
-    poly,bbox = [],None
-    img = imageio.imread(maskfile)
-    img = numpy.where(img == obj.instance, 255, 0).astype(numpy.uint8)
-    contours, _ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-    allpts = []
-    for c in contours:
-        a = c.flatten()
-        pts = []
-        for i in a: 
-            pts.append(int(i))
-            allpts.append(i)
-        if len(pts) > 4: poly.append(pts)
-    polyarr = numpy.array(allpts, dtype=numpy.int32)
-    polyarr = polyarr.reshape(int(len(polyarr)/2), 2)
-    if len(polyarr) < 3: return None, None
-    x,y,w,h = cv2.boundingRect(polyarr)
-    if w < MIN_FEATURE_SIZE or h < MIN_FEATURE_SIZE: poly,bbox = None,None
-    else: 
-        bbox = [int(val) for val in [x,y,w-1,h-1]]
-    return poly, bbox
+    return get_annotator(obj).polygons(obj.instance)
 
 def total_bound_box(obj):
     #returns a bound box for object and all it's children
@@ -70,6 +165,7 @@ def total_bound_box(obj):
 
 
 
+@trace.traced(category="annotation")
 def compute_bbox3d(obj):
     blendobj = obj.root
     if blendobj.type in ['EMPTY', 'ARMATURE']: blendobj = blendobj.children[0]
@@ -83,6 +179,7 @@ def compute_bbox3d(obj):
     return [val for val in bbox3d]
 
 
+@trace.traced(category="annotation")
 def compute_centroid(obj):
     blendobj = obj.root
     if blendobj.type in ['EMPTY', 'ARMATURE']: blendobj = blendobj.children[0]
@@ -94,35 +191,26 @@ def compute_centroid(obj):
     return [y,x], camcoord[2]
 
 
+@trace.traced(category="annotation")
 def compute_rle(obj):
-    maskfile = obj.mask.replace('#', str(obj.active_scene.frame_current))
-    img = imageio.imread(maskfile)
-    rle = { 'size':img.shape, 'counts':[] }
-    count = 1
-    prev = [0,0,0]
-    for y in range(img.shape[0]):
-        for x in range(img.shape[1]):
-            if not (img[y,x] == prev).all():
-                rle['counts'].append(count)
-                prev = img[y,x]
-                count = 1
-            else: count += 1
-    return rle
+    """ Run-length encode the object's mask in the uncompressed COCO format. """
+    return rle.encode(get_annotator(obj).img == obj.instance)
 
 
+@trace.traced(category="annotation")
 def truncated(obj, bbox):
     if bbox is None:
         return
     x, y, w, h = bbox
     if x == 0 or y == 0:
         return True
-    maskfile = obj.mask.replace('#', str(obj.active_scene.frame_current))
-    img = imageio.imread(maskfile)
-    if x+w+1 == img.shape[0] or y+h+1 == img.shape[1]:
+    shape = get_annotator(obj).shape
+    if x+w+1 == shape[0] or y+h+1 == shape[1]:
         return True
     return False
 
 
+@trace.traced(category="annotation")
 def compute_size(obj):
     """ Return x,y,z or length, width, depth. """
     return [c for c in obj.root.dimensions]
@@ -152,6 +240,7 @@ def euler_from_quaternion(x, y, z, w):
     return [roll_x, pitch_y, yaw_z]  # in radians
 
 
+@trace.traced(category="annotation")
 def compute_rotation(obj):
     """ Return Euler angles: roll, pitch, and yaw. """
     loc, rot, scale = obj.root.matrix_world.decompose()
@@ -169,25 +258,54 @@ def compute_rotation(obj):
     return roll, pitch, yaw
 
 
+def read_solo_mask(obj):
+    """
+    Read the mask rendered with only this object in the scene, in full frame coordinates.
+    Returns None if no solo mask was rendered for the object.
+    """
+    if not obj.solo_mask_id:
+        return None
+    maskfilebase, maskext = obj.mask.replace('#', str(obj.active_scene.frame_current)).rsplit('.', 1)
+    soloimg = read_mask('{}-{}.{}'.format(maskfilebase, obj.solo_mask_id, maskext))
+
+    region = getattr(obj, 'solo_mask_region', None)
+    if region is None:
+        return soloimg
+    # the solo mask was cropped to a border region, place it back in the full frame
+    row, col = region
+    shape = get_annotator(obj).shape
+    fullimg = numpy.zeros(shape[:2] + soloimg.shape[2:], dtype=soloimg.dtype)
+    h = min(soloimg.shape[0], shape[0] - row)
+    w = min(soloimg.shape[1], shape[1] - col)
+    fullimg[row:row + h, col:col + w] = soloimg[:h, :w]
+    return fullimg
+
+
+@trace.traced(category="annotation")
 def compute_obstruction(obj):
     """Estimate the amount of an object's mask is hidden from view of the camera. 0 - full view; 1 - out of view. """
-    maskfilebase, maskext = obj.mask.replace('#', str(obj.active_scene.frame_current)).rsplit('.', 1)
-    solomaskfile = '{}-{}.{}'.format(maskfilebase, obj.solo_mask_id, maskext)
+    compcount = get_annotator(obj).pixel_counts.get(obj.instance, 0)
 
-    if obj.solo_mask_id:
-        soloimg = imageio.imread(solomaskfile)
-    else:
+    amodal_pixels = getattr(obj, 'amodal_pixels', None)
+    if amodal_pixels is not None:
+        if amodal_pixels == 0:
+            return None  # unknown - the mesh does not cover a pixel center
+        # the rasterized mesh can differ from the render by a few pixels along its edges
+        return max(0.0, 1.0 - compcount / amodal_pixels)
+
+    soloimg = read_solo_mask(obj)
+    if soloimg is None:
         # print('Object {} has no mask'.format(obj.instance))
         return None  # unknown - object could be outside image boundary
 
-    compositemaskfile = obj.mask.replace('#', str(obj.active_scene.frame_current))
-    compimg = imageio.imread(compositemaskfile)
-    compmask = numpy.nonzero(compimg == obj.instance)[0]
-
-    solononzero = soloimg[numpy.nonzero(soloimg)]
-    pix_id = numpy.unique(solononzero)[1]  # the second entry is the first entry + obj.instance
-    solomask = numpy.nonzero(soloimg == pix_id)[0]
+    if getattr(obj, 'mask_mode', 'compositor') == 'index':
+        # the solo render only contains this object's index
+        solomask = numpy.nonzero(soloimg == obj.instance)[0]
+    else:
+        solononzero = soloimg[numpy.nonzero(soloimg)]
+        pix_id = numpy.unique(solononzero)[1]  # the second entry is the first entry + obj.instance
+        solomask = numpy.nonzero(soloimg == pix_id)[0]
 
-    obstruction = 1.0 - len(compmask) / len(solomask)
+    obstruction = 1.0 - compcount / len(solomask)
 
     return obstruction
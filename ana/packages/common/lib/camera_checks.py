@@ -11,6 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import numpy
+
+# pairs of bound_box corners joined by an edge
+BOX_EDGES = ((0, 1), (0, 3), (0, 4), (1, 2),
+             (1, 5), (2, 3), (2, 6), (3, 7),
+             (4, 5), (4, 7), (5, 6), (6, 7))
+
+
 def camera_as_planes(scene, obj):
     """
     Return planes in world-space which represent the camera view bounds.
@@ -106,11 +114,8 @@ def object_in_planes(obj, planes):
             return True
 
     # possible one of our edges intersects
-    edges = ((0, 1), (0, 3), (0, 4), (1, 2),
-             (1, 5), (2, 3), (2, 6), (3, 7),
-             (4, 5), (4, 7), (5, 6), (6, 7))
     if any(is_segment_in_planes(box[e[0]], box[e[1]], planes)
-           for e in edges):
+           for e in BOX_EDGES):
         return True
 
 
@@ -130,24 +135,120 @@ def objects_in_camera(objects,camera):
     scene = context.scene
     origin = camera.matrix_world.to_translation()
     planes = camera_as_planes(scene, camera)
-    objects_in_view = []
-    for obj in objects:
-        meshes_objects = collect_mesh_objects(obj)
-        if len(objects_in_planes(meshes_objects, planes, origin)) is not 0:
-            objects_in_view.append(obj) #Some part of this object is visible
+    in_view = objects_in_view_mask(objects, planes, origin)
+    return [obj for obj, visible in zip(objects, in_view) if visible] #Some part of these objects is visible
+
+
+def objects_in_view_mask(objects, planes, origin):
+    """
+    Return a boolean array that is True for each object with some mesh (even partially) inside all planes.
+    Objects are blender objects or AnaObjects, the mesh objects below all objects are tested in a single batch.
+    Objects without mesh objects, e.g. collection instances, can't be tested and are reported in view.
+    """
+    mesh_objects = []
+    owners = []
+    in_view = numpy.zeros(len(objects), dtype=bool)
+    for i, obj in enumerate(objects):
+        meshes = mesh_objects_of(obj)
+        if not meshes:
+            in_view[i] = True
+        mesh_objects.extend(meshes)
+        owners.extend([i] * len(meshes))
+    if mesh_objects:
+        in_view[numpy.array(owners)[mesh_objects_in_planes(mesh_objects, planes, origin)]] = True
+    return in_view
+
+
+def mesh_objects_in_planes(objects, planes, origin):
+    """
+    Vectorized objects_in_planes - return a boolean array that is True for each object
+    which is inside (even partially) all planes.
+    """
+    corners = numpy.array([[tuple(v) for v in obj.bound_box] for obj in objects], dtype=numpy.float64).reshape(-1, 8, 3)
+    matrices = numpy.array([numpy.array(obj.matrix_world) for obj in objects], dtype=numpy.float64).reshape(-1, 4, 4)
+    normals = numpy.array([tuple(p[0]) for p in planes], dtype=numpy.float64).reshape(-1, 3)
+    offsets = numpy.array([p[1] for p in planes], dtype=numpy.float64)
+    return boxes_in_planes(corners, matrices, normals, offsets, numpy.array(tuple(origin), dtype=numpy.float64))
+
+
+def boxes_in_planes(corners, matrices, normals, offsets, origin):
+    """
+    Test N bounding boxes against P planes at once.
+    corners (N,8,3) are in local coordinates and matrices (N,4,4) map them to world space.
+    Planes are normals (P,3) and offsets (P,), a point v is inside a plane when normal.v + offset > 0.
+    A box is in the planes if the origin is inside it, one of its corners is inside all
+    planes or one of its edges crosses the volume bounded by the planes.
+    """
+    box = corners @ matrices[:, :3, :3].transpose(0, 2, 1) + matrices[:, None, :3, 3]
+    side = box @ normals.T + offsets  # (N,8,P)
+
+    # origin inside the local bounding box
+    inverse = numpy.linalg.inv(matrices)
+    local_origin = numpy.einsum('nij,j->ni', inverse[:, :3, :3], origin) + inverse[:, :3, 3]
+    in_box = ((corners.min(axis=1) <= local_origin) & (local_origin <= corners.max(axis=1))).all(axis=1)
+
+    # one point in all planes
+    corner_in = (side > 0.0).all(axis=2).any(axis=1)
+
+    # one of the edges intersects, see is_segment_in_planes
+    edges = numpy.array(BOX_EDGES)
+    t = -side[:, edges[:, 0]]  # (N,12,P)
+    div = side[:, edges[:, 1]] - side[:, edges[:, 0]]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        fac = t / div
+    lower = div > 0.0
+    upper = div < 0.0
+    rejected = ((lower & (t >= div)) | (upper & (t > 0.0))).any(axis=2)
+    p1_fac = numpy.where(lower & (t > 0.0), fac, 0.0).max(axis=2)
+    p2_fac = numpy.where(upper & (t > div), fac, 1.0).min(axis=2)
+    edge_in = (~rejected & (p1_fac <= p2_fac)).any(axis=1)
+
+    return in_box | corner_in | edge_in
+
+
+def cull_objects_outside_camera(objects, camera):
+    """
+    Hide the objects that are completely outside the view of the camera from the render
+    and return them. Hidden objects no longer cast shadows or show up in reflections.
+    """
+    from bpy import context
+    scene = context.scene
+    origin = camera.matrix_world.to_translation()
+    planes = camera_as_planes(scene, camera)
+    in_view = objects_in_view_mask(objects, planes, origin)
+    culled = [obj for obj, visible in zip(objects, in_view) if not visible]
+    for obj in culled:
+        for item in hierarchy_of(obj):
+            item.hide_render = True
+    return culled
+
+
+def mesh_objects_of(obj):
+    """ The mesh objects at and below a blender object, or in the hierarchy index of an AnaObject """
+    mesh_objects = getattr(obj, "mesh_objects", None)
+    return mesh_objects if mesh_objects is not None else collect_mesh_objects(obj)
+
+
+def hierarchy_of(obj):
+    """ A blender object and all objects below it, or the hierarchy index of an AnaObject """
+    hierarchy = getattr(obj, "hierarchy", None)
+    if hierarchy is not None:
+        return hierarchy
+    hierarchy = [obj]
+    for item in hierarchy:
+        hierarchy.extend(item.children)
+    return hierarchy
 
-    return objects_in_view
 
 def collect_mesh_objects(obj):
-    object_array=[]
-    if obj.type=='MESH': object_array.append(obj)
-    # print("checking", obj.name)
-    # print(len(obj.children), "children found.")
-    for child in obj.children:
-        collection = collect_mesh_objects(child)
-        if len(collection) is not 0:
-            for item in collection:
-                object_array.append(item)
+    object_array = []
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if item.type == 'MESH':
+            object_array.append(item)
+        # push children in reverse so they are visited in order
+        stack.extend(reversed(item.children))
     return object_array
 
 #    for obj in objects_in_view:
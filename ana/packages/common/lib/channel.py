@@ -11,15 +11,140 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import sys
 import os
+import copy
+import hashlib
 import logging
 import importlib
 import importlib.util
+import json
+import tempfile
 import yaml
+from ana.packages.common.lib.exceptions import ChannelError
+from ana.packages.common.lib.node import NodeRegistry
 
 logger = logging.getLogger(__name__)
 
+# use the C YAML parser when it is available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# bump when the cached data changes
+CACHE_VERSION = 2
+# bump when the format of assets.json changes
+ASSETS_VERSION = 1
+
+
+def load_yaml(path):
+    """ Parse a YAML file """
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
+
+def file_hash(path):
+    """ Return the sha256 of a file """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def channel_cache_file(base_dir, channel_name):
+    """
+    Return the path of the cache file for a channel, or None if caching is disabled.
+    The cache directory is ANA_CACHE_DIR and defaults to ana in the user's cache directory,
+    set ANA_CACHE_DIR to an empty string to disable the cache.
+    """
+    default_dir = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ana")
+    cache_dir = os.environ.get("ANA_CACHE_DIR", default_dir)
+    if not cache_dir:
+        return None
+    key = hashlib.sha256(os.path.abspath(base_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "channel-{}-{}.json".format(channel_name, key))
+
+
+def private_path(path):
+    """ Return True if a path is owned by the current user and no one else can write to it """
+    stat = os.stat(path)
+    if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+        return False
+    return not stat.st_mode & 0o022
+
+
+def load_channel_cache(cache_file):
+    """ Return the cached channel configuration, or None if it is missing or any source file changed """
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    try:
+        # don't trust a cache another user could have written
+        if not private_path(os.path.dirname(cache_file)) or not private_path(cache_file):
+            logger.warning("Ignoring channel cache '%s' - it is not private to this user", cache_file)
+            return None
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+        if cache["version"] != CACHE_VERSION:
+            return None
+        for path, mtime, size, sha in cache["files"]:
+            stat = os.stat(path)
+            if stat.st_mtime_ns == mtime and stat.st_size == size:
+                continue
+            # a touched file is still valid if its contents are the same
+            if stat.st_size != size or file_hash(path) != sha:
+                return None
+        return cache["channel"]
+    except Exception as e:
+        logger.info("Ignoring channel cache '%s': %s", cache_file, e)
+        return None
+
+
+def save_channel_cache(cache_file, files, channel):
+    """ Save the channel configuration along with the state of the files it was parsed from """
+    if cache_file is None:
+        return
+    try:
+        cache = {
+            "version": CACHE_VERSION,
+            "files": [[path, os.stat(path).st_mtime_ns, os.stat(path).st_size, file_hash(path)] for path in files],
+            "channel": list(channel)}
+        # YAML values JSON can't hold exactly, e.g. dates or integer keys, would change when read back
+        data = json.dumps(cache)
+        if json.loads(data) != cache:
+            logger.info("Not caching channel configuration, it can't be stored as JSON")
+            return
+        cache_dir = os.path.dirname(cache_file)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if not private_path(cache_dir):
+            logger.warning("Not writing channel cache, '%s' is not private to this user", cache_dir)
+            return
+        # write to a temporary file first so concurrent readers never see a partial cache
+        fd, tmpfile = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmpfile, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        logger.info("Can't write channel cache '%s': %s", cache_file, e)
+
+
+def load_assets(base_dir, packages):
+    """
+    Load the asset index of each package, written by scripts/index_assets.py to
+    packages/<package>/config/assets.json. Packages without a current index are left out.
+    """
+    assets = {}
+    for package_name in packages:
+        assets_file = os.path.join(base_dir, "packages", package_name, "config", "assets.json")
+        if not os.path.isfile(assets_file):
+            continue
+        try:
+            with open(assets_file, "r") as f:
+                manifest = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring asset index '%s' - error parsing file", assets_file)
+            continue
+        if manifest.get("version") != ASSETS_VERSION:
+            logger.warning("Ignoring asset index '%s' - rerun scripts/index_assets.py", assets_file)
+            continue
+        assets[package_name] = manifest
+    return assets
+
+
 class Channel:
     """ Channel class """
     def __init__(self, root_dir, base_dir, channel_name):
@@ -28,20 +153,37 @@ class Channel:
         self.channel_config_file = os.path.join(base_dir, "channels", channel_name, "config", "channel.yml")
         self.deckard_config_file = os.path.join(base_dir, "channels", channel_name, "config", "deckard.yml")
 
+        # load the resolved configuration from the cache when none of the files have changed
+        cache_file = channel_cache_file(base_dir, channel_name)
+        cached = load_channel_cache(cache_file)
+        if cached is not None:
+            self.classes, self.schemas, self.packages, self.package_config_files = cached
+        else:
+            files = self.parse(root_dir, base_dir)
+            save_channel_cache(
+                cache_file, files, (self.classes, self.schemas, self.packages, self.package_config_files))
+
+        # node classes and compiled schemas
+        self.registry = NodeRegistry(self.classes, self.schemas)
+
+        # asset index of the packages, see get_asset_info
+        self.assets = load_assets(base_dir, self.packages)
+
+    def parse(self, root_dir, base_dir):
+        """ Parse the channel, schema and package files, return the list of files that were read """
         # read channel configuration
         try:
-            with open(self.channel_config_file, "r") as f:
-                channel_config = yaml.safe_load(f)
+            channel_config = load_yaml(self.channel_config_file)
         except FileNotFoundError:
-            logger.critical("Channel configuration error - 'channel.yml' file not found")
-            sys.exit(1)
-        except yaml.scanner.ScannerError:
-            logger.critical("Channel configuration error - error parsing file 'channel.yml'")
-            sys.exit(1)
+            raise ChannelError("Channel configuration error - 'channel.yml' file not found")
+        except yaml.YAMLError:
+            raise ChannelError("Channel configuration error - error parsing file 'channel.yml'")
+        files = [self.channel_config_file]
 
         # load class definitions and schemas
         self.classes = {}
         self.schemas = {}
+        schema_modules = {}
         package_names = []
         for alias, channel_node_def in channel_config["nodes"].items():
             module = channel_node_def["module"]
@@ -54,15 +196,16 @@ class Channel:
 
             schema_file = os.path.abspath(os.path.join(root_dir, *module.split(".")) + ".yml")
             
-            # load the original schema
+            # load the original schema, each schema file is parsed once
             try:
-                with open(schema_file, "r") as f:
-                    schema_module = yaml.safe_load(f)
-                    schema = schema_module["schemas"][klass]
-                    modified_schema = schema.copy()
-            except yaml.scanner.ScannerError:
-                logger.critical("Schema error for class '%s' - YAML scanner error", klass)
-                sys.exit(1)
+                if schema_file not in schema_modules:
+                    schema_modules[schema_file] = load_yaml(schema_file)
+                    files.append(schema_file)
+                schema = schema_modules[schema_file]["schemas"][klass]
+                # copy so overrides don't change the schema shared with other aliases
+                modified_schema = copy.deepcopy(schema)
+            except yaml.YAMLError:
+                raise ChannelError("Schema error for class '{}' - YAML scanner error".format(klass))
 
             # override node inputs
             if channel_node_def.get("inputs") is not None:
@@ -76,8 +219,7 @@ class Channel:
                             found = True
                             break
                     if not found:
-                        logging.error("Input port '%s' not found in schema file '%s'", port, schema_file)
-                        sys.exit(1)
+                        raise ChannelError("Input port '{}' not found in schema file '{}'".format(port, schema_file))
             
             # override node outputs
             if channel_node_def.get("outputs") is not None:
@@ -91,14 +233,13 @@ class Channel:
                             found = True
                             break
                     if not found:
-                        logging.error("Output port '%s' not found in schema file '%s'", port, schema_file)
-                        sys.exit(1)
+                        raise ChannelError("Output port '{}' not found in schema file '{}'".format(port, schema_file))
 
             # save updated schema
             self.schemas[alias] = modified_schema
 
         # get unique package names
-        package_names = list(set(package_names))
+        package_names = sorted(set(package_names))
 
         # load package configurations and merge overrides
         self.packages = {}
@@ -106,17 +247,17 @@ class Channel:
         for package_name in package_names:
             try:
                 self.package_config_files[package_name] = os.path.join(base_dir, "packages", package_name, "config", "package.yml")
-                with open(self.package_config_files[package_name], "r") as f:
-                    self.packages[package_name] = yaml.safe_load(f)
-                    if channel_config.get("packages") is not None and channel_config["packages"].get(package_name) is not None:
-                        for key, value in channel_config["packages"][package_name].items():
-                            self.packages[package_name][key] = value
+                self.packages[package_name] = load_yaml(self.package_config_files[package_name])
+                files.append(self.package_config_files[package_name])
+                if channel_config.get("packages") is not None and channel_config["packages"].get(package_name) is not None:
+                    for key, value in channel_config["packages"][package_name].items():
+                        self.packages[package_name][key] = value
             except FileNotFoundError:
-                logger.critical("Package configuration error - 'package.yml' file not found for package '%s'", package_name)
-                sys.exit(1)
-            except yaml.scanner.ScannerError:
-                logger.critical("Package configuration error - error parsing file 'package.yml' for package '%s'", package_name)
-                sys.exit(1)
+                raise ChannelError("Package configuration error - 'package.yml' file not found for package '{}'".format(package_name))
+            except yaml.YAMLError:
+                raise ChannelError("Package configuration error - error parsing file 'package.yml' for package '{}'".format(package_name))
+
+        return files
 
     def setup(self):
         """ Load and execute the channel-specific setup function """
@@ -131,3 +272,20 @@ class Channel:
         if importlib.util.find_spec(module):
             post_process = getattr(importlib.import_module(module), "post_process")
             post_process()
+
+    def reset(self):
+        """ Reset Blender and the object counters between runs in the same process """
+        # note: these are imported here so the channel can be loaded outside of Blender
+        # pylint: disable=import-outside-toplevel
+        import bpy
+        from ana.packages.common.lib.ana_object import AnaObject
+        from ana.packages.common.lib.generator import Generator
+        from ana.packages.common.lib.load import clear_collection_cache
+
+        # reload the startup file; setup() renames the scene and configures devices again
+        bpy.ops.wm.read_homefile(use_empty=False)
+        clear_collection_cache()
+
+        # instance numbers are used as pass indices and annotation ids, so restart them
+        AnaObject.next_instance = 1
+        Generator.reset()
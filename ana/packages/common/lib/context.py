@@ -14,7 +14,12 @@
 import os
 import logging
 import time
+import hashlib
+import threading
+import contextlib
+import numpy
 from numpy.random import RandomState
+import ana.packages.common.lib.trace as trace
 
 initialized = False
 channel = None
@@ -25,6 +30,21 @@ output = None
 data = None
 random = None
 packages = None
+# number of threads for nodes that don't need the main thread, 0 runs every node on the main thread
+node_threads = 0
+# files written to the output directory by the current run, see add_output
+outputs = []
+# local cache of data volume files, see volume_cache.VolumeCache
+volume_cache = None
+# copy the files of the graph's packages to the volume cache while the nodes execute
+prefetch = False
+# random number streams for the current run, indexed by key
+streams = {}
+# number of stream keys handed out for the current run, indexed by (node, purpose)
+stream_counts = {}
+stream_lock = threading.Lock()
+# the node executing in the current thread
+scope = threading.local()
 
 # HACK: need more robust pathing
 # directory containing ana - assumes this module is in ana/ana/packages/common/lib
@@ -33,20 +53,20 @@ BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file_
 ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, ".."))
 
 # pylint: disable=redefined-outer-name
-def initialize(channel_name, seed=None, interp_num=0, preview=False, output="./output", data="./data", loglevel="ERROR", logfile=None):
+def initialize(channel_name, seed=None, interp_num=0, preview=False, output="./output", data="./data", loglevel="ERROR", logfile=None, node_threads=0, cache_dir=None, cache_size=10240, prefetch=False):
     """ Initialize Ana configuration """
 
     # note: this is imported here to avoid a circular import at the module level
     # pylint: disable=import-outside-toplevel
     from ana.packages.common.lib.channel import Channel
-    globals()['channel'] = Channel(ROOT_DIR, BASE_DIR, channel_name)
+    with trace.span("channel", channel=channel_name):
+        globals()['channel'] = Channel(ROOT_DIR, BASE_DIR, channel_name)
 
     if seed is None:
         globals()['seed'] = int(str(int(time.time()*1e7))[-9:])
     else:
         globals()['seed'] = seed
 
-    globals()['interp_num'] = interp_num
     globals()['preview'] = preview
 
     # create output directory if it doesn't already exist
@@ -58,8 +78,17 @@ def initialize(channel_name, seed=None, interp_num=0, preview=False, output="./o
     # set the data directory
     globals()['data'] = data
 
-    # use this for repeatable random distributions, e.g. self.ctx.ana_random.uniform(0,1)
-    globals()['random'] = RandomState(globals()['seed'] + interp_num)
+    # run pure Python nodes in a thread pool
+    globals()['node_threads'] = node_threads
+
+    # copy volume files to a local cache of cache_size MB
+    if cache_dir is not None:
+        from ana.packages.common.lib.volume_cache import VolumeCache
+        globals()['volume_cache'] = VolumeCache(cache_dir, cache_size * 2**20)
+    globals()['prefetch'] = prefetch
+
+    # set the run number and the random state for the run
+    reset(interp_num)
 
     # make package configurations available to all nodes
     globals()['packages'] = channel.packages
@@ -86,3 +115,83 @@ def initialize(channel_name, seed=None, interp_num=0, preview=False, output="./o
     rootLogger.addHandler(consoleHandler)
 
     globals()['initialized'] = True
+
+
+def reset(interp_num, seed=None, preview=None, output=None):
+    """
+    Reset the per-run configuration so the next graph run is repeatable on its own.
+    The seed, preview and output settings are only changed when they are given.
+    """
+    if seed is not None:
+        globals()['seed'] = seed
+    if preview is not None:
+        globals()['preview'] = preview
+    if output is not None:
+        if not os.path.exists(output):
+            os.makedirs(output)
+        globals()['output'] = output
+    globals()['interp_num'] = interp_num
+
+    # use this for repeatable random distributions, e.g. self.ctx.ana_random.uniform(0,1)
+    globals()['random'] = RandomState(globals()['seed'] + interp_num)
+
+    # independent random streams start over for each run
+    with stream_lock:
+        streams.clear()
+        stream_counts.clear()
+        outputs.clear()
+
+
+def add_output(path):
+    """
+    Record a file written to the output directory by the current run. Nodes that write
+    their own files call this so the daemon can report them without scanning the directory.
+    """
+    with stream_lock:
+        outputs.append(path)
+
+
+def rng(*keys):
+    """
+    Return an independent random number generator (numpy.random.Generator) for the current run.
+    The stream only depends on the seed, interp_num and keys, e.g. rng("node", name, "camera"),
+    so draws made elsewhere don't change it. The same keys return the same generator for the
+    rest of the run.
+    """
+    key = tuple(str(k) for k in keys)
+    with stream_lock:
+        generator = streams.get(key)
+        if generator is None:
+            digest = hashlib.sha256("\x1f".join(key).encode()).digest()
+            entropy = [globals()['seed'], globals()['interp_num'], int.from_bytes(digest[:16], "little")]
+            generator = numpy.random.Generator(numpy.random.PCG64(numpy.random.SeedSequence(entropy)))
+            streams[key] = generator
+    return generator
+
+
+def current_node():
+    """ Return the name of the node executing in this thread, None outside of node execution """
+    return getattr(scope, "node", None)
+
+
+@contextlib.contextmanager
+def node_scope(name):
+    """ Mark the node executing in this thread """
+    previous = current_node()
+    scope.node = name
+    try:
+        yield
+    finally:
+        scope.node = previous
+
+
+def stream_key(purpose):
+    """
+    Return a new stream key for the current node, e.g. for each generator it creates.
+    Keys are numbered in creation order within the node so they repeat from run to run.
+    """
+    node = current_node()
+    with stream_lock:
+        count = stream_counts.get((node, purpose), 0)
+        stream_counts[(node, purpose)] = count + 1
+    return ("node", node, purpose, count)
@@ -0,0 +1,134 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Daemon mode - keep a Blender process with the channel loaded and serve graph jobs over a Unix socket.
+
+Each request is a single line of JSON and gets a single line of JSON in reply. A job looks like
+    {"graph": "example_test", "interp_num": 3, "seed": 42, "preview": true, "output": "./output"}
+where graph is a graph file or the graph itself and the other keys are optional. The reply has the
+status ("ok" or "failed"), the files the job wrote to the output directory, the timings in seconds and
+the error message of a failed job. Settings missing from a job are taken from the command line. Send {"command": "shutdown"} to stop the daemon.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.interp import load_graph, run
+
+logger = logging.getLogger(__name__)
+
+
+def import_nodes():
+    """ Import the modules of all nodes in the channel so the first job doesn't pay for it """
+    for alias in ctx.channel.classes:
+        try:
+            ctx.channel.registry.node_class(alias)
+        except Exception as e:
+            logger.warning("Can't import module for node '%s': %s", alias, e)
+
+
+def list_outputs():
+    """ Return the files recorded with ctx.add_output by the current job that exist """
+    return sorted({path for path in ctx.outputs if os.path.isfile(path)})
+
+
+def run_job(job, reset_channel, defaults):
+    """ Run a single graph job and return the reply, settings missing from the job are taken from defaults """
+    starttime = time.time()
+    reply = {"status": "ok", "interp_num": job.get("interp_num", 0)}
+    # a job that fails before the run starts must not report the files of the previous job
+    ctx.outputs.clear()
+    try:
+        graph = job["graph"]
+        if not isinstance(graph, dict):
+            graph = load_graph(graph, ctx.channel.name)
+        loadtime = time.time()
+        run(graph, reply["interp_num"], reset_channel=reset_channel,
+            seed=job.get("seed", defaults["seed"]),
+            preview=job.get("preview", defaults["preview"]),
+            output=job.get("output", defaults["output"]))
+        runtime = time.time()
+    except Exception as e:
+        logger.error("An exception of type %s occurred while running job", type(e).__name__, exc_info=e)
+        reply["status"] = "failed"
+        reply["error"] = "{}: {}".format(type(e).__name__, e)
+        loadtime = runtime = time.time()
+    reply["outputs"] = list_outputs()
+    reply["timings"] = {
+        "load": loadtime - starttime,
+        "run": runtime - loadtime,
+        "total": time.time() - starttime}
+    return reply
+
+
+def serve(socket_path):
+    """ Serve graph jobs on a Unix socket until a shutdown request is received """
+    import_nodes()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    logger.info("Serving jobs on %s", socket_path)
+    print('Daemon listening on {}'.format(socket_path), flush=True)
+
+    # settings from the command line are used when a job doesn't give them
+    defaults = {"seed": ctx.seed, "preview": ctx.preview, "output": ctx.output}
+    # the blender scene is clean until the first job runs
+    reset_channel = False
+    shutdown = False
+    try:
+        while not shutdown:
+            connection, _ = server.accept()
+            try:
+                with connection, connection.makefile("rw") as stream:
+                    for line in stream:
+                        if not line.strip():
+                            continue
+                        try:
+                            job = json.loads(line)
+                        except ValueError as e:
+                            reply = {"status": "failed", "error": "Invalid job: {}".format(e)}
+                        else:
+                            if not isinstance(job, dict):
+                                reply = {"status": "failed", "error": "Invalid job: expected a JSON object, got {}".format(
+                                    type(job).__name__)}
+                            elif job.get("command") == "shutdown":
+                                shutdown = True
+                                reply = {"status": "ok"}
+                            else:
+                                reply = run_job(job, reset_channel, defaults)
+                                reset_channel = True
+                        stream.write(json.dumps(reply) + "\n")
+                        stream.flush()
+                        if shutdown:
+                            break
+            except (OSError, UnicodeDecodeError) as e:
+                # a client that goes away or sends garbage only ends its own connection
+                logger.warning("Closed connection to client: %s", e)
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def request(socket_path, job):
+    """ Send a job to a daemon and wait for the reply - this does not need Blender """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile("rw") as stream:
+            stream.write(json.dumps(job) + "\n")
+            stream.flush()
+            return json.loads(stream.readline())
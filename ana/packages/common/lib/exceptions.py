@@ -0,0 +1,29 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Exceptions raised by the Ana interpreter. These are raised instead of exiting the
+process so a batch of runs can record a failure and continue with the next run.
+"""
+
+
+class AnaError(Exception):
+    """ Base class for Ana errors """
+
+
+class ChannelError(AnaError):
+    """ The channel or package configuration is invalid """
+
+
+class GraphError(AnaError):
+    """ The graph is invalid or could not be interpreted """
@@ -15,10 +15,15 @@ from abc import ABC, abstractmethod
 import json
 import os
 import copy
+import functools
+import importlib
+import threading
+import weakref
 import numpy as np
 import ana
 import ana.packages.common.lib.context as ctx
 from ana.packages.common.lib.ana_object import AnaObject
+import ana.packages.common.lib.generator_dag as generator_dag
 
 def get_blendfile_generator(package, object_class, object_type):
     """
@@ -34,48 +39,188 @@ def get_blendfile_generator(package, object_class, object_type):
         config=ctx.packages[package]["objects"][object_type])
     return generator
 
+def build_alias_table(weights):
+    """
+    Build an alias table (Vose's method) for sampling indices in proportion to weights.
+    Returns (prob, alias): pick a column i uniformly, keep it with probability prob[i]
+    and otherwise take alias[i].
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    if n == 0 or weights.sum() <= 0:
+        raise ValueError("Can't select from generators without positive weights")
+    scaled = weights * n / weights.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # whatever is left has probability 1 up to rounding
+    return prob, alias
+
+def _invalidates(method):
+    """ Wrap a list method so calling it drops the alias table of the generator owning the list """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        owner = self.owner()
+        if owner is not None:
+            owner._children_changed()
+        return result
+    return wrapper
+
+class ChildList(list):
+    """
+    The children of a generator. Changing the list in place rebuilds the alias table
+    of the generator on the next selection.
+    """
+    def __init__(self, owner, children=()):
+        super().__init__(children)
+        self.owner = weakref.ref(owner)
+
+    append = _invalidates(list.append)
+    extend = _invalidates(list.extend)
+    insert = _invalidates(list.insert)
+    remove = _invalidates(list.remove)
+    pop = _invalidates(list.pop)
+    clear = _invalidates(list.clear)
+    sort = _invalidates(list.sort)
+    reverse = _invalidates(list.reverse)
+    __setitem__ = _invalidates(list.__setitem__)
+    __delitem__ = _invalidates(list.__delitem__)
+    __iadd__ = _invalidates(list.__iadd__)
+    __imul__ = _invalidates(list.__imul__)
+
 class Generator(ABC):
     """
     Base class for generators and modifiers
     """
     next_id = 0
-    # all generators indexed by id
-    generators = {}
+    # all live generators indexed by id, a generator is dropped once nothing else refers to it
+    generators = weakref.WeakValueDictionary()
+    # generators can be created by nodes running in a thread pool
+    id_lock = threading.Lock()
+    # guards the parent sets, a generator can be a child of generators created in different threads
+    parents_lock = threading.Lock()
     def __init__(self, children=None, **kwargs):
-        self.id = Generator.next_id
-        Generator.generators[self.id] = self
-        Generator.next_id += 1
+        with Generator.id_lock:
+            self.id = Generator.next_id
+            Generator.generators[self.id] = self
+            Generator.next_id += 1
+        # generators that have this one as a child, their alias tables depend on its weight
+        self._parents = weakref.WeakSet()
+        self._weight = 1
         if children is None:
             self.children = []
         else:
             self.children = children
         self.kwargs = kwargs
-        self.weight = 1
+        # random stream keyed by the node that created the generator
+        self.stream = ctx.stream_key("generator")
+
+    @classmethod
+    def reset(cls):
+        """ Forget the generators of the previous run and restart the ids """
+        with cls.id_lock:
+            cls.next_id = 0
+            cls.generators = weakref.WeakValueDictionary()
 
     @abstractmethod
     def exec(self, *args, **kwargs):
         pass
 
+    def requirements(self):
+        """
+        Return the set of (blender_file, collection) pairs that executing this generator
+        may load, so they can be loaded together with load.preload before executing it.
+        """
+        pairs = set()
+        for child in self.children:
+            if isinstance(child, Generator):
+                pairs |= child.requirements()
+        return pairs
+
     def clone(self):
         """
         Clone a generator. The clone has no children.
         """
         the_clone = copy.copy(self)
 
-        the_clone.id = Generator.next_id
-        Generator.generators[the_clone.id] = the_clone
-        Generator.next_id += 1
+        with Generator.id_lock:
+            the_clone.id = Generator.next_id
+            Generator.generators[the_clone.id] = the_clone
+            Generator.next_id += 1
+        the_clone._parents = weakref.WeakSet()
         the_clone.children = []
+        the_clone.stream = ctx.stream_key("generator")
         return the_clone
 
+    @property
+    def children(self):
+        """ Child generators """
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = ChildList(self, value)
+        self._children_changed()
+
+    def _children_changed(self):
+        """ Drop the alias table and register as a parent of the current children """
+        self._alias_table = None
+        with Generator.parents_lock:
+            for child in self._children:
+                if isinstance(child, Generator):
+                    child._parents.add(self)
+
+    @property
+    def weight(self):
+        """ Selection weight of this generator relative to its siblings """
+        return self._weight
+
+    @weight.setter
+    def weight(self, value):
+        self._weight = value
+        # the alias tables of the parents must be rebuilt
+        with Generator.parents_lock:
+            parents = list(self._parents)
+        for parent in parents:
+            parent._alias_table = None
+
+    def alias_table(self):
+        """
+        Return the alias table (probabilities, aliases) for weighted selection of a child.
+        The table is cached until the weight of a child generator changes or the children change.
+        """
+        table = self._alias_table
+        if table is None:
+            table = build_alias_table([child.weight for child in self.children])
+            self._alias_table = table
+        return table
+
+    def select_indices(self, size=None):
+        """ Select weighted random child indices, a single index when size is None """
+        prob, alias = self.alias_table()
+        rng = ctx.rng(*self.stream)
+        column = rng.integers(len(prob), size=size)
+        return np.where(rng.random(size=size) < prob[column], column, alias[column])
+
     def select_child(self):
         """ Select a weighted random child """
-        weights = []
-        for child in self.children:
-            weights.append(child.weight)
-        weights = np.array(weights)
-        selected = ctx.random.choice(self.children, p=weights/sum(weights))
-        return selected
+        return self.children[int(self.select_indices())]
+
+    def select_children(self, n):
+        """ Select n weighted random children at once """
+        return [self.children[index] for index in self.select_indices(n)]
 
 class ObjectGenerator(Generator):
     """
@@ -87,6 +232,18 @@ class ObjectGenerator(Generator):
         self.object_class = object_class
         self.object_type = object_type
 
+    def requirements(self):
+        """ The collection this generator copies from the asset cache, if any """
+        config = self.kwargs.get("config", {})
+        if "blender_file" not in self.kwargs or config.get("load", "append") == "link":
+            return set()
+        if config.get("load", "append") == "append" and not config.get("cache", True):
+            return set()
+        # object classes with their own loader may not use the asset cache
+        if getattr(self.object_class, "load", None) is not AnaObject.load:
+            return set()
+        return {(self.kwargs["blender_file"], self.object_type)}
+
     def exec(self, *args, **kwargs):
         """ Return a new instance of the specified object """
         # instantiate the object class
@@ -120,9 +277,19 @@ class ObjectModifier(Generator):
         # recursively execute until we get an object
         if not isinstance(child, AnaObject):
             child = child.exec(*args, **kwargs)
+        return self.apply(child)
+
+    def apply(self, obj):
+        """ Execute the modifier method on an object """
+        if obj.load_mode == "instance":
+            # the objects of an instanced collection are shared by all of its instances
+            raise ValueError("Can't apply modifier '{}' to '{}', it was loaded with load: instance".format(
+                self.method, obj.object_type))
+        # modifiers change a single object, so it can't keep sharing materials with other instances
+        obj.make_materials_unique()
         # execute modifier method
-        getattr(child, self.method)(**self.kwargs)
-        return child
+        getattr(obj, self.method)(**self.kwargs)
+        return obj
 
     def __repr__(self):
         return json.dumps({
@@ -151,6 +318,150 @@ class CreateBranchGenerator(Generator):
             "id": self.id
         })
 
+class GeneratorProgram:
+    """
+    A generator tree compiled into a flat list of paths. Each path is a leaf, the chain of
+    modifiers applied to it (innermost first) and the probability of the tree executing
+    that path, so a path is sampled with a single draw instead of one per level.
+    """
+    def __init__(self, leaves, modifiers, chains, path_leaves, path_chains, probs):
+        # leaf generators (or objects) and modifiers referenced by index
+        self.leaves = leaves
+        self.modifiers = modifiers
+        # modifier index tuples, innermost modifier first
+        self.chains = chains
+        # per path arrays
+        self.path_leaves = np.asarray(path_leaves, dtype=np.int64)
+        self.path_chains = np.asarray(path_chains, dtype=np.int64)
+        self.probs = np.asarray(probs, dtype=np.float64)
+        self.table = build_alias_table(self.probs)
+        self.stream = ctx.stream_key("program")
+
+    def sample(self, size=None):
+        """ Draw random path indices, a single index when size is None """
+        prob, alias = self.table
+        rng = ctx.rng(*self.stream)
+        column = rng.integers(len(prob), size=size)
+        return np.where(rng.random(size=size) < prob[column], column, alias[column])
+
+    def requirements(self, paths=None):
+        """ Return the (blender_file, collection) pairs needed by the given paths, all paths by default """
+        if paths is None:
+            paths = range(len(self.probs))
+        pairs = set()
+        for leaf in {int(self.path_leaves[path]) for path in paths}:
+            if isinstance(self.leaves[leaf], Generator):
+                pairs |= self.leaves[leaf].requirements()
+        return pairs
+
+    def exec_path(self, path):
+        """ Execute a single path and return the object """
+        leaf = self.leaves[self.path_leaves[path]]
+        obj = leaf if isinstance(leaf, AnaObject) else leaf.exec()
+        for modifier in self.chains[self.path_chains[path]]:
+            obj = self.modifiers[modifier].apply(obj)
+        return obj
+
+    def exec(self, *args, **kwargs):
+        """ Sample a path and execute it """
+        return self.exec_path(int(self.sample()))
+
+    def dump(self):
+        """ Return a JSON serializable representation that can be loaded in another process """
+        leaves = []
+        for leaf in self.leaves:
+            if not isinstance(leaf, ObjectGenerator):
+                raise ValueError("Can't serialize leaf '{}' of a generator program".format(leaf))
+            leaves.append({
+                "object_class": "{}:{}".format(leaf.object_class.__module__, leaf.object_class.__qualname__),
+                "object_type": leaf.object_type,
+                "kwargs": leaf.kwargs})
+        return {
+            "leaves": leaves,
+            "modifiers": [{"method": modifier.method, "kwargs": modifier.kwargs} for modifier in self.modifiers],
+            "chains": [list(chain) for chain in self.chains],
+            "path_leaves": self.path_leaves.tolist(),
+            "path_chains": self.path_chains.tolist(),
+            "probs": self.probs.tolist()}
+
+    @classmethod
+    def load(cls, data):
+        """ Create a program from the output of dump """
+        leaves = []
+        for leaf in data["leaves"]:
+            module, qualname = leaf["object_class"].split(":")
+            object_class = importlib.import_module(module)
+            for name in qualname.split("."):
+                object_class = getattr(object_class, name)
+            leaves.append(ObjectGenerator(object_class, leaf["object_type"], **leaf["kwargs"]))
+        modifiers = [ObjectModifier(modifier["method"], [], **modifier["kwargs"]) for modifier in data["modifiers"]]
+        return cls(leaves, modifiers, [tuple(chain) for chain in data["chains"]],
+                   data["path_leaves"], data["path_chains"], data["probs"])
+
+    def __repr__(self):
+        return json.dumps({
+            "class": self.__class__.__name__,
+            "paths": len(self.probs)
+        })
+
+def compile_generator(tree):
+    """
+    Compile a tree of branch generators and modifiers into a GeneratorProgram. Each entry is
+    a leaf with the chain of modifiers applied to it and the probability of the tree executing
+    it, the sum over all routes of the product of the weighted choices along the way. Each
+    generator is visited once, so shared children don't multiply the work; the number of
+    entries grows with the distinct leaf and modifier combinations.
+    """
+    leaves, leaf_index = [], {}
+    modifiers, modifier_index = [], {}
+    # distribution of each generator over (leaf index, modifier indices innermost first)
+    dists = {}
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in dists:
+            continue
+        if not isinstance(node, (CreateBranchGenerator, ObjectModifier)):
+            # anything else is a leaf - an object generator or an object
+            leaf_index[id(node)] = len(leaves)
+            leaves.append(node)
+            dists[id(node)] = {(leaf_index[id(node)], ()): 1.0}
+            continue
+        if not expanded:
+            # visit the children first, in order so leaves are numbered depth first
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children)
+                         if child.weight > 0 and id(child) not in dists)
+            continue
+        outer = ()
+        if isinstance(node, ObjectModifier):
+            modifier_index[id(node)] = len(modifiers)
+            modifiers.append(node)
+            outer = (modifier_index[id(node)],)
+        weights = np.array([child.weight for child in node.children], dtype=np.float64)
+        total = weights.sum()
+        dist = {}
+        for child, weight in zip(node.children, weights):
+            if weight <= 0:
+                continue
+            for (leaf, chain), prob in dists[id(child)].items():
+                key = (leaf, chain + outer)
+                dist[key] = dist.get(key, 0.0) + prob * weight / total
+        dists[id(node)] = dist
+
+    chains, chain_index = [], {}
+    paths = {}
+    for (leaf, chain), prob in sorted(dists[id(tree)].items()):
+        if chain not in chain_index:
+            chain_index[chain] = len(chains)
+            chains.append(chain)
+        paths[(leaf, chain_index[chain])] = prob
+
+    keys = sorted(paths)
+    return GeneratorProgram(
+        leaves, modifiers, chains,
+        [key[0] for key in keys], [key[1] for key in keys], [paths[key] for key in keys])
+
 class PathList(list):
     """
     A list of paths. Each path is a list of generator id's from root to leaf
@@ -191,33 +502,11 @@ class PathList(list):
         tree = Generator.generators[id_map[self[0][0]]]
         return tree
 
-def _get_all_leaves(tree, leaf_class=ObjectGenerator, leaves=None):
-    """
-    Helper function that gets a list of all leaves in the tree. The list may include
-    dupes because it follows every possible path
-    """
-    if leaves is None:
-        leaves = []
-    if isinstance(tree, leaf_class):
-        leaves.append(tree)
-        return leaves
-    else:
-        for child in tree.children:
-            leaves = _get_all_leaves(child, leaf_class, leaves)
-        return leaves
-
 def get_unique_leaves(tree, leaf_class=ObjectGenerator):
     """
     Get list of all unique leaves in the tree.
     """
-    leaves_with_dupes = _get_all_leaves(tree, leaf_class=leaf_class)
-    ids = []
-    leaves = []
-    for leaf in leaves_with_dupes:
-        if leaf.id not in ids:
-            ids.append(leaf.id)
-            leaves.append(leaf)
-    return leaves
+    return generator_dag.unique_leaves(tree, leaf_class)
 
 def _get_single_pathlist(tree, leaf_class=ObjectGenerator):
     """
@@ -235,29 +524,7 @@ def create_single_path(tree, leaf_class=ObjectGenerator):
     """
     Create an exectuable single path to a weighted random leaf.
     """
-    return _get_single_pathlist(tree, leaf_class=ObjectGenerator).to_tree()
-
-def _get_all_paths(tree, leaf_class=ObjectGenerator, paths=None, current_depth=0):
-    """
-    Helper function that creates a list of all paths in the tree
-    Returns a Pathlist with one entry per path
-    """
-    if paths is None:
-        paths = PathList([[]])
-    current_depth += 1
-    paths[-1].append(tree.id)
-    if isinstance(tree, leaf_class):
-        # if we are at a leaf then we're done with this path
-        return paths
-    else:
-        # otherwise continue down the left-most path until we hit a leaf
-        paths = _get_all_paths(tree.children[0], leaf_class, paths, current_depth)
-        if len(tree.children) > 1:
-            # if there are more children then create new path
-            for child in tree.children[1:]:
-                paths.append(paths[-1][:current_depth])
-                paths = _get_all_paths(child, leaf_class, paths, current_depth)
-        return paths
+    return _get_single_pathlist(tree, leaf_class=leaf_class).to_tree()
 
 def create_multi_path(tree, leaf_class=ObjectGenerator):
     """
@@ -268,15 +535,8 @@ def create_multi_path(tree, leaf_class=ObjectGenerator):
     single_path = _get_single_pathlist(tree, leaf_class)
     # get the leaf
     leaf_id = single_path[0][-1]
-    # generate all possible paths
-    all_paths = _get_all_paths(tree, leaf_class)
-    # save all paths that end at the leaf
-    paths_to_leaf = PathList()
-    for path in all_paths:
-        if path[-1] == leaf_id:
-            paths_to_leaf.append(path)
-    # convert back to a tree
-    return paths_to_leaf.to_tree()
+    # keep the generators on paths to the leaf, without enumerating the paths
+    return generator_dag.prune_to_leaf(tree, leaf_id, leaf_class)
 
 if __name__ == "__main__":
     # test
@@ -0,0 +1,106 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Analysis of generator trees. Generators can share children, so a tree is really a DAG and
+the number of root to leaf paths can grow exponentially with its depth. The functions here
+visit each generator once, so they are linear in the number of generators and child links.
+"""
+
+def _children(generator, leaf_class):
+    """ Children of a generator, leaves have none """
+    if isinstance(generator, leaf_class):
+        return []
+    return list(generator.children)
+
+
+def postorder(tree, leaf_class):
+    """ Return the unique generators of a tree with every child before its parents """
+    order = []
+    visited = set()
+    stack = [(tree, False)]
+    while stack:
+        generator, expanded = stack.pop()
+        if expanded:
+            order.append(generator)
+            continue
+        if generator.id in visited:
+            continue
+        visited.add(generator.id)
+        stack.append((generator, True))
+        for child in reversed(_children(generator, leaf_class)):
+            if child.id not in visited:
+                stack.append((child, False))
+    return order
+
+
+def unique_leaves(tree, leaf_class):
+    """ Return the unique leaves of a tree in depth first order """
+    leaves = []
+    visited = set()
+    stack = [tree]
+    while stack:
+        generator = stack.pop()
+        if generator.id in visited:
+            continue
+        visited.add(generator.id)
+        if isinstance(generator, leaf_class):
+            leaves.append(generator)
+        else:
+            stack.extend(reversed(list(generator.children)))
+    return leaves
+
+
+def reachable_leaves(tree, leaf_class):
+    """ Return the set of leaf ids reachable from each generator, indexed by generator id """
+    reachable = {}
+    for generator in postorder(tree, leaf_class):
+        if isinstance(generator, leaf_class):
+            reachable[generator.id] = frozenset([generator.id])
+        else:
+            leaves = set()
+            for child in generator.children:
+                leaves |= reachable[child.id]
+            reachable[generator.id] = frozenset(leaves)
+    return reachable
+
+
+def count_paths(tree, leaf_class, leaf_id=None):
+    """ Count the root to leaf paths of a tree, only those ending at leaf_id if it is given """
+    counts = {}
+    for generator in postorder(tree, leaf_class):
+        if isinstance(generator, leaf_class):
+            counts[generator.id] = 1 if leaf_id is None or generator.id == leaf_id else 0
+        else:
+            counts[generator.id] = sum(counts[child.id] for child in generator.children)
+    return counts[tree.id]
+
+
+def prune_to_leaf(tree, leaf_id, leaf_class):
+    """
+    Return an executable copy of the tree that only contains the paths ending at leaf_id.
+    Each generator on those paths is cloned once, so shared children stay shared, and
+    children keep their original order. Every call returns new clones.
+    """
+    reachable = reachable_leaves(tree, leaf_class)
+    if leaf_id not in reachable[tree.id]:
+        raise ValueError("Generator {} is not a leaf of generator {}".format(leaf_id, tree.id))
+    clones = {}
+    for generator in postorder(tree, leaf_class):
+        if leaf_id not in reachable[generator.id]:
+            continue
+        clone = generator.clone()
+        clone.children = [clones[child.id] for child in _children(generator, leaf_class)
+                          if child.id in clones]
+        clones[generator.id] = clone
+    return clones[tree.id]
@@ -11,111 +11,303 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-# import sys
+import heapq
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import gc
+import os
+import copy
+import yaml
 import ana.packages.common.lib.context as ctx
+import ana.packages.common.lib.trace as trace
 from ana.packages.common.lib.node import create_node
+from ana.packages.common.lib.package_utils import get_package_files
+from ana.packages.common.lib.exceptions import GraphError
 
 logger = logging.getLogger(__name__)
 
+
+class ExecutionPlan:
+    """
+    A graph compiled into a fixed execution order.
+
+    The output port set of every node and the destination of every output link
+    are resolved once when the plan is built, so executing the plan is linear in
+    the number of nodes and links. Nodes that become ready at the same time are
+    executed in the order of their names, which matches the order used by
+    earlier versions of the interpreter. Values delivered to an input port are
+    always ordered by the plan position of their source, so the inputs of a node
+    don't depend on which of its sources finished first.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        # schema output port names, indexed by node name
+        self.output_ports = {}
+        # resolved output links, indexed by source node name: [(src_port, dst_node, dst_port), ...]
+        self.targets = {}
+        # number of unresolved input links, indexed by node name
+        self.indegree = {}
+        # node names in execution order
+        self.order = []
+        self._link()
+        self._sort()
+
+    def _link(self):
+        """ Validate input links, append outlinks to nodes and resolve link targets """
+        for name, node in self.nodes.items():
+            self.output_ports[name] = node.compiled_schema.output_set
+            self.targets[name] = []
+            self.indegree[name] = 0
+
+        for dst_node, node in self.nodes.items():
+            for dst_port, links in node.inlinks.items():
+                for src_node, src_port in links:
+                    if src_node not in self.nodes:
+                        raise GraphError(
+                            "Node '{}' class '{}' input '{}' is linked to undefined node '{}'".format(
+                                dst_node, node.__class__.__name__, dst_port, src_node))
+                    if src_port not in self.output_ports[src_node]:
+                        raise GraphError(
+                            "Node '{}' class '{}' input '{}' is linked to node '{}' class '{}' on undefined port '{}'".format(
+                                dst_node, node.__class__.__name__, dst_port,
+                                src_node, self.nodes[src_node].__class__.__name__, src_port))
+                    outlinks = self.nodes[src_node].outlinks
+                    if src_port not in outlinks:
+                        outlinks[src_port] = []
+                    outlinks[src_port].append((dst_node, dst_port))
+                    self.targets[src_node].append((src_port, dst_node, dst_port))
+                    self.indegree[dst_node] += 1
+
+    def _sort(self):
+        """ Topologically sort the nodes, breaking ties by node name """
+        rank = {name: num for num, name in enumerate(sorted(self.nodes))}
+        indegree = dict(self.indegree)
+        ready = [(rank[name], name) for name, count in indegree.items() if count == 0]
+        heapq.heapify(ready)
+        while ready:
+            _, name = heapq.heappop(ready)
+            self.order.append(name)
+            for _, dst_node, _ in self.targets[name]:
+                indegree[dst_node] -= 1
+                if indegree[dst_node] == 0:
+                    heapq.heappush(ready, (rank[dst_node], dst_node))
+
+        if len(self.order) != len(self.nodes):
+            unresolved = [name for name, count in indegree.items() if count > 0]
+            errorString = "Graph execution failed; graph is cyclic. "
+            cycle = self._find_cycle(unresolved)
+            if cycle:
+                errorString += "Cycle: " + ", ".join(cycle) + ". "
+            errorString += "The following links could not be resolved: "
+            linkDescriptions = []
+            for name in unresolved:
+                for port, inlinks in self.nodes[name].inlinks.items():
+                    for inlink in inlinks:
+                        linkDescriptions.append("Node '{}' class '{}' input '{}' link '[{}, {}]'".format(
+                            name, self.nodes[name].__class__.__name__, port, inlink[0], inlink[1]))
+            errorString += ', '.join(linkDescriptions)
+            raise GraphError(errorString)
+
+    def _find_cycle(self, unresolved):
+        """ Return one cycle among the unresolved nodes as a list of 'node:port' link descriptions """
+        unresolved = set(unresolved)
+        for start in sorted(unresolved):
+            # follow input links backwards until a node repeats
+            path = []
+            visited = {}
+            name = start
+            while name not in visited:
+                visited[name] = len(path)
+                step = None
+                for port, inlinks in sorted(self.nodes[name].inlinks.items()):
+                    for src_node, src_port in inlinks:
+                        if src_node in unresolved:
+                            step = (src_node, src_port, port)
+                            break
+                    if step:
+                        break
+                if step is None:
+                    break
+                src_node, src_port, port = step
+                path.append("{}:{} -> {}:{}".format(src_node, src_port, name, port))
+                name = src_node
+            else:
+                cycle = path[visited[name]:]
+                cycle.reverse()
+                return cycle
+        return None
+
+    def _prepare(self):
+        """ Compute the input slot of every link and the critical path priority of every node """
+        self.position = position = {name: num for num, name in enumerate(self.order)}
+        # values delivered to a port are ordered by the position of their source in the plan,
+        # so inputs match serial execution no matter when the sources finish
+        self.slots = {}
+        for name in self.order:
+            for num, (src_port, dst_node, dst_port) in enumerate(self.targets[name]):
+                self.slots[(name, num)] = (position[name], num)
+        # the longest chain of nodes from each node to the end of the graph
+        self.priority = {}
+        for name in reversed(self.order):
+            self.priority[name] = 1 + max(
+                (self.priority[dst_node] for _, dst_node, _ in self.targets[name]), default=0)
+        self.remaining = dict(self.indegree)
+        self.delivered = {name: {} for name in self.nodes}
+        # pool nodes ready to run, only used for concurrent execution
+        self.ready = None
+
+    def execute(self, threads=0):
+        """
+        Execute the nodes, passing outputs along the resolved links. With threads > 0 the
+        nodes whose schema sets main_thread to false run in a thread pool; all other nodes
+        run on the main thread in plan order.
+        """
+        self._prepare()
+        concurrent = [name for name in self.order if not self.nodes[name].compiled_schema.main_thread]
+        if threads <= 0 or not concurrent:
+            for name in self.order:
+                self._complete(name, self._run(name))
+        else:
+            self._execute_concurrent(threads)
+
+    def _execute_concurrent(self, threads):
+        """ Run main thread nodes in plan order while the other nodes run in a pool, longest path first """
+        main_nodes = [name for name in self.order if self.nodes[name].compiled_schema.main_thread]
+        next_main = 0
+        self.ready = []
+        for name, count in self.remaining.items():
+            if count == 0:
+                self._ready(name)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            while True:
+                while self.ready and len(futures) < threads:
+                    _, _, name = heapq.heappop(self.ready)
+                    futures[pool.submit(self._run, name)] = name
+                if next_main < len(main_nodes) and self.remaining[main_nodes[next_main]] == 0:
+                    name = main_nodes[next_main]
+                    next_main += 1
+                    self._complete(name, self._run(name))
+                    continue
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: self.position[futures[future]]):
+                    self._complete(futures.pop(future), future.result())
+
+    def _ready(self, name):
+        """ Queue a pool node whose inputs are all delivered """
+        if not self.nodes[name].compiled_schema.main_thread:
+            heapq.heappush(self.ready, (-self.priority[name], self.position[name], name))
+
+    def _run(self, name):
+        """ Execute a single node and return its outputs """
+        node = self.nodes[name]
+        logger.info("Executing node '%s' class '%s'", name, node.__class__.__name__)
+        with trace.span("exec " + name, "node", node_class=node.__class__.__name__), ctx.node_scope(name):
+            outputs = node.exec()
+        # verify the actual node output matches the schema outputs
+        # TODO: After people clean up their returns, make this throw an exception.
+        if set(outputs.keys()) != self.output_ports[name]:
+            logger.error("Output returned by node '%s' class '%s' doesn't match output defined in schema",
+                         node.name, node.__class__.__name__)
+        return outputs
+
+    def _complete(self, name, outputs):
+        """ Resolve the output links of a node that finished executing """
+        for num, (src_port, dst_node, dst_port) in enumerate(self.targets[name]):
+            self._deliver(name, src_port, dst_node, dst_port, outputs[src_port], self.slots[(name, num)])
+
+    def _deliver(self, src_node, src_port, dst_node, dst_port, value, slot):
+        """
+        Store a value for the destination node/port and remove the resolved inlink. Once all
+        inlinks of the destination are resolved the values are appended to its inputs in slot order.
+        """
+        dst = self.nodes[dst_node]
+        try:
+            dst.inlinks[dst_port].remove((src_node, src_port))
+            # if there are no more inlinks on the destination port then delete it
+            if len(dst.inlinks[dst_port]) == 0:
+                del dst.inlinks[dst_port]
+        except (KeyError, ValueError):
+            # this is a coding error
+            raise GraphError("Node '{}' class '{}' is missing link '[{}, {}]'".format(
+                dst_node, dst.__class__.__name__, src_node, src_port))
+        self.delivered[dst_node].setdefault(dst_port, []).append((slot, value))
+        self.remaining[dst_node] -= 1
+        if self.remaining[dst_node] == 0:
+            for port, values in self.delivered.pop(dst_node).items():
+                if port not in dst.inputs:
+                    dst.inputs[port] = []
+                dst.inputs[port].extend(value for _, value in sorted(values, key=lambda item: item[0]))
+            if self.ready is not None:
+                self._ready(dst_node)
+
+
 def interp(graph):
     """Interpret a graph"""
     graphFormatVersion = graph.get("version", 0.0)
 
     # channel setup
-    ctx.channel.setup()
+    with trace.span("channel setup"):
+        ctx.channel.setup()
 
     # create and configure nodes
     nodes = {}
     for name, node_config in sorted(graph["nodes"].items()):
-        if graphFormatVersion == 0.0:
-            nodes[name] = create_node(name, node_config["class"])
-            nodes[name].configure_v0(node_config)
-        else:
-            nodes[name] = create_node(name, node_config["nodeClass"])
-            nodes[name].configure(node_config)
-
-    # append outlinks to nodes
-    for dst_node in nodes:
-        for dst_port in nodes[dst_node].inlinks:
-            for link in nodes[dst_node].inlinks[dst_port]:
-                src_node, src_port = link
-                if src_node in nodes.keys():
-                    schema_output_set = set()
-                    for port_dict in nodes[src_node].schema["outputs"]:
-                        schema_output_set.add(port_dict["name"])
-                    if src_port not in schema_output_set:
-                        logger.error(
-                            "Node '%s' class '%s' input '%s' is linked to node '%s' class '%s' on undefined port '%s'",
-                            dst_node, nodes[dst_node].__class__.__name__, dst_port,
-                            src_node, nodes[src_port].__class__.__name__, src_port)
-                        sys.exit(1)
-                    if src_port not in nodes[src_node].outlinks.keys():
-                        nodes[src_node].outlinks[src_port] = []
-                    nodes[src_node].outlinks[src_port].append((dst_node, dst_port))
-                else:
-                    logger.error(
-                        "Node '%s' class '%s' input '%s' is linked to undefined node '%s'",
-                        dst_node, nodes[dst_node].__class__.__name__, dst_port, src_node)
-                    sys.exit(1)
-
-    # execute nodes
-    while len(nodes) > 0:
-        node_executed = None
-        for name, node in nodes.items():
-            # if all input links have been resolved then execute this node
-            if len(node.inlinks.keys()) == 0:
-                logger.info("Executing node '%s' class '%s'", name, node.__class__.__name__)
-                outputs = node.exec()
-                # verify the actual node output matches the schema outputs
-                # TODO: After people clean up their returns, make this throw an exception.
-                schema_output_set = set()
-                for port_dict in node.schema["outputs"]:
-                    schema_output_set.add(port_dict["name"])
-                if set(outputs.keys()) != schema_output_set:
-                    logger.error("Output returned by node '%s' class '%s' doesn't match output defined in schema",
-                                node.name, node.__class__.__name__)
-                # resolve output links
-                for src_port in node.outlinks:
-                    for outlink in node.outlinks[src_port]:
-                        dst_node, dst_port = outlink
-                        # append value to input of destination node/port
-                        if dst_port not in nodes[dst_node].inputs.keys():
-                            nodes[dst_node].inputs[dst_port] = []
-                        nodes[dst_node].inputs[dst_port].append(outputs[src_port])
-                        # remove inlink from destination node/port
-                        try:
-                            nodes[dst_node].inlinks[dst_port].remove((name, src_port))
-                            # if there are no more inlinks on the destination port then delete it
-                            if len(nodes[dst_node].inlinks[dst_port]) == 0:
-                                del nodes[dst_node].inlinks[dst_port]
-                        except ValueError:
-                            # this is a coding error
-                            logger.critical(
-                                "Node '%s' class '%s' is missing link '[%s, %s]'",
-                                dst_node, nodes[dst_node].__class__.__name__, name, src_port)
-                            sys.exit(1)
-                node_executed = node
-                break
-
-        # delete the node we executed
-        if node_executed:
-            del nodes[node_executed.name]
-        else:
-            # this is either a coding error or a cycle in the graph
-            errorString = "Graph execution failed; graph may be cyclic. The following links could not be resolved: "
-            linkDescriptions = []
-            for name in nodes:
-                for port in nodes[name].inlinks:
-                    for inlink in nodes[name].inlinks[port]:
-                        linkDescriptions.append("Node '%s' class '%s' input '%s' link '[%s, %s]'",
-                                                name, nodes[name].__class__.__name__, port, inlink[0], inlink[1])
-            errorString += ', '.join(linkDescriptions)
-            logger.error(errorString)
-            sys.exit(1)
+        with trace.span("configure " + name, "node"):
+            if graphFormatVersion == 0.0:
+                nodes[name] = create_node(name, node_config["class"])
+                nodes[name].configure_v0(node_config)
+            else:
+                nodes[name] = create_node(name, node_config["nodeClass"])
+                nodes[name].configure(node_config)
+
+    # compile the graph and execute nodes
+    with trace.span("compile graph"):
+        plan = ExecutionPlan(nodes)
+    prefetch = ctx.volume_cache is not None and ctx.prefetch
+    if prefetch:
+        # warm the cache with the files of the packages the nodes belong to while the nodes execute
+        packages = sorted({type(node).__module__.split(".")[2] for node in nodes.values()} & set(ctx.packages))
+        ctx.volume_cache.prefetch([path for package in packages for path in get_package_files(package)])
+    try:
+        plan.execute(ctx.node_threads)
+    finally:
+        if prefetch:
+            # don't keep copying for a run that is over, or keep a failed run from exiting
+            ctx.volume_cache.cancel_prefetch()
 
     # channel post processing
-    ctx.channel.post_process()
+    with trace.span("channel post process"):
+        ctx.channel.post_process()
+
+    gc.collect()
+
+
+def load_graph(graph, channel_name):
+    """
+    Load a graph file - supports yaml or json format. A graph given without a directory
+    is looked up in the graphs directory of the channel.
+    """
+    if '/' not in graph:
+        if '.yml' not in graph and os.path.isfile(f'./channels/{channel_name}/graphs/{graph}.yml'):
+            graph = f'channels/{channel_name}/graphs/{graph}.yml'
+        elif os.path.isfile(f'./channels/{channel_name}/graphs/{graph}'):
+            graph = f'channels/{channel_name}/graphs/{graph}'
+    with trace.span("load graph", graph=graph):
+        with open(graph, "r") as f:
+            return yaml.safe_load(f)
+
 
-    gc.collect()
\ No newline at end of file
+def run(graph, interp_num, reset_channel=False, seed=None, preview=None, output=None):
+    """
+    Run a graph for a single interp_num. Set reset_channel if a graph has already been
+    run in this process. Seed, preview and output override the settings from initialize.
+    """
+    with trace.span("run", interp_num=interp_num):
+        if reset_channel:
+            ctx.channel.reset()
+        ctx.reset(interp_num, seed=seed, preview=preview, output=output)
+        interp(copy.deepcopy(graph))
@@ -16,6 +16,13 @@ A collection of utility functions that load assets from existing blender files
 """
 import bpy
 from ana.packages.common.lib.search_utils import find_root
+import ana.packages.common.lib.trace as trace
+
+# collections appended from blender files, indexed by (blender_file_name, collection_name)
+# These are never linked to a scene; they are the templates that instances are copied from.
+_collection_cache = {}
+# collections linked from blender files as library data, indexed the same way
+_linked_cache = {}
 
 def load_model(blender_file_name, collection_name):
     '''
@@ -35,18 +42,128 @@ def load_model(blender_file_name, collection_name):
 
     return root
 
-def load_collection(blender_file_name, collection_name):
+def load_collection(blender_file_name, collection_name, link=False):
     '''
-    Load a collection.
+    Load a collection. With link the collection is linked as read-only library data instead of appended.
     Returns a pointer to the collection.
     '''
 
     # load collection
-    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
+    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=link) as (_, dt):
         dt.collections = [collection_name]
 
     return dt.collections[0]
 
+def clear_collection_cache():
+    """
+    Forget all cached collections. Call this when the blender data has been reset.
+    """
+    _collection_cache.clear()
+    _linked_cache.clear()
+
+def _cached_template(key, cache=_collection_cache):
+    '''
+    Return the cached template for a (blender_file_name, collection_name) key, None if it
+    is not cached or has been removed from the blender data.
+    '''
+    template = cache.get(key)
+    if template is not None:
+        try:
+            # accessing a removed datablock raises a ReferenceError
+            if len(template.all_objects):
+                return template
+        except ReferenceError:
+            pass
+    return None
+
+def get_cached_collection(blender_file_name, collection_name, link=False):
+    '''
+    Return the cached template of a collection, appending it from the file the first time.
+    With link the template is linked from the file instead.
+    '''
+    cache = _linked_cache if link else _collection_cache
+    key = (blender_file_name, collection_name)
+    template = _cached_template(key, cache)
+    if template is not None:
+        return template
+    template = load_collection(blender_file_name, collection_name, link=link)
+    cache[key] = template
+    return template
+
+def preload(pairs):
+    '''
+    Append the templates of several collections into the cache, opening each blender file once.
+    pairs is an iterable of (blender_file_name, collection_name); cached collections are skipped.
+    '''
+    files = {}
+    for key in pairs:
+        if _cached_template(key) is None:
+            files.setdefault(key[0], set()).add(key[1])
+
+    for blender_file_name, collection_names in sorted(files.items()):
+        collection_names = sorted(collection_names)
+        with trace.span("preload", "load", blender_file=blender_file_name, collections=len(collection_names)):
+            with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
+                dt.collections = collection_names
+        for collection_name, collection in zip(collection_names, dt.collections):
+            # missing collections are left for get_cached_collection to report
+            if collection is not None:
+                _collection_cache[(blender_file_name, collection_name)] = collection
+
+def instance_collection(blender_file_name, collection_name, link=False):
+    '''
+    Create a new instance of a collection in a blender file.
+    The collection is only appended from the file once. Instances are made by copying
+    its objects, the copies share the mesh, armature and material datablocks of the template.
+    With link the template is linked instead, so the shared datablocks stay library data.
+    Returns a pointer to the new collection.
+    '''
+    template = get_cached_collection(blender_file_name, collection_name, link=link)
+    object_map = {}
+    new_collection = copy_collection(template, object_map)
+
+    # point parents, modifiers and constraints of the copies at the other copies
+    for original, copy in object_map.items():
+        if original.parent in object_map:
+            copy.parent = object_map[original.parent]
+        for modifier in copy.modifiers:
+            if getattr(modifier, "object", None) in object_map:
+                modifier.object = object_map[modifier.object]
+        for constraint in copy.constraints:
+            if getattr(constraint, "target", None) in object_map:
+                constraint.target = object_map[constraint.target]
+
+    return new_collection
+
+def collection_instance(blender_file_name, collection_name):
+    '''
+    Create a collection holding a single empty that instances a collection in a blender file.
+    The collection is only appended from the file once and all instances render its objects.
+    Returns a pointer to the new collection, the empty is its only object.
+    '''
+    template = get_cached_collection(blender_file_name, collection_name)
+    empty = bpy.data.objects.new(collection_name, None)
+    empty.instance_type = 'COLLECTION'
+    empty.instance_collection = template
+    new_collection = bpy.data.collections.new(collection_name)
+    new_collection.objects.link(empty)
+    return new_collection
+
+def copy_collection(collection, object_map):
+    '''
+    Copy a collection and its child collections. Objects are copied once and the
+    copies are recorded in object_map, indexed by the original object.
+    Returns a pointer to the new collection.
+    '''
+    new_collection = bpy.data.collections.new(collection.name)
+    for obj in collection.objects:
+        if obj not in object_map:
+            object_map[obj] = obj.copy()
+        new_collection.objects.link(object_map[obj])
+    for child in collection.children:
+        new_collection.children.link(copy_collection(child, object_map))
+    return new_collection
+
 def load_material(blender_file_name, material_name):
     """
     Load a material from a blender file.
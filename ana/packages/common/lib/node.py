@@ -11,39 +11,79 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import sys
 import importlib
 import logging
 import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.exceptions import GraphError
 
 logger = logging.getLogger(__name__)
 
+class NodeSchema:
+    """Compiled node schema - the port sets and defaults used to configure and link nodes"""
+    def __init__(self, schema):
+        self.schema = schema
+        inputs = schema.get("inputs") or []
+        outputs = schema.get("outputs") or []
+        self.input_set = frozenset(port_dict["name"] for port_dict in inputs)
+        self.input_defaults = {
+            port_dict["name"]: port_dict.get("default") for port_dict in inputs if "default" in port_dict}
+        self.input_types = {port_dict["name"]: port_dict.get("type") for port_dict in inputs}
+        self.output_set = frozenset(port_dict["name"] for port_dict in outputs)
+        self.output_types = {port_dict["name"]: port_dict.get("type") for port_dict in outputs}
+        # nodes that use bpy must run on the main thread, pure Python nodes can set this to false
+        self.main_thread = bool(schema.get("main_thread", True))
+
+
+class NodeRegistry:
+    """
+    Node classes and compiled schemas for each alias in a channel. Schemas are compiled when
+    the registry is created; node modules are imported the first time a node is created so
+    unused nodes never import their modules.
+    """
+    def __init__(self, classes, schemas):
+        self.classes = classes
+        self.schemas = {alias: NodeSchema(schema) for alias, schema in schemas.items()}
+        self.node_classes = {}
+
+    def schema(self, alias):
+        """Return the compiled schema for an alias"""
+        try:
+            return self.schemas[alias]
+        except KeyError:
+            raise GraphError("No schema defined for node '{}' in channel definition file".format(alias))
+
+    def node_class(self, alias):
+        """Return the node class for an alias, importing its module on first use"""
+        node_class = self.node_classes.get(alias)
+        if node_class is not None:
+            return node_class
+
+        try:
+            module = self.classes[alias]["module"]
+        except KeyError:
+            raise GraphError("No module defined for node '{}' in channel definition file".format(alias))
+        try:
+            class_name = self.classes[alias]["class"]
+        except KeyError:
+            raise GraphError("No class defined for node '{}' in channel definition file".format(alias))
+
+        # import the class
+        try:
+            node_class = getattr(importlib.import_module(module), class_name)
+        except ModuleNotFoundError:
+            raise GraphError("Can't import class '{}', module '{}' not found".format(class_name, module))
+        except AttributeError:
+            raise GraphError("Can't import node '{}', class '{}' not found".format(alias, class_name))
+
+        self.node_classes[alias] = node_class
+        return node_class
+
+
 def create_node(name, alias):
     """Factory method for node class """
 
-    try:
-        module = ctx.channel.classes[alias]["module"]
-    except KeyError:
-        logger.critical("No module defined for node '%s' in channel definition file", alias)
-        sys.exit(1)
-    try:
-        class_name = ctx.channel.classes[alias]["class"]
-    except KeyError:
-        logger.critical("No class defined for node '%s' in channel definition file", alias)
-        sys.exit(1)
-
-    # import the class
-    try:
-        node_class = getattr(importlib.import_module(module), class_name)
-    except ModuleNotFoundError:
-        logger.critical("Can't import class '%s', module '%s' not found", class_name, module)
-        sys.exit(1)
-    except AttributeError:
-        logger.critical("Can't import node '%s', class '%s' not found", alias, class_name)
-        sys.exit(1)
-
     # instantiate the node
-    node = node_class(name, alias)
+    node = ctx.channel.registry.node_class(alias)(name, alias)
 
     return node
 
@@ -60,7 +100,8 @@ class Node:
         self.inputs = {}
         self.inlinks = {}
         self.outlinks = {}
-        self.schema = ctx.channel.schemas[alias]
+        self.compiled_schema = ctx.channel.registry.schema(alias)
+        self.schema = self.compiled_schema.schema
         self.input_types = ["values", "links"]
         # self.version =
 
@@ -91,18 +132,12 @@ class Node:
         logger.debug("SCHEMA: %s", self.schema)
 
         # get set of all schema inputs and their defaults
-        schema_input_set = set()
-        input_defaults = {}
-        if self.schema["inputs"] is not None:
-            for port_dict in self.schema["inputs"]:
-                schema_input_set.add(port_dict["name"])
-                if "default" in port_dict:
-                    input_defaults[port_dict["name"]] = port_dict.get("default")
+        schema_input_set = self.compiled_schema.input_set
+        input_defaults = self.compiled_schema.input_defaults
 
         for key, value in config.get("values", {}).items():
             if key not in schema_input_set:
-                logger.error("Input port '%s' is not defined in schema for class '%s'", key, type(self).__name__)
-                sys.exit(1)
+                raise GraphError("Input port '{}' is not defined in schema for class '{}'".format(key, type(self).__name__))
 
             if key not in self.inputs:
                 self.inputs[key] = []
@@ -116,9 +151,8 @@ class Node:
                 src_node = link['sourceNode']
                 src_port = link['outputPort']
                 if src_node == self.name:
-                    logger.error("Node '%s' class '%s' port '%s' is connected to the same node",
-                                  self.name, self.__class__.__name__, src_port)
-                    sys.exit(1)
+                    raise GraphError("Node '{}' class '{}' port '{}' is connected to the same node".format(
+                        self.name, self.__class__.__name__, src_port))
 
                 self.inlinks[key].append((src_node, src_port))
 
@@ -136,8 +170,7 @@ class Node:
             errorString = "The following ports for node '{}' class '{}' cannot be resolved: ".format(
                 self.name, self.__class__.__name__)
             errorString += ', '.join(unresolveable_ports)
-            logger.error(errorString)
-            sys.exit(1)
+            raise GraphError(errorString)
 
     def configure_v0(self, config):
         """Configure node"""
@@ -166,19 +199,13 @@ class Node:
         logger.debug("SCHEMA: %s", self.schema)
 
         # get set of all schema inputs and their defaults
-        schema_input_set = set()
-        input_defaults = {}
-        if self.schema["inputs"] is not None:
-            for port_dict in self.schema["inputs"]:
-                schema_input_set.add(port_dict["name"])
-                if "default" in port_dict:
-                    input_defaults[port_dict["name"]] = port_dict.get("default")
+        schema_input_set = self.compiled_schema.input_set
+        input_defaults = self.compiled_schema.input_defaults
 
         if config.get("inputs") is not None:
             for key, value in config["inputs"].items():
                 if key not in schema_input_set:
-                    logger.error("Input port '%s' is not defined in schema for class '%s'", key, type(self).__name__)
-                    sys.exit(1)
+                    raise GraphError("Input port '{}' is not defined in schema for class '{}'".format(key, type(self).__name__))
                 # "in1": {...}
                 if isinstance(value, dict):
                     key1, value1 = next(iter(value.items()))
@@ -188,9 +215,8 @@ class Node:
                         src_node = value1[0]
                         src_port = value1[1]
                         if src_node == self.name:
-                            logger.error("Node '%s' class '%s' port '%s' is connected to the same node",
-                                          self.name, self.__class__.__name__, src_port)
-                            sys.exit(1)
+                            raise GraphError("Node '{}' class '{}' port '{}' is connected to the same node".format(
+                                self.name, self.__class__.__name__, src_port))
                         if key not in self.inlinks:
                             self.inlinks[key] = []
                         self.inlinks[key].append((src_node, src_port))
@@ -206,9 +232,8 @@ class Node:
                                     src_node = value2[0]
                                     src_port = value2[1]
                                     if src_node == self.name:
-                                        logger.error("Node '%s' class '%s' port '%s' is connected to the same node",
-                                                    self.name, self.__class__.__name__, src_port)
-                                        sys.exit(1)
+                                        raise GraphError("Node '{}' class '{}' port '{}' is connected to the same node".format(
+                                            self.name, self.__class__.__name__, src_port))
                                     if key not in self.inlinks:
                                         self.inlinks[key] = []
                                     self.inlinks[key].append((src_node, src_port))
@@ -242,8 +267,11 @@ class Node:
             errorString = "The following ports for node '{}' class '{}' cannot be resolved: ".format(
                 self.name, self.__class__.__name__)
             errorString += ', '.join(unresolveable_ports)
-            logger.error(errorString)
-            sys.exit(1)
+            raise GraphError(errorString)
+
+    def rng(self, purpose="default"):
+        """Return the random number generator of this node for the current run, see context.rng"""
+        return ctx.rng("node", self.name, purpose)
 
     def exec(self):
         """Execute Node"""
@@ -16,7 +16,17 @@ import ana.packages.common.lib.context as ctx
 
 def get_volume_path(package, inpath):
     """
-    Convert a volume path to an absolute path
+    Convert a volume path to an absolute path. With a volume cache the path of the
+    local copy of the file is returned.
+    """
+    path = resolve_volume_path(package, inpath)
+    if ctx.volume_cache is not None:
+        return ctx.volume_cache.get(path)
+    return path
+
+def resolve_volume_path(package, inpath):
+    """
+    Convert a volume path to the path of the file on the volume
     """
     if ":" in inpath:
         # path includes a volume
@@ -37,3 +47,23 @@ def get_volume_path(package, inpath):
             # path is relative to "--data" parameter
             return os.path.join(ctx.data, inpath)
 
+
+def get_package_files(package):
+    """
+    Return the volume paths of the files of the objects defined in package.yml
+    """
+    objects = ctx.packages[package].get("objects") or {}
+    return sorted({resolve_volume_path(package, config["filename"]) for config in objects.values()})
+
+def get_asset_info(package, object_type):
+    """
+    Return the indexed information for an object defined in package.yml without loading
+    its blender file, or None if the file hasn't been indexed with scripts/index_assets.py.
+    The information is a dictionary with the keys roots, objects, meshes, polygons,
+    vertices, dimensions (world space x, y, z extent of the meshes) and materials.
+    """
+    filename = ctx.packages[package]["objects"][object_type]["filename"]
+    indexed = ctx.channel.assets.get(package, {}).get("files", {}).get(filename)
+    if indexed is None:
+        return None
+    return indexed["collections"].get(object_type)
@@ -14,7 +14,6 @@
 from abc import ABC
 import logging
 from ana.packages.common.lib.ana_object import AnaObject
-import ana.packages.common.lib.context as ctx
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +39,7 @@ class RiggedObject(AnaObject):
                 min = modification['min']
                 max = modification['max']
                 rot_axis = modification['axis']
-                angle = min + ctx.random.random()*(max-min)
+                angle = min + self.rng.random()*(max-min)
                 angle_axis = [angle]
                 angle_axis.extend(rot_axis)
 
@@ -61,7 +60,7 @@ class RiggedObject(AnaObject):
                 min = modification['min']
                 max = modification['max']
                 loc_axis = modification['axis']
-                translation = min + ctx.random.random()*(max-min)
+                translation = min + self.rng.random()*(max-min)
                 translation_axis = [translation]
                 translation_axis.extend(loc_axis)
 
@@ -0,0 +1,60 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run-length encoding of binary masks in the uncompressed COCO format.
+
+Runs are counted over the pixels in column-major order and alternate between
+background and foreground, starting with background. A mask that starts with a
+foreground pixel therefore starts with a count of 0.
+
+    {"size": [height, width], "counts": [zeros, ones, zeros, ...]}
+"""
+import numpy
+
+
+def encode(mask):
+    """
+    Encode a 2D binary mask.
+    Returns a dictionary with the mask size and the run lengths.
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    if mask.ndim != 2:
+        raise ValueError("Expected a 2D mask, got an array with shape {}".format(mask.shape))
+    pixels = mask.ravel(order='F')
+    # indices where a run ends and the next one starts
+    changes = numpy.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = numpy.diff(numpy.concatenate(([0], changes, [pixels.size])))
+    if pixels.size and pixels[0]:
+        # the first run counts background pixels
+        counts = numpy.concatenate(([0], counts))
+    return {"size": [int(mask.shape[0]), int(mask.shape[1])], "counts": counts.tolist()}
+
+
+def decode(rle):
+    """
+    Decode a run-length encoding.
+    Returns a 2D boolean mask.
+    """
+    height, width = rle["size"]
+    counts = numpy.asarray(rle["counts"], dtype=numpy.int64)
+    if counts.sum() != height * width:
+        raise ValueError("Run lengths add up to {} pixels, expected {}".format(counts.sum(), height * width))
+    # even runs are background, odd runs are foreground
+    values = numpy.arange(len(counts)) % 2 == 1
+    return numpy.repeat(values, counts).reshape((height, width), order='F')
+
+
+def area(rle):
+    """ Return the number of foreground pixels in a run-length encoding """
+    return int(sum(rle["counts"][1::2]))
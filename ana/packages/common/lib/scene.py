@@ -19,6 +19,7 @@ import bpy
 import cv2
 import numpy
 import ana.packages.common.lib.context as ctx
+import ana.packages.common.lib.bbox as annotations
 
 logger = logging.getLogger(__name__)
 loglevel = logging.getLogger().level
@@ -36,11 +37,26 @@ class MetadataEncoder(json.JSONEncoder):
 
 class AnaScene:
     """ Base class for a scene """
-    def __init__(self, blender_scene=None, annotation_view_layer=None, objects=None, sensor_name="Image"):
-        """ initialize scene """
+    def __init__(self, blender_scene=None, annotation_view_layer=None, objects=None, sensor_name="Image",
+                 mask_mode="compositor", mask_format="PNG"):
+        """
+        initialize scene
+
+        mask_mode selects how the instance mask is written:
+            "compositor" - an IDMask node chain is added to the compositor for each object
+            "index" - the object index pass is written once, the compositor doesn't grow with the number of objects
+        mask_format is the file format of the mask in "index" mode, "PNG" (16 bit) or "OPEN_EXR" (32 bit float)
+        """
+        if mask_mode not in ("compositor", "index"):
+            raise ValueError("Invalid mask mode '{}'".format(mask_mode))
+        if mask_format not in ("PNG", "OPEN_EXR"):
+            raise ValueError("Invalid mask format '{}'".format(mask_format))
         self.filename = None # this is set when annotations are written
         self.sensor_name = sensor_name
         self.blender_scene = blender_scene
+        self.mask_mode = mask_mode
+        self.mask_format = mask_format if mask_mode == "index" else "PNG"
+        self.mask_extension = "exr" if self.mask_format == "OPEN_EXR" else "png"
         if annotation_view_layer is None:
             self.annotation_view_layer = bpy.context.view_layer
         else:
@@ -86,15 +102,35 @@ class AnaScene:
         self.maskout = nodes.new('CompositorNodeOutputFile') #output mask node
         self.maskout.name = 'maskout'
         self.maskout.base_path = os.path.join(ctx.output, "masks")
-        self.maskout.format.file_format = "PNG"
-        self.maskout.format.color_mode = "BW"
-        self.maskout.format.color_depth = "16"
-        self.maskout.format.compression = 0
+        if self.mask_format == "OPEN_EXR":
+            self.maskout.format.file_format = "OPEN_EXR"
+            self.maskout.format.color_mode = "BW"
+            self.maskout.format.color_depth = "32"
+            self.maskout.format.exr_codec = "ZIP"
+        else:
+            self.maskout.format.file_format = "PNG"
+            self.maskout.format.color_mode = "BW"
+            self.maskout.format.color_depth = "16"
+            self.maskout.format.compression = 0
         self.maskout.file_slots.remove(self.maskout.inputs['Image'])
         self.maskout.file_slots.new(filename)
         self.maskoutput = None
         self.mask = os.path.join(ctx.output, 'masks', filename)
 
+        if self.mask_mode == "index":
+            # write the object index pass directly, the pixel value is the instance number of the object
+            indexoutput = nodes['Render Layers'].outputs['IndexOB']
+            if self.mask_format == "PNG":
+                # 16 bit PNG maps [0,1] to [0,65535]
+                scalenode = nodes.new('CompositorNodeMath')
+                scalenode.name = 'maskscale'
+                scalenode.operation = 'DIVIDE'
+                scalenode.inputs[1].default_value = 65535
+                links.new(indexoutput, scalenode.inputs[0])
+                indexoutput = scalenode.outputs[0]
+            links.new(indexoutput, self.maskout.inputs[0])
+            self.maskoutput = indexoutput
+
         self.last_output = nodes['Render Layers'].outputs['Image']
         self.last_link = links.new(self.last_output, self.imgout.inputs[0])
 
@@ -115,13 +151,21 @@ class AnaScene:
         nodes = self.blender_scene.node_tree.nodes
         links = self.blender_scene.node_tree.links
 
-        obj.root.pass_index = obj.instance
-        children = [child.name for child in obj.root.children]
-        while len(children):
-            bpy.data.objects[children[0]].pass_index = obj.instance
-            for child in bpy.data.objects[children[0]].children:
-                children.append(child.name)
-            children.pop(0)
+        for item in obj.hierarchy:
+            item.pass_index = obj.instance
+            # the objects of an instanced collection are shared by every instance of it
+            if item.instance_type == 'COLLECTION' and item.instance_collection is not None:
+                for instanced in item.instance_collection.all_objects:
+                    instanced.pass_index = obj.instance
+
+        if not os.path.isdir(os.path.join(ctx.output, 'masks')):
+            os.mkdir(os.path.join(ctx.output, 'masks'))
+        obj.mask = os.path.join(ctx.output, f'masks/{ctx.interp_num:010}-#-{self.sensor_name}.{self.mask_extension}')
+        obj.mask_mode = self.mask_mode
+
+        if self.mask_mode == "index":
+            # the index pass already contains every object
+            return
 
         # maskroot = f'{ctx.interp_num:010}-{obj.root.name}-#'
         # self.maskout.file_slots.new(maskroot)
@@ -149,13 +193,14 @@ class AnaScene:
             links.new(addnode.outputs[0], self.maskout.inputs[0])
             self.maskoutput = addnode.outputs[0]
 
-        if not os.path.isdir(os.path.join(ctx.output, 'masks')):
-            os.mkdir(os.path.join(ctx.output, 'masks'))
-        obj.mask = os.path.join(ctx.output, f'masks/{ctx.interp_num:010}-#-{self.sensor_name}.png')
-
 
-    def write_ana_annotations(self, calculate_obstruction=False):
-        """ Creates an annotations file of the image in <output>/annotations/{imgfile}-ana.json """
+    def write_ana_annotations(self, calculate_obstruction=False, polygon_tolerance=0.0, segmentation="polygon"):
+        """
+        Creates an annotations file of the image in <output>/annotations/{imgfile}-ana.json
+        Segmentation polygons are simplified to within polygon_tolerance pixels of the mask outline (0 disables this).
+        segmentation selects what is written for each object: "polygon", "rle" (COCO run-length encoding in place
+        of the polygons) or "both" (polygons in "segmentation" and the run-length encoding in "rle").
+        """
         if not self.filename: self.filename = f'{ctx.interp_num:010}-{self.blender_scene.frame_current}-{self.sensor_name}.png'
         if not os.path.isdir(os.path.join(ctx.output, 'annotations')):
             os.mkdir(os.path.join(ctx.output, 'annotations'))
@@ -163,13 +208,20 @@ class AnaScene:
 
         logger.info(f"Writing annotations to: {annfile}")
 
+        # read the mask once and share it with the annotations of all objects
+        maskfile = f'{self.mask}.{self.mask_extension}'.replace('#', str(self.blender_scene.frame_current))
+        annotations.open_annotator(maskfile, polygon_tolerance=polygon_tolerance, segmentation=segmentation)
+
         # generate list of annotations
         ann_list = []
-        for obj in self.objects:
-            if obj.rendered and obj.ooi:
-                logger.debug(f"Generated annotation for {obj.root.name}")
-                ann = obj.dump_annotations(calculate_obstruction=calculate_obstruction)
-                if ann: ann_list.append(ann)
+        try:
+            for obj in self.objects:
+                if obj.rendered and obj.ooi:
+                    logger.debug(f"Generated annotation for {obj.root.name}")
+                    ann = obj.dump_annotations(calculate_obstruction=calculate_obstruction)
+                    if ann: ann_list.append(ann)
+        finally:
+            annotations.close_annotator()
 
         annotation_out = {
             "filename": self.filename,
@@ -178,6 +230,7 @@ class AnaScene:
 
         with open(annfile, 'w') as f:
             json.dump(annotation_out, f, indent=4)
+        ctx.add_output(annfile)
 
         # helper functions for creating annotation and segmentation images, helpful for debugging
         if loglevel == getattr(logging, 'DEBUG'):
@@ -189,10 +242,11 @@ class AnaScene:
             for obj in ann_list:
                 bbox = numpy.array(obj['bbox']).astype('int32')
                 imgdata = cv2.rectangle(imgdata, (bbox[0],bbox[1]), (bbox[0]+bbox[2],bbox[1]+bbox[3]), color=(0,255,0), thickness=1)
-                seg = numpy.array(obj['segmentation']).flatten()
-                pts = numpy.array(seg).reshape(int(len(seg)/2),2)
-                imgdata = cv2.polylines(imgdata, [pts.astype('int32')], True, color=(255,0,255), thickness=1)
-                segdata = cv2.fillPoly(segdata, [pts.astype('int32')], ctx.random.uniform(0,255,[3]))
+                if isinstance(obj['segmentation'], list):
+                    seg = numpy.array(obj['segmentation']).flatten()
+                    pts = numpy.array(seg).reshape(int(len(seg)/2),2)
+                    imgdata = cv2.polylines(imgdata, [pts.astype('int32')], True, color=(255,0,255), thickness=1)
+                    segdata = cv2.fillPoly(segdata, [pts.astype('int32')], ctx.random.uniform(0,255,[3]))
                 pts = numpy.array(obj['bbox3d']).reshape(int(len(obj['bbox3d'])/3),3)[:,:2]
                 imgdata = cv2.polylines(imgdata, [pts.astype('int32')], True, color=(0,0,255), thickness=1)
                 if not obj['centroid'][0] < 0 and not obj['centroid'][0] > imgdata.shape[0] and not obj['centroid'][1] < 0 and not obj['centroid'][1] > imgdata.shape[1]:
@@ -210,3 +264,4 @@ class AnaScene:
 
         with open(metafile, "w") as f:
             json.dump(self, f, cls=MetadataEncoder, indent=4)
+        ctx.add_output(metafile)
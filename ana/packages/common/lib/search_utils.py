@@ -11,12 +11,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
 import sys
 import logging
 import bpy
 
 logger = logging.getLogger(__name__)
 
+# the ".001" suffix blender adds to make object names unique
+NAME_SUFFIX = re.compile(r"\.\d{3,}$")
+
+
+def base_name(name):
+    """Return a datablock name without the numeric suffix blender adds to duplicates"""
+    return NAME_SUFFIX.sub("", name)
+
 
 def get_child_objects(model):
     """Return a list of all children of an object"""
@@ -27,7 +36,25 @@ def get_child_objects(model):
     return children
 
 
-def find_object(model, qname):
+def index_hierarchy(root):
+    """
+    Return the objects of a hierarchy, parents before their children, and a dictionary of them
+    indexed by their path of base names below the root, e.g. ("Right_Wing", "Flap"). When children
+    share a base name the first one is indexed, as find_object would find it.
+    """
+    hierarchy = []
+    index = {}
+    stack = [((), root)]
+    while stack:
+        path, obj = stack.pop()
+        hierarchy.append(obj)
+        index.setdefault(path, obj)
+        # push children in reverse so they are visited in order
+        stack.extend((path + (base_name(child.name),), child) for child in reversed(obj.children))
+    return hierarchy, index
+
+
+def find_object(model, qname, index=None):
     """
     Search an object hierarchy for a qualified object name. Return a pointer to the object. 
     Example:
@@ -39,13 +66,16 @@ def find_object(model, qname):
 
         will return the "rotodome.003" object in the "Boeing_E3.003" hierarchy.
 
+    To look up several objects without walking the hierarchy each time, pass the index
+    of the model from index_hierarchy. Names that aren't in the index are searched by prefix.
     """
     
     if not model.name.startswith(qname[0]):
         # top object in model doesn't match qname
         logger.critical("Top object in model '%s' is not named %s", model.name, qname[0])
         sys.exit(1)
-    else:
+    obj = index.get(tuple(qname[1:])) if index is not None else None
+    if obj is None:
         obj = model
         # find subsequent qnames
         for level in range(1, len(qname)):
@@ -63,18 +93,16 @@ def find_object(model, qname):
     # if all levels matched then we found the object
     return obj
 
-def find_mesh(model, qname, mesh_prefix):
-    """Find a mesh that is attached to a qualified object name"""
+def find_mesh(model, qname, mesh_prefix, index=None):
+    """Find a mesh that is attached to a qualified object name, see find_object for the index"""
 
     # find the object by its qualified name
-    obj = find_object(model, qname)
+    obj = find_object(model, qname, index)
 
-    # check if any meshes matching the prefix are associated with the target object
+    # check if the mesh of the target object matches the prefix
     mesh_found = None
-    for mesh in bpy.data.meshes:
-        if mesh.name.startswith(mesh_prefix):
-            if obj.data == mesh:
-                mesh_found = mesh
+    if isinstance(obj.data, bpy.types.Mesh) and obj.data.name.startswith(mesh_prefix):
+        mesh_found = obj.data
 
     # either no mesh matched the prefix or none of the matching meshes were associated with the object
     if not mesh_found:
@@ -86,9 +114,9 @@ def find_mesh(model, qname, mesh_prefix):
 def find_material(material_name):
     """Find material by name"""
 
-    for mat in bpy.data.materials:
-        if mat.name == material_name:
-            return mat
+    mat = bpy.data.materials.get(material_name)
+    if mat is not None:
+        return mat
 
     # couldn't find a material with that name
     logger.critical("Couldn't find material named '%s'", material_name)
@@ -97,12 +125,10 @@ def find_material(material_name):
 def find_root(collection):
     """Find the root object in a collection"""
 
-    # find the object that has no parent
-    children = []
+    # find the object that has no parent in the collection
     all_objects = list(collection.all_objects)
-    for parent in all_objects:
-        children.extend(list(parent.children))
-    roots = list(set(all_objects) - set(children))
+    members = set(all_objects)
+    roots = [obj for obj in all_objects if obj.parent is None or obj.parent not in members]
 
     # there should only be one root
     if len(roots) == 0:
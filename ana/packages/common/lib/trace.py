@@ -0,0 +1,149 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Timeline instrumentation for Ana runs.
+
+Spans are recorded as Chrome trace events that can be opened with chrome://tracing
+or https://ui.perfetto.dev. Tracing is off by default; when it is off a span costs a
+single flag check, so instrumentation can stay in production code.
+
+    import ana.packages.common.lib.trace as trace
+
+    with trace.span("bake", frames=250):
+        bpy.ops.ptcache.bake_all()
+
+    @trace.traced()
+    def compute_polygons(obj):
+        ...
+"""
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import functools
+import collections
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+trace_file = None
+# most spans kept for the trace file, older spans are dropped in long batch or daemon runs
+MAX_EVENTS = 200000
+# recorded spans: (name, category, start, end, thread id, args)
+events = collections.deque(maxlen=MAX_EVENTS)
+# number, total and longest duration of all spans by name, including the dropped ones
+totals = {}
+# number of spans dropped from events
+dropped = 0
+_lock = threading.Lock()
+_origin = time.perf_counter()
+
+
+def enable(filename):
+    """ Start recording spans. The trace is written and a summary printed when the process exits. """
+    globals()['trace_file'] = filename
+    if not enabled:
+        atexit.register(finish)
+    globals()['enabled'] = True
+
+
+@contextmanager
+def span(name, category="ana", **args):
+    """ Record the time spent in the body of the with statement. Spans can be nested. """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, category, start, time.perf_counter(), args)
+
+
+def record(name, category, start, end, args):
+    """ Add a span to the events and the summary totals """
+    global dropped
+    with _lock:
+        if len(events) == events.maxlen:
+            dropped += 1
+        events.append((name, category, start, end, threading.get_ident(), args))
+        count, total, longest = totals.get(name, (0, 0.0, 0.0))
+        duration = end - start
+        totals[name] = (count + 1, total + duration, max(longest, duration))
+
+
+def traced(name=None, category="ana"):
+    """ Decorator that records a span for every call of the function """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write(filename):
+    """ Write the recorded spans in Chrome trace event format """
+    pid = os.getpid()
+    trace_events = []
+    with _lock:
+        recorded = list(events)
+    if dropped:
+        logger.warning("The trace only holds the last %d spans, %d earlier spans were dropped", len(recorded), dropped)
+    for name, category, start, end, tid, args in recorded:
+        trace_events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - _origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": tid,
+            "args": {key: str(value) for key, value in args.items()}
+        })
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def summary():
+    """ Return a table of the total, mean and max time per span name, slowest first """
+    with _lock:
+        totals_copy = dict(totals)
+
+    width = max([len(name) for name in totals_copy] + [4])
+    lines = ["{:<{w}}  {:>7}  {:>10}  {:>10}  {:>10}".format("span", "count", "total(s)", "mean(s)", "max(s)", w=width)]
+    for name, (count, total, longest) in sorted(totals_copy.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append("{:<{w}}  {:>7}  {:>10.3f}  {:>10.3f}  {:>10.3f}".format(
+            name, count, total, total / count, longest, w=width))
+    return "\n".join(lines)
+
+
+def finish():
+    """ Write the trace file and print the summary """
+    if not events:
+        return
+    try:
+        write(trace_file)
+        logger.info("Wrote trace to %s", trace_file)
+    except OSError as e:
+        logger.error("Failed to write trace file '%s': %s", trace_file, e)
+    print(summary())
@@ -0,0 +1,244 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A local disk cache for files on data volumes.
+
+Files are stored under the sha256 of their contents, so a file is copied once no matter
+how many volumes or paths refer to it. The size and mtime of each source file are recorded
+with its hash, so an unchanged source is not read again. Processes using the same cache
+directory share it, and the least recently used files are removed when the cache grows
+beyond its size limit.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import ana.packages.common.lib.trace as trace
+try:
+    import fcntl
+except ImportError:
+    # no locking between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# bump when the format of the index changes
+INDEX_VERSION = 1
+# bytes read at a time when copying a file into the cache
+COPY_CHUNK = 1 << 22
+
+
+class PrefetchCancelled(Exception):
+    """ Raised in a background copy when the prefetches are cancelled """
+
+
+class VolumeCache:
+    """ Content addressed cache of volume files in a local directory """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.files_dir = os.path.join(self.cache_dir, "files")
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        self.lock_file = os.path.join(self.cache_dir, "lock")
+        os.makedirs(self.files_dir, exist_ok=True)
+        # guards the index between threads, the lock file guards it between processes
+        self.index_lock = threading.Lock()
+        # guards the attributes below
+        self.lock = threading.Lock()
+        # sources resolved by this process: path -> (size, mtime_ns, cached path)
+        self.resolved = {}
+        # prefetches that haven't been claimed yet, indexed by source path
+        self.futures = {}
+        self.executor = None
+        # set to stop the copies of the current executor
+        self.cancelled = None
+        self.stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_copied": 0}
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        """ Lock the cache and yield its index, the index is saved when the block exits without an error """
+        with self.index_lock, open(self.lock_file, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {"version": INDEX_VERSION, "sources": {}, "files": {}}
+                try:
+                    with open(self.index_file, "r") as f:
+                        saved = json.load(f)
+                    if saved.get("version") == INDEX_VERSION:
+                        index = saved
+                except (OSError, ValueError):
+                    pass
+                yield index
+                fd, tmpfile = tempfile.mkstemp(dir=self.cache_dir)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(index, f)
+                os.replace(tmpfile, self.index_file)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, path):
+        """
+        Return the path of the cached copy of a file, copying it into the cache if needed.
+        Files that can't be cached are used in place.
+        """
+        with self.lock:
+            future = self.futures.pop(path, None)
+        if future is not None:
+            try:
+                return future.result()
+            except (PrefetchCancelled, CancelledError):
+                pass
+        return self.resolve(path)
+
+    def prefetch(self, paths):
+        """
+        Copy files into the cache in a background thread, get() waits for a file that is still being copied.
+        Call cancel_prefetch() when the files are no longer needed, the thread keeps the process alive.
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="volume-prefetch")
+                self.cancelled = threading.Event()
+            for path in paths:
+                if path not in self.futures:
+                    self.futures[path] = self.executor.submit(self.resolve, path, self.cancelled)
+
+    def cancel_prefetch(self):
+        """ Drop the files that haven't been prefetched and stop the copy in progress """
+        with self.lock:
+            executor, cancelled = self.executor, self.cancelled
+            self.executor = self.cancelled = None
+            self.futures = {}
+        if executor is not None:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def resolve(self, path, cancelled=None):
+        """ Look a file up in the cache and copy it in on a miss """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # not a file, or not there, let the caller report it
+            return path
+        if not os.path.isfile(path) or stat.st_size > self.max_bytes:
+            return path
+        source = os.path.abspath(path)
+        try:
+            with self.lock:
+                resolved = self.resolved.get(source)
+            if resolved is not None and resolved[:2] == (stat.st_size, stat.st_mtime_ns) and os.path.isfile(resolved[2]):
+                # already counted when it was first resolved
+                return resolved[2]
+
+            with self.locked_index() as index:
+                cached = self.lookup(index, source, stat)
+            if cached is not None:
+                self.count(hit=True, size=stat.st_size)
+            else:
+                with trace.span("cache volume file", "load", path=source, size=stat.st_size):
+                    cached = self.copy(source, stat, cancelled)
+                self.count(hit=False, size=stat.st_size)
+            with self.lock:
+                self.resolved[source] = (stat.st_size, stat.st_mtime_ns, cached)
+            return cached
+        except OSError as e:
+            logger.warning("Can't cache volume file '%s': %s", path, e)
+            return path
+
+    def lookup(self, index, source, stat):
+        """ Return the cached path of an unchanged source file and mark it as used, None on a miss """
+        entry = index["sources"].get(source)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        name = entry["name"]
+        cached = os.path.join(self.files_dir, name)
+        if name not in index["files"] or not os.path.isfile(cached):
+            return None
+        index["files"][name]["last_used"] = time.time()
+        return cached
+
+    def copy(self, source, stat, cancelled=None):
+        """
+        Copy a file into the cache, hashing it on the way, and return the cached path.
+        Raises PrefetchCancelled when the cancelled event is set during the copy.
+        """
+        sha = hashlib.sha256()
+        fd, tmpfile = tempfile.mkstemp(dir=self.files_dir)
+        try:
+            with open(source, "rb") as src, os.fdopen(fd, "wb") as dst:
+                for chunk in iter(lambda: src.read(COPY_CHUNK), b""):
+                    if cancelled is not None and cancelled.is_set():
+                        raise PrefetchCancelled(source)
+                    sha.update(chunk)
+                    dst.write(chunk)
+            # keep the extension, blender expects .blend files
+            name = sha.hexdigest() + os.path.splitext(source)[1]
+            cached = os.path.join(self.files_dir, name)
+            with self.locked_index() as index:
+                # the same contents may already be cached from another path or process
+                if name in index["files"] and os.path.isfile(cached):
+                    os.remove(tmpfile)
+                else:
+                    os.replace(tmpfile, cached)
+                index["files"][name] = {"size": stat.st_size, "last_used": time.time()}
+                index["sources"][source] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "name": name}
+                self.evict(index, keep=name)
+            return cached
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def evict(self, index, keep):
+        """ Remove the least recently used files until the cache fits in its size limit """
+        files = index["files"]
+        total = sum(entry["size"] for entry in files.values())
+        for name in sorted(files, key=lambda name: files[name]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.files_dir, name))
+            total -= files.pop(name)["size"]
+            logger.info("Removed '%s' from the volume cache", name)
+        for source in [source for source, entry in index["sources"].items() if entry["name"] not in files]:
+            del index["sources"][source]
+
+    def count(self, hit, size):
+        """ Update the hit and byte counters, each file is counted once per process """
+        with self.lock:
+            if hit:
+                self.stats["hits"] += 1
+                self.stats["bytes_saved"] += size
+            else:
+                self.stats["misses"] += 1
+                self.stats["bytes_copied"] += size
+
+    def summary(self):
+        """ Return a line describing the cache hit rate and the bytes it saved """
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        return "Volume cache: {} files found, {} copied ({:.0%} hit rate), {:.1f}MB saved, {:.1f}MB copied".format(
+            stats["hits"], stats["misses"], stats["hits"] / lookups if lookups else 0,
+            stats["bytes_saved"] / 2**20, stats["bytes_copied"] / 2**20)
@@ -11,7 +11,6 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import sys
 import logging
 from ana.packages.common.lib.node import Node
 
@@ -39,6 +38,7 @@ class ConditionalSelector(Node):
             if a > b:   value = t
             else:       value = f
         else:
-            logger.error("Encountered invalid value for Operator: {}. Exiting...".format(operator))
-            sys.exit(1)
+            # this node may run in the node thread pool, so report the error instead of exiting the process
+            logger.error("Encountered invalid value for Operator: {}".format(operator))
+            raise ValueError("Invalid Operator '{}'".format(operator))
         return {"Value": value}
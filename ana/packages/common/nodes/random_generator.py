@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-import ana.packages.common.lib.context as ctx
 from ana.packages.common.lib.node import Node
 
 logger = logging.getLogger(__name__)
@@ -58,7 +57,7 @@ class RandomTriangular(Node):
         size = _none_or_int_or_list(self.inputs["size"][0])
 
         # draw samples
-        out = ctx.random.triangular(left, mode, right, size)
+        out = self.rng().triangular(left, mode, right, size)
 
         logger.debug("samples = %s", out)
 
@@ -80,7 +79,7 @@ class RandomUniform(Node):
         size = _none_or_int_or_list(self.inputs["size"][0])
 
         # draw samples
-        out = ctx.random.uniform(low, high, size)
+        out = self.rng().uniform(low, high, size)
 
         logger.debug("samples = %s", out)
 
@@ -89,7 +88,7 @@ class RandomUniform(Node):
 class RandomRandint(Node):
     """
     Return random integers from low (inclusive) to high (exclusive).
-    See numpy.random.randint for details.
+    See numpy.random.Generator.integers for details.
     """
 
     def exec(self):
@@ -102,7 +101,7 @@ class RandomRandint(Node):
         size = _none_or_int_or_list(self.inputs["size"][0])
 
         # draw samples
-        out = ctx.random.randint(low, high, size)
+        out = self.rng().integers(low, high, size)
 
         logger.debug("samples = %s", out)
 
@@ -124,7 +123,7 @@ class RandomNormal(Node):
         size = _none_or_int_or_list(self.inputs["size"][0])
 
         # draw samples
-        out = ctx.random.normal(loc, scale, size)
+        out = self.rng().normal(loc, scale, size)
 
         logger.debug("samples = %s", out)
 
@@ -139,6 +138,6 @@ class RandomChoice(Node):
         choice_list = list(self.inputs["List_of_Choices"][0])
         number = int(self.inputs["Number_of_Choices"][0])
         unique = str(self.inputs["Unique_Choices"][0])
-        if unique is "True":    choices = ctx.random.choice(choice_list, number, replace=False) 
-        else:                   choices = ctx.random.choice(choice_list, number, replace=True) 
+        if unique == "True":    choices = self.rng().choice(choice_list, number, replace=False)
+        else:                   choices = self.rng().choice(choice_list, number, replace=True)
         return {"Choices": choices}
@@ -13,7 +13,9 @@
 # limitations under the License.
 import bpy
 from ana.packages.common.lib.node import Node
-from ana.packages.common.lib.generator import CreateBranchGenerator
+from ana.packages.common.lib.generator import CreateBranchGenerator, compile_generator
+from ana.packages.common.lib.load import preload
+import ana.packages.common.lib.trace as trace
 import logging
 
 logger = logging.getLogger(__name__)
@@ -32,12 +34,15 @@ class DropObjectsNode(Node):
             objects = self.inputs["Objects"][0]
 
             #Pick a link when more than one is provided
-            container_generator = CreateBranchGenerator(self.inputs["Container Generator"])
-            floor_generator = CreateBranchGenerator(self.inputs["Floor Generator"])
+            container_program = compile_generator(CreateBranchGenerator(self.inputs["Container Generator"]))
+            floor_program = compile_generator(CreateBranchGenerator(self.inputs["Floor Generator"]))
+            container_path = container_program.sample()
+            floor_path = floor_program.sample()
 
-            #Create the container and floor
-            container = container_generator.exec()
-            floor = floor_generator.exec()
+            #Load what both need before creating the container and floor
+            preload(container_program.requirements([container_path]) | floor_program.requirements([floor_path]))
+            container = container_program.exec_path(container_path)
+            floor = floor_program.exec_path(floor_path)
 
             #Let's make sure we have a rigid body world going.
             bpy.ops.rigidbody.world_add()
@@ -72,7 +77,8 @@ class DropObjectsNode(Node):
             sc.frame_current = 250
 
             #Before we go, let's bake the physics
-            bpy.ops.ptcache.bake_all()
+            with trace.span("bake_all", "bpy", objects=len(objects)):
+                bpy.ops.ptcache.bake_all()
         except Exception as e:
             logger.error("{} in \"{}\": \"{}\"".format(type(e).__name__, type(self).__name__, e).replace("\n", ""))
             raise
@@ -202,8 +202,8 @@ class ContainerNode(Node):
             box_type = self.inputs["Container Type"][0]
             if box_type == "<random>":
                 # select a random container
-                select_list = [portdef["select"] for portdef in self.schema["inputs"] if
-                               portdef.get('name') == "Container Type"][0]
+                select_list = list([portdef["select"] for portdef in self.schema["inputs"] if
+                                    portdef.get('name') == "Container Type"][0])
                 select_list.remove("<random>")
                 box_type = ctx.random.choice(select_list)
                 while box_type in ['Tall Basket', 'Short Basket']:
@@ -227,8 +227,8 @@ class FloorNode(Node):
             floor_type = self.inputs["Floor Type"][0]
             if floor_type == "<random>":
                 # select a random floor
-                select_list = [portdef["select"] for portdef in self.schema["inputs"] if
-                               portdef.get('name') == "Floor Type"][0]
+                select_list = list([portdef["select"] for portdef in self.schema["inputs"] if
+                                    portdef.get('name') == "Floor Type"][0])
                 select_list.remove("<random>")
                 floor_type = ctx.random.choice(select_list)
         except Exception as e:
@@ -13,9 +13,9 @@
 # limitations under the License.
 import math
 from ana.packages.common.lib.node import Node
-from ana.packages.common.lib.generator import CreateBranchGenerator
+from ana.packages.common.lib.generator import CreateBranchGenerator, compile_generator
 import ana.packages.common.lib.context as ctx
-import numpy as np
+from ana.packages.common.lib.load import preload
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,13 +33,19 @@ class RandomPlacementClass(Node):
         try:
             # First we grab the generator method from the inputs
             branch_generator = CreateBranchGenerator(self.inputs["Object Generators"])
+            # flatten the generator tree so each object is a single draw
+            program = compile_generator(branch_generator)
 
             object_number = min(200, int(self.inputs["Number of Objects"][0]))
 
             object_list = []
 
-            for ii in np.arange(object_number):
-                this_object = branch_generator.exec() #Picks a new branch from the inputs and executes it
+            # pick the path for every object at once, then open each blender file they need once
+            paths = program.sample(object_number)
+            preload(program.requirements(paths))
+
+            for ii, path in enumerate(paths):
+                this_object = program.exec_path(path) #Executes the path picked from the inputs
                 object_list.append(this_object)
                 #.root is the actual blender object
                 this_object.root.location = (
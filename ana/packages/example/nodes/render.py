@@ -12,17 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import bpy
+import mathutils
+from bpy_extras.object_utils import world_to_camera_view
 import ana.packages.common.lib.context as ctx
 from ana.packages.common.lib.node import Node
 from ana.packages.common.lib.scene import AnaScene
+from ana.packages.common.lib.bbox import read_mask
+from ana.packages.common.lib.amodal import compute_amodal_mask
+from ana.packages.common.lib.camera_checks import cull_objects_outside_camera
+import ana.packages.common.lib.trace as trace
 import logging
 import imageio
 import os
 import numpy
 import glob
+import math
 
 logger = logging.getLogger(__name__)
 
+# pixels added around the projected bounds of an object when rendering its solo mask
+SOLO_BORDER_PADDING = 4
+
 
 class RenderNode(Node):
     """
@@ -39,6 +49,12 @@ class RenderNode(Node):
             #We do not expect more than one DropObjects node to be ported to here, but the input is still a list.
             objects = self.inputs["Objects of Interest"][0]
 
+            #Check the annotation settings before spending time on the render
+            segmentation = self.inputs["Segmentation"][0]
+            if segmentation not in ("polygon", "rle", "both"):
+                raise ValueError("Segmentation must be polygon, rle or both, got '{}'".format(segmentation))
+            polygon_tolerance = float(self.inputs["Polygon Tolerance"][0])
+
             calculate_obstruction = True
             resolution = 'high'
             if ctx.preview:
@@ -66,7 +82,9 @@ class RenderNode(Node):
 
             cam1 = bpy.data.cameras.new("Camera 1")
             cam_obj1 = bpy.data.objects.new("Camera 1", cam1)
-            height = ctx.random.triangular(.5, 0.65, 1)
+            # the camera has its own random stream so other nodes don't move it
+            rng = self.rng("camera")
+            height = rng.triangular(.5, 0.65, 1)
 
             # Location is offset from center
             cam_obj1.location = (.15, -.15, height)
@@ -76,7 +94,7 @@ class RenderNode(Node):
 
             # Azimuthal rotation limit based on height
             z_abs_max = heightScale/2 + 0.5  # between 0.5 and 1
-            zval = ctx.random.uniform(-1*z_abs_max, z_abs_max)
+            zval = rng.uniform(-1*z_abs_max, z_abs_max)
             zScale = (zval + 1) / 2  # between 0 and 1
 
             xmin = 0.15
@@ -84,10 +102,10 @@ class RenderNode(Node):
             ymin = 0.15
             ymax = 0.15 + heightScale*(0.15 + .4*(1 - zScale))  # between .7 and .3 when no height scaling
             if zval > 0:  # The Y rotation is throttled
-                xval = ctx.random.uniform(xmin, xmax)
+                xval = rng.uniform(xmin, xmax)
                 yval = 0.15
             else:  # The X rotation is throttled
-                yval = ctx.random.uniform(ymin, ymax)
+                yval = rng.uniform(ymin, ymax)
                 xval = 0.15
             cam_obj1.rotation_euler = (xval, yval, zval)
 
@@ -95,6 +113,12 @@ class RenderNode(Node):
 
             scn.camera = cam_obj1
 
+            #Hide objects that are completely outside the camera view so Cycles has less to build
+            if self.inputs["Cull Objects Outside Camera"][0] == "True":
+                bpy.context.view_layer.update()
+                culled = cull_objects_outside_camera(objects, cam_obj1)
+                logger.info("Culled {} objects outside the camera view".format(len(culled)))
+
             #camera_constraint = cam_obj1.constraints.new(type='TRACK_TO')
             #target_object = objects[ctx.random.randint(1, len(objects))]
             #camera_constraint.target = target_object.root
@@ -106,7 +130,8 @@ class RenderNode(Node):
                 blender_scene=scn,
                 annotation_view_layer=bpy.context.view_layer,
                 objects=objects,
-                sensor_name=sensor_name)
+                sensor_name=sensor_name,
+                mask_mode="index")
 
             #Add denoise node to compositor
             s = bpy.data.scenes[ctx.channel.name]
@@ -131,68 +156,43 @@ class RenderNode(Node):
             imgfilename = f"{ctx.interp_num:010}-{scn.frame_current}-{sensor_name}.png"
             preview = imageio.imread(os.path.join(ctx.output,'images',imgfilename))
             imageio.imsave(os.path.join(ctx.output,'preview.png'), preview)
+            ctx.add_output(os.path.join(ctx.output,'images',imgfilename))
+            ctx.add_output(f'{scene.mask}.{scene.mask_extension}'.replace('#', str(scn.frame_current)))
+            ctx.add_output(os.path.join(ctx.output,'preview.png'))
 
             if not calculate_obstruction:
                 if not ctx.preview:
                     # just create annotations
-                    scene.write_ana_annotations(calculate_obstruction=calculate_obstruction)
+                    scene.write_ana_annotations(calculate_obstruction=calculate_obstruction,
+                                                polygon_tolerance=polygon_tolerance, segmentation=segmentation)
                     scene.write_ana_metadata()
                 return {}
-            #Render masks for each object.
-            #only render a mask file for objects in the image
-
-            #Unlink all the object masks in the compositor
-            links = scn.node_tree.links
-            masknodes = [node for node in scn.node_tree.nodes if node.name.split('_')[-1]=='mask']
-            masklinks = {}
-            for masknode in masknodes:
-                masklinks[masknode.index] = {
-                    'masknode': masknode,
-                    'socketinput': masknode.outputs[0].links[0].to_socket
-                }
-                links.remove(masknode.outputs[0].links[0])
-            #Unlink the image from the compositor
-            for link in scn.node_tree.nodes['Render Layers'].outputs['Image'].links:
-                links.remove(link)
-
             masktemplate = os.path.join(scene.maskout.base_path,
-                                        scene.maskout.file_slots[0].path + '.' + scene.maskout.format.file_format.lower())
+                                        scene.maskout.file_slots[0].path + '.' + scene.mask_extension)
 
-            #Only render a mask file for objects in the image
+            #Only annotate objects in the image
             compositemaskfile = masktemplate.replace('#', str(scn.frame_current))
-            compimg = imageio.imread(compositemaskfile)
+            compimg = read_mask(compositemaskfile)
             allmasks = compimg[numpy.nonzero(compimg)]
             renderedobjectidxs = numpy.unique(allmasks)
             renderedobjects = [obj for obj in objects if obj.instance in renderedobjectidxs]
-
-            #Hide all but a single object and render a mask
             for obj in objects:
-                obj.root.hide_render = True
                 if obj not in renderedobjects:
                     obj.rendered = False
 
             imgpath = scene.imgout.file_slots[0].path
             maskpath = scene.maskout.file_slots[0].path
-            for obj in renderedobjects:
-                obj.solo_mask_id = f'obj{obj.instance:03}'
-                scene.maskout.file_slots[0].path = '{}-{}'.format(maskpath, obj.solo_mask_id)
-                scene.imgout.file_slots[0].path = '{}-{}'.format(imgpath, obj.solo_mask_id)
-
-                obj.root.hide_render = False
-
-                # link the ID mask node to it's divide node
-                masknode = masklinks[obj.instance]['masknode']
-                socketinput = masklinks[obj.instance]['socketinput']
-                links.new(masknode.outputs['Alpha'], socketinput)
-
-                render(resolution='low')
-
-                # rehide object
-                obj.root.hide_render = True
-                links.remove(masknode.outputs[0].links[0])
+            if self.inputs["Obstruction Method"][0] == "amodal":
+                #Rasterize the meshes of each object instead of rendering it on its own
+                for obj in renderedobjects:
+                    obj.amodal_pixels = int(numpy.count_nonzero(compute_amodal_mask(obj, scn)))
+            else:
+                #Render a mask for each object in the image
+                self.render_solo_masks(scn, scene, objects, renderedobjects)
 
             #Create annotations
-            scene.write_ana_annotations(calculate_obstruction=calculate_obstruction)
+            scene.write_ana_annotations(calculate_obstruction=calculate_obstruction,
+                                        polygon_tolerance=polygon_tolerance, segmentation=segmentation)
             scene.write_ana_metadata()
 
             print("Number Objects Rendered: {}".format(len([o for o in objects if o.rendered])))
@@ -211,6 +211,99 @@ class RenderNode(Node):
 
         return {}
 
+    def render_solo_masks(self, scn, scene, objects, renderedobjects):
+        """Render a mask for each object in the image with all other objects hidden"""
+        #Unlink all the object masks in the compositor
+        links = scn.node_tree.links
+        masknodes = [node for node in scn.node_tree.nodes if node.name.split('_')[-1]=='mask']
+        masklinks = {}
+        for masknode in masknodes:
+            masklinks[masknode.index] = {
+                'masknode': masknode,
+                'socketinput': masknode.outputs[0].links[0].to_socket
+            }
+            links.remove(masknode.outputs[0].links[0])
+        #Unlink the image from the compositor
+        for link in scn.node_tree.nodes['Render Layers'].outputs['Image'].links:
+            links.remove(link)
+
+        #Hide all but a single object and render a mask
+        for obj in objects:
+            obj.root.hide_render = True
+
+        #Only render the region of the image around each object
+        width = int(scn.render.resolution_x * scn.render.resolution_percentage / 100)
+        height = int(scn.render.resolution_y * scn.render.resolution_percentage / 100)
+        scn.render.use_crop_to_border = True
+
+        imgpath = scene.imgout.file_slots[0].path
+        maskpath = scene.maskout.file_slots[0].path
+        try:
+            for obj in renderedobjects:
+                obj.solo_mask_id = f'obj{obj.instance:03}'
+                scene.maskout.file_slots[0].path = '{}-{}'.format(maskpath, obj.solo_mask_id)
+                scene.imgout.file_slots[0].path = '{}-{}'.format(imgpath, obj.solo_mask_id)
+
+                region = solo_border(scn, obj, width, height)
+                if region is None:
+                    scn.render.use_border = False
+                    obj.solo_mask_region = None
+                else:
+                    # Blender truncates border * resolution, so aim at pixel centers to get exact pixels
+                    xmin, ymin, xmax, ymax = region
+                    scn.render.use_border = True
+                    scn.render.border_min_x = (xmin + 0.5) / width
+                    scn.render.border_max_x = min(1.0, (xmax + 0.5) / width)
+                    scn.render.border_min_y = (ymin + 0.5) / height
+                    scn.render.border_max_y = min(1.0, (ymax + 0.5) / height)
+                    # image rows count down from the top, the border counts up from the bottom
+                    obj.solo_mask_region = (height - ymax, xmin)
+
+                obj.root.hide_render = False
+
+                # link the ID mask node to it's divide node, in index mode the index pass is already linked
+                if obj.instance in masklinks:
+                    masknode = masklinks[obj.instance]['masknode']
+                    socketinput = masklinks[obj.instance]['socketinput']
+                    links.new(masknode.outputs['Alpha'], socketinput)
+
+                render(resolution='low')
+
+                # rehide object
+                obj.root.hide_render = True
+                if obj.instance in masklinks:
+                    links.remove(masknode.outputs[0].links[0])
+        finally:
+            scn.render.use_border = False
+            scn.render.use_crop_to_border = False
+
+
+def solo_border(scn, obj, width, height, padding=SOLO_BORDER_PADDING):
+    """
+    Return the pixel region (xmin, ymin, xmax, ymax) around the projected bounds of an object,
+    counted from the bottom left of the image with xmax and ymax exclusive.
+    Returns None if the object reaches behind the camera and the full frame has to be rendered.
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    xs, ys = [], []
+    for mesh_object in obj.mesh_objects:
+        evaluated = mesh_object.evaluated_get(depsgraph)
+        for corner in evaluated.bound_box:
+            co = world_to_camera_view(scn, scn.camera, evaluated.matrix_world @ mathutils.Vector(corner))
+            if co.z <= 0:
+                return None
+            xs.append(co.x * width)
+            ys.append(co.y * height)
+    if not xs:
+        return None
+    xmin = max(0, math.floor(min(xs)) - padding)
+    ymin = max(0, math.floor(min(ys)) - padding)
+    xmax = min(width, math.ceil(max(xs)) + padding)
+    ymax = min(height, math.ceil(max(ys)) + padding)
+    if xmin >= xmax or ymin >= ymax:
+        return None
+    return xmin, ymin, xmax, ymax
+
 
 def render(resolution='high'):
     # The render patch size, 256 is best for GPU
@@ -239,4 +332,5 @@ def render(resolution='high'):
 
     
 
-    bpy.ops.render.render('INVOKE_DEFAULT')
+    with trace.span("render " + resolution, "bpy"):
+        bpy.ops.render.render('INVOKE_DEFAULT')
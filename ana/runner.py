@@ -0,0 +1,227 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import os
+import re
+import argparse
+import collections
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# status line printed by ana.py for each run of a batch
+RUN_STATUS = re.compile(r"^Run (\d+): (ok|failed) Elapsed Time: ([0-9.]+)sec")
+# printed by ana.py when it stops a batch early, the runs that didn't start are requeued
+BATCH_STOPPED = re.compile(r"^Stopped batch after run (\d+)")
+
+
+class Runner:
+    """
+    Run interp_num values across a number of Blender worker processes.
+
+    Each worker process runs a batch of interp_num values taken from the front of a shared
+    queue. Batches shrink as the queue empties so the workers finish at about the same time.
+    A worker process is replaced after its batch, so jobs_per_worker and max_rss bound how
+    long a single Blender process lives. Runs that crash the worker or fail are put back
+    on the queue until they have been tried retries + 1 times.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.pending = collections.deque(range(args.start, args.start + args.count))
+        self.attempts = collections.Counter()
+        self.running = 0
+        self.done = []
+        self.failed = []
+        self.lock = threading.Lock()
+        self.starttime = time.time()
+
+    def take_batch(self):
+        """ Take the next batch of interp_num values from the queue """
+        with self.lock:
+            size = -(-len(self.pending) // self.args.workers)
+            size = max(1, min(self.args.jobs_per_worker, size))
+            batch = [self.pending.popleft() for _ in range(min(size, len(self.pending)))]
+            self.running += len(batch)
+            return batch
+
+    def finish(self, interp_num, status, elapsed):
+        """ Record the outcome of a single run """
+        with self.lock:
+            self.running -= 1
+            self.attempts[interp_num] += 1
+            if status == "ok":
+                self.done.append(interp_num)
+            elif self.attempts[interp_num] <= self.args.retries:
+                logger.warning("interp_num %d %s, retrying", interp_num, status)
+                self.pending.append(interp_num)
+            else:
+                logger.error("interp_num %d %s after %d attempts", interp_num, status, self.attempts[interp_num])
+                self.failed.append(interp_num)
+            minutes = (time.time() - self.starttime) / 60
+            print('Progress: {}/{} done, {} failed, {:.1f} images/min, last run {:.3f}sec'.format(
+                len(self.done), self.args.count, len(self.failed), len(self.done) / minutes, elapsed), flush=True)
+
+    def requeue(self, interp_nums):
+        """ Put runs that never started back on the queue """
+        with self.lock:
+            self.running -= len(interp_nums)
+            self.pending.extendleft(reversed(interp_nums))
+
+    def command(self, listfile):
+        """ Return the Blender command line for a worker """
+        args = self.args
+        threads = max(1, args.threads // args.workers)
+        command = [
+            args.blender, "--background", "--threads", str(threads),
+            "--python", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ana.py"), "--",
+            "--graph", args.graph,
+            "--channel", args.channel,
+            "--seed", str(args.seed),
+            "--interp_list", listfile,
+            "--output", args.output,
+            "--data", args.data,
+            "--loglevel", args.loglevel]
+        if args.preview:
+            command.append("--preview")
+        if args.max_rss is not None:
+            command.extend(["--max_rss", str(args.max_rss)])
+        if args.cache_dir is not None:
+            command.extend(["--cache_dir", args.cache_dir, "--cache_size", str(args.cache_size)])
+            if args.prefetch:
+                command.append("--prefetch")
+        return command
+
+    def run_batch(self, batch):
+        """ Run a batch of interp_num values in a new Blender process """
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write("\n".join(str(interp_num) for interp_num in batch))
+            listfile = f.name
+        remaining = list(batch)
+        stopped = False
+        tail = collections.deque(maxlen=20)
+        try:
+            process = subprocess.Popen(
+                self.command(listfile), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, bufsize=1)
+            for line in process.stdout:
+                tail.append(line.rstrip())
+                if BATCH_STOPPED.match(line):
+                    stopped = True
+                    continue
+                match = RUN_STATUS.match(line)
+                if match is None:
+                    continue
+                interp_num = int(match.group(1))
+                if interp_num in remaining:
+                    remaining.remove(interp_num)
+                    self.finish(interp_num, match.group(2), float(match.group(3)))
+            returncode = process.wait()
+        finally:
+            os.remove(listfile)
+
+        if remaining and returncode != 0:
+            # the first run that didn't report was running when the worker died, the rest never started
+            logger.error("Worker exited with code %d during interp_num %d:\n%s",
+                         returncode, remaining[0], "\n".join(tail))
+            self.finish(remaining.pop(0), "crashed", 0.0)
+            self.requeue(remaining)
+        elif remaining and stopped:
+            # the worker stopped early after reaching max_rss
+            self.requeue(remaining)
+        elif remaining:
+            # a clean exit that didn't report every run, count the runs as failed so retries stay bounded
+            logger.error("Worker exited without reporting interp_num %s:\n%s",
+                         ", ".join(str(interp_num) for interp_num in remaining), "\n".join(tail))
+            for interp_num in remaining:
+                self.finish(interp_num, "failed", 0.0)
+
+    def worker(self):
+        """ Keep a worker process running until the queue is empty """
+        while True:
+            batch = self.take_batch()
+            if batch:
+                self.run_batch(batch)
+                continue
+            with self.lock:
+                if self.running == 0 and not self.pending:
+                    return
+            # runs in other workers may still be retried
+            time.sleep(0.5)
+
+    def run(self):
+        """ Run all interp_num values, return the list that failed """
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.args.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(self.failed)
+
+
+if __name__ == "__main__":
+    '''
+    Run a graph count times across several Blender processes. Each run uses the same
+    seed and interp_num as a sequential run, so the output is identical.
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--graph', required=True)
+    parser.add_argument('--channel', required=True)
+    parser.add_argument('--count', required=True, type=int)
+    parser.add_argument('--start', default=0, type=int)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--threads', default=os.cpu_count() or 1, type=int,
+                        help='Total render threads, split across the workers')
+    parser.add_argument('--jobs_per_worker', default=50, type=int,
+                        help='Number of runs before a worker process is replaced')
+    parser.add_argument('--max_rss', default=None, type=int,
+                        help='Replace a worker process once its memory use exceeds this many MB')
+    parser.add_argument('--retries', default=2, type=int)
+    parser.add_argument('--seed', default=None, type=int)
+    parser.add_argument('--blender', default='blender')
+    parser.add_argument('--preview', action="store_true", default=False)
+    parser.add_argument('--output', default="./output")
+    parser.add_argument('--data', default='./data')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Local directory the workers share as a cache of the data volume files')
+    parser.add_argument('--cache_size', default=10240, type=int,
+                        help='Size limit of the volume cache in MB')
+    parser.add_argument('--prefetch', action="store_true", default=False,
+                        help='Copy the files of the packages a graph uses to the volume cache while it runs')
+    parser.add_argument('--loglevel', default="ERROR")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    if args.workers < 1 or args.count < 1 or args.jobs_per_worker < 1:
+        logger.error("count, workers and jobs_per_worker must be at least 1")
+        sys.exit(1)
+    if args.seed is None:
+        # every worker must use the same seed
+        args.seed = int(str(int(time.time()*1e7))[-9:])
+    print('Seed: {}'.format(args.seed))
+
+    starttime = time.time()
+    failed = Runner(args).run()
+    if failed:
+        logger.error("%d of %d runs failed, interp_num: %s", len(failed), args.count,
+                     ", ".join(str(num) for num in failed))
+
+    print('Elapsed Time: {:.3f}sec'.format(time.time()-starttime))
+    if failed:
+        sys.exit(1)
@@ -48,7 +48,8 @@ fi
 # make sure all deckard nodes are in channel config
 python validate_configs.py \
   --channel_config ../channels/$channel/config/channel.yml \
-  --deckard_config ../channels/$channel/config/deckard.yml
+  --deckard_config ../channels/$channel/config/deckard.yml \
+  --packages_dir ../packages
 echo "Configuration files validated."
 
 # Create the new Dockerfile used for deployment
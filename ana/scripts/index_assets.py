@@ -0,0 +1,109 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import os
+import argparse
+import json
+import bpy
+from mathutils import Vector
+import ana.packages.common.lib.context as ctx
+from ana.packages.common.lib.channel import Channel, file_hash, load_assets, ASSETS_VERSION
+from ana.packages.common.lib.package_utils import get_volume_path
+
+
+def index_collection(collection):
+    """ Summarize a collection of the open blender file """
+    objects = list(collection.all_objects)
+    meshes = [obj for obj in objects if obj.type == 'MESH']
+    materials = set()
+    for obj in objects:
+        for slot in obj.material_slots:
+            if slot.material is not None:
+                materials.add(slot.material.name)
+    # world space bounding box of the meshes
+    corners = [obj.matrix_world @ Vector(corner) for obj in meshes for corner in obj.bound_box]
+    if corners:
+        dimensions = [max(c[axis] for c in corners) - min(c[axis] for c in corners) for axis in range(3)]
+    else:
+        dimensions = [0.0, 0.0, 0.0]
+    return {
+        "roots": sorted(obj.name for obj in objects if obj.parent is None or obj.parent not in objects),
+        "objects": len(objects),
+        "meshes": len(meshes),
+        "polygons": sum(len(obj.data.polygons) for obj in meshes),
+        "vertices": sum(len(obj.data.vertices) for obj in meshes),
+        "dimensions": dimensions,
+        "materials": sorted(materials)}
+
+
+def index_file(blender_file):
+    """ Open a blender file and summarize all of its collections """
+    bpy.ops.wm.open_mainfile(filepath=blender_file)
+    return {collection.name: index_collection(collection) for collection in bpy.data.collections}
+
+
+if __name__ == "__main__":
+    '''
+    Index the blender files used by the packages of a channel. Run it in Blender from the ana directory:
+
+        blender --background --python scripts/index_assets.py -- --channel <channel-name> --data <data-dir>
+
+    The collections of every file named in package.yml are summarized in packages/<package>/config/assets.json.
+    Files whose hash matches the existing index are not opened again unless --force is given.
+    '''
+
+    # parse commmand line arguments
+    argv = sys.argv
+    argv = argv[argv.index("--") + 1:] if "--" in argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channel', required=True)
+    parser.add_argument('--data', default='./data')
+    parser.add_argument('--force', action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    # volume paths are resolved with the channel's package configuration
+    channel = Channel(ctx.ROOT_DIR, ctx.BASE_DIR, args.channel)
+    ctx.packages = channel.packages
+    ctx.data = args.data
+    assets = load_assets(ctx.BASE_DIR, channel.packages)
+
+    exit_code = 0
+    for package, package_config in channel.packages.items():
+        objects = package_config.get("objects") or {}
+        if not objects:
+            continue
+        manifest = assets.get(package) or {"version": ASSETS_VERSION, "files": {}}
+        for filename in sorted({object_config["filename"] for object_config in objects.values()}):
+            blender_file = get_volume_path(package, filename)
+            if not os.path.isfile(blender_file):
+                print(f"ERROR - package '{package}' file '{filename}' not found at '{blender_file}'")
+                exit_code = 1
+                continue
+            sha = file_hash(blender_file)
+            entry = manifest["files"].get(filename)
+            if entry is not None and entry["sha256"] == sha and not args.force:
+                print(f"'{filename}' is up to date")
+                continue
+            print(f"Indexing '{filename}'")
+            manifest["files"][filename] = {
+                "sha256": sha,
+                "size": os.path.getsize(blender_file),
+                "collections": index_file(blender_file)}
+
+        assets_file = os.path.join(ctx.BASE_DIR, "packages", package, "config", "assets.json")
+        with open(assets_file, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        print(f"Wrote '{assets_file}'")
+
+    sys.exit(exit_code)
@@ -11,21 +11,60 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import sys
 import argparse
+import json
 import yaml
 
+
+def validate_assets(channel_config, packages_dir):
+    """
+    Check the objects of the packages used by the channel against the asset index in
+    packages/<package>/config/assets.json. Returns True if no errors were found.
+    """
+    valid = True
+    package_names = sorted({node["module"].split(".")[2] for node in channel_config["nodes"].values()})
+    for package_name in package_names:
+        config_dir = os.path.join(packages_dir, package_name, "config")
+        with open(os.path.join(config_dir, "package.yml"), "r") as f:
+            package_config = yaml.safe_load(f) or {}
+        overrides = (channel_config.get("packages") or {}).get(package_name) or {}
+        package_config.update(overrides)
+        objects = package_config.get("objects") or {}
+        if not objects:
+            continue
+
+        assets_file = os.path.join(config_dir, "assets.json")
+        if not os.path.isfile(assets_file):
+            print(f"WARNING - package '{package_name}' has no asset index, run index_assets.py to check its objects")
+            continue
+        with open(assets_file, "r") as f:
+            files = json.load(f).get("files", {})
+
+        for filename in sorted({object_config["filename"] for object_config in objects.values()} - set(files)):
+            print(f"WARNING - package '{package_name}' file '{filename}' is not in the asset index")
+        for object_type, object_config in objects.items():
+            filename = object_config["filename"]
+            if filename in files and object_type not in files[filename]["collections"]:
+                print(f"ERROR - package '{package_name}' object '{object_type}' is not a collection in '{filename}'")
+                valid = False
+    return valid
+
+
 if __name__ == "__main__":
     '''
     This script is called by the buildchannel.sh script. It
     compares channel.yml with deckard.yml and verifies that
-    nodes in one are also in the other.
+    nodes in one are also in the other. With --packages_dir the
+    package objects are checked against the asset index.
     '''
 
     # parse commmand line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--channel_config', required=True)
     parser.add_argument('--deckard_config', required=True)
+    parser.add_argument('--packages_dir', default=None)
     args = parser.parse_args()
 
     with open(args.channel_config, "r") as f:
@@ -56,6 +95,9 @@ if __name__ == "__main__":
         print(f"ERROR - node '{node}' is in deckard.yml but not in channel.yml")
         exit_code = 1
 
+    if args.packages_dir is not None and not validate_assets(channel_config, args.packages_dir):
+        exit_code = 1
+
     if exit_code == 1:
         print("Invalid configuration")
 